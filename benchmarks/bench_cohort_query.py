@@ -0,0 +1,46 @@
+"""Time db.query_sqlite_db finding a cohort with set operations (the default) against pivoting every matching value
+per participant (wide=True) and against a warm bitmap index, on a synthetic database with an ICD10-like field of many
+array columns.
+
+Usage: python benchmarks/bench_cohort_query.py [n_participants] [n_wide_arrays]
+"""
+import os
+import sys
+import tempfile
+from ukbcc import db, bitmap
+from bench_storage_layout import write_synthetic_files, best_of
+
+
+def main():
+    n_participants = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_wide_arrays = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    icd10 = [('41270', f'D{c:03d}') for c in range(0, 1000, 5)]
+    queries = {'all_of one value': {'all_of': [('20000', '3')], 'any_of': [], 'none_of': []},
+               'any_of 200 ICD10 codes': {'all_of': [], 'any_of': icd10, 'none_of': []},
+               'all_of + any_of ICD10 + none_of': {'all_of': [('20001', '1')], 'any_of': icd10[:50],
+                                                    'none_of': [('20002', '2'), ('41270', 'D999')]},
+               'none_of only': {'all_of': [], 'any_of': [], 'none_of': [('20003', '5')]}}
+
+    with tempfile.TemporaryDirectory() as dirname:
+        files = write_synthetic_files(dirname, n_participants, 5, n_wide_arrays=n_wide_arrays)
+        con = db.create_sqlite_db(os.path.join(dirname, 'db.sqlite'), *files, profile='bulk')
+        index = bitmap.EidBitmapIndex(con=con)
+        results = {}
+        for name, criteria in queries.items():
+            sets = db.query_sqlite_db(con=con, cohort_criteria=criteria)
+            pivot = db.query_sqlite_db(con=con, cohort_criteria=criteria, wide=True)
+            assert set(sets['eid']) == set(pivot['eid']) == set(index.query(criteria))
+            results[name] = (len(sets),
+                             best_of(lambda: db.query_sqlite_db(con=con, cohort_criteria=criteria, wide=True), 3),
+                             best_of(lambda: db.query_sqlite_db(con=con, cohort_criteria=criteria), 3),
+                             best_of(lambda: index.query(criteria)))
+
+    print(f'\n{n_participants} participants, field 41270 with {n_wide_arrays} array columns')
+    for name, (n, pivot, sets, bitmaps) in results.items():
+        print(f'{name} ({n} participants): pivot {1000 * pivot:.1f}ms, sets {1000 * sets:.1f}ms '
+              f'({pivot / sets:.1f}x), bitmaps {1000 * bitmaps:.2f}ms')
+    print(f'bitmap index: {len(index.bitmaps)} bitmaps, {index.memory_usage() / 1024:.0f}KB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Time db.query_sqlite_db and db.count_cohort on a database served normally, with SQLite locking the file and checking
+it for changes, against the same database served immutable (connection.set_immutable). Both are timed on pooled
+connections and on a fresh connection per query. The difference is small on a local disk; pass a directory on the
+network filesystem (e.g. Lustre or NFS) to build the database there.
+
+Usage: python benchmarks/bench_immutable.py [n_participants] [directory]
+"""
+import os
+import sys
+import tempfile
+from ukbcc import db, connection
+from bench_storage_layout import write_synthetic_files, best_of
+
+
+def main():
+    n_participants = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = sys.argv[2] if len(sys.argv) > 2 else None
+    queries = {'all_of one value': {'all_of': [('20000', '3')], 'any_of': [], 'none_of': []},
+               'all_of + any_of + none_of': {'all_of': [('20001', '1')], 'any_of': [('20002', '2'), ('20003', '4')],
+                                              'none_of': [('20004', '5')]}}
+
+    with tempfile.TemporaryDirectory(dir=directory) as dirname:
+        files = write_synthetic_files(dirname, n_participants, 5)
+        db_filename = os.path.join(dirname, 'db.sqlite')
+        db.create_sqlite_db(db_filename, *files, profile='bulk').close()
+        results = {}
+        for mode in ['locking', 'immutable']:
+            connection.set_immutable(db_filename, mode == 'immutable')
+            for name, criteria in queries.items():
+                pooled = best_of(lambda: db.query_sqlite_db(criteria, db_filename=db_filename), 10)
+                count = best_of(lambda: db.count_cohort(criteria, db_filename=db_filename), 10)
+                def fresh():
+                    con = connection.connect_read_only(db_filename)
+                    db.query_sqlite_db(criteria, con=con)
+                    con.close()
+                results[mode, name] = (pooled, count, best_of(fresh, 10))
+        connection.set_immutable(db_filename, False)
+        connection.close_all()
+
+    print(f'\n{n_participants} participants, database in {directory or tempfile.gettempdir()}')
+    for name in queries:
+        for mode in ['locking', 'immutable']:
+            pooled, count, fresh = results[mode, name]
+            print(f'{name}, {mode}: query {1000 * pooled:.2f}ms, count {1000 * count:.2f}ms, '
+                  f'query on a fresh connection {1000 * fresh:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Time db.insert_main_chunk on a wide synthetic chunk against the previous melt and split implementation.
+
+Usage: python benchmarks/bench_insert_main_chunk.py [n_rows] [n_cols]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from ukbcc import db
+
+
+# insert_main_chunk as it was before the column map: melt, then regex split every value's column name
+def insert_main_chunk_melt(chunk, tab_name, tab_fields):
+    curr_tab_fields = set(chunk.columns.to_list()) & set(tab_fields)
+    trips = chunk[['eid'] + list(curr_tab_fields)].melt(id_vars='eid', value_vars=curr_tab_fields)
+    trips = trips[trips['value'].notnull()]
+    split = trips['variable'].str.split("[-.]", n=2, expand=True)
+    trips['field'], trips['time'], trips['array'] = split[0], split[1], split[2]
+    trips = trips[['eid', 'field', 'time', 'array', 'value']]
+    return (f'INSERT INTO {tab_name} values({",".join("?" * len(trips.columns))})', trips.values.tolist())
+
+
+def synthetic_chunk(n_rows, n_cols, fill=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    cols = [f'{20000 + i // 20}-{(i // 5) % 4}.{i % 5}' for i in range(n_cols)]
+    values = rng.integers(0, 50, size=(n_rows, n_cols)).astype(str).astype(object)
+    values[rng.random((n_rows, n_cols)) > fill] = None
+    chunk = pd.DataFrame(values, columns=cols)
+    chunk.insert(0, 'eid', np.arange(1000000, 1000000 + n_rows))
+    return chunk, cols
+
+
+def best_of(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_cols = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    chunk, cols = synthetic_chunk(n_rows, n_cols)
+    column_map = db.create_column_map({'str': cols}, chunk.columns)
+
+    n_values = len(db.insert_main_chunk(chunk, 'str', cols, column_map)[1])
+    assert n_values == len(insert_main_chunk_melt(chunk, 'str', cols)[1])
+    print(f'chunk: {n_rows} rows x {n_cols} columns, {n_values} non-null values')
+
+    before = best_of(lambda: insert_main_chunk_melt(chunk, 'str', cols))
+    after = best_of(lambda: db.insert_main_chunk(chunk, 'str', cols, column_map))
+    print(f'melt + split per value: {before:.3f}s per chunk')
+    print(f'precomputed column map: {after:.3f}s per chunk ({before / after:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
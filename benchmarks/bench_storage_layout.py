@@ -0,0 +1,99 @@
+"""Compare database file size and cohort query latency for the storage layouts of db.create_sqlite_db: the original
+tables plus indexes, compact, clustered (WITHOUT ROWID) and compact + clustered. Builds each layout from the same
+synthetic main, gp_clinical and showcase files.
+
+Usage: python benchmarks/bench_storage_layout.py [n_participants] [n_fields]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from ukbcc import db
+
+layouts = {'tables + indexes': {}, 'compact': {'compact': True}, 'clustered': {'clustered': True},
+           'compact + clustered': {'compact': True, 'clustered': True}}
+
+
+# Categorical fields 20000... with 2 instances x 3 arrays, plus integer field 21003 and the height field 50 which
+# query_sqlite_db uses for none_of queries. With n_wide_arrays, also an ICD10-like field 41270 with that many array
+# columns, filled from the front with codes D000... for about 5 diagnoses per participant.
+def write_synthetic_files(dirname, n_participants, n_fields, seed=0, n_wide_arrays=0):
+    rng = np.random.default_rng(seed)
+    eids = np.arange(1000000, 1000000 + n_participants)
+    main = {'eid': eids}
+    for f in range(20000, 20000 + n_fields):
+        for i in range(2):
+            for a in range(3):
+                values = rng.integers(0, 20, n_participants).astype(str).astype(object)
+                values[rng.random(n_participants) > 0.4] = None
+                main[f'{f}-{i}.{a}'] = values
+    n_codes = rng.poisson(5, n_participants)
+    for a in range(n_wide_arrays):
+        values = np.array([f'D{c:03d}' for c in rng.integers(0, 1000, n_participants)], dtype=object)
+        values[n_codes <= a] = None
+        main[f'41270-0.{a}'] = values
+    main['21003-0.0'] = rng.integers(40, 70, n_participants)
+    main['50-0.0'] = rng.integers(150, 200, n_participants)
+    main_filename = os.path.join(dirname, 'main.csv')
+    pd.DataFrame(main).to_csv(main_filename, index=False)
+
+    showcase = pd.DataFrame({'Path': 'x', 'Category': 1,
+                             'FieldID': list(range(20000, 20000 + n_fields)) + [41270, 21003, 50], 'Field': 'x',
+                             'ValueType': ['Categorical multiple'] * (n_fields + 1) + ['Integer', 'Continuous']})
+    showcase_filename = os.path.join(dirname, 'showcase.csv')
+    showcase.to_csv(showcase_filename, index=False)
+
+    n_events = 5 * n_participants
+    codes = np.array([f'X{c:03d}.' for c in range(500)])
+    days = rng.integers(0, 15000, n_events)
+    gp = pd.DataFrame({'eid': rng.choice(eids, n_events), 'data_provider': 3,
+                       'event_dt': (pd.Timestamp('1970-01-01') + pd.to_timedelta(days, unit='D')).strftime('%d/%m/%Y'),
+                       'read_2': rng.choice(codes, n_events), 'read_3': None, 'value1': None, 'value2': None,
+                       'value3': None})
+    gp_filename = os.path.join(dirname, 'gp_clinical.tsv')
+    gp.to_csv(gp_filename, sep='\t', index=False)
+    return main_filename, gp_filename, showcase_filename
+
+
+def best_of(fn, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    n_participants = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_fields = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    queries = {'all_of one value': {'all_of': [('20000', '3')], 'any_of': [], 'none_of': []},
+               'any_of three fields': {'all_of': [], 'any_of': [('20001', '1'), ('20002', '2'), ('21003', '55')],
+                                       'none_of': []},
+               'read_2 and none_of': {'all_of': [('read_2', 'X042.')], 'any_of': [], 'none_of': [('20003', '5')]}}
+
+    with tempfile.TemporaryDirectory() as dirname:
+        files = write_synthetic_files(dirname, n_participants, n_fields)
+        results = {}
+        for name, options in layouts.items():
+            db_filename = os.path.join(dirname, name.replace(' ', '') + '.sqlite')
+            start = time.perf_counter()
+            con = db.create_sqlite_db(db_filename, *files, step=5000, profile='bulk', **options)
+            build = time.perf_counter() - start
+            latency = {q: best_of(lambda: db.query_sqlite_db(con=con, cohort_criteria=c)) for q, c in queries.items()}
+            n_eids = {q: len(db.query_sqlite_db(con=con, cohort_criteria=c)) for q, c in queries.items()}
+            results[name] = (os.path.getsize(db_filename), build, latency, n_eids)
+            con.close()
+
+    print(f'\n{n_participants} participants, {n_fields} categorical fields')
+    base_size = results['tables + indexes'][0]
+    for name, (size, build, latency, n_eids) in results.items():
+        print(f'{name}: {size / 1024**2:.1f}MB ({size / base_size:.2f}x), build {build:.1f}s')
+        for q, t in latency.items():
+            print(f'    {q}: {1000 * t:.1f}ms ({n_eids[q]} participants)')
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,7 @@ setup(
         'Natural Language :: English',
         'Intended Audience :: Science/Research'
     ],
-    scripts=['bin/ukbcc_cli', 'bin/ukbcc', 'bin/build_database'],
+    scripts=['bin/ukbcc_cli', 'bin/ukbcc', 'bin/build_database', 'bin/purge_eids'],
     # entry_points={
     #     'console_scripts': [
     #         'ukbcc_alt = ukbcc.main:main',
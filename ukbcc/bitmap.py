@@ -0,0 +1,206 @@
+import numpy as np
+import collections
+import sqlite3
+import threading
+import os
+from functools import reduce
+from . import db, connection
+
+
+class EidBitmapIndex:
+    """In-memory bitmaps of the participants matching each (field, value) criterion of a database.
+
+    Every participant seen gets an ordinal, and the participants matching a criterion are held as a bitmap over the
+    ordinals. Bitmaps are Python ints, so and/or/andnot of a cohort over 500k participants are single C-level
+    operations on ~60KB. A bitmap is loaded from the database the first time its criterion is used. The bitmaps of
+    named phenotypes (lists of criteria combined by AND or OR) are kept as well, so a phenotype reused across cohorts
+    is only combined once. Bitmaps are kept until they take more than max_bytes, least recently used first out.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db to index
+    con: sqlite3.Connection
+        connection to use instead of the calling thread's pooled connection to db_filename
+    max_bytes: int
+        memory to use for bitmaps
+    """
+
+    def __init__(self, db_filename: str = None, con: sqlite3.Connection = None, max_bytes: int = 256 * 1024**2):
+        self.db_filename = db_filename
+        self.con = con
+        self.field_desc = db.load_field_metadata(self._connection())
+        self.ordinals = {}
+        self.eids = []
+        self.bitmaps = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stamp = None
+        self._eids_array = np.array([], dtype=np.int64)
+        self._lock = threading.RLock()
+
+    # Without a connection of its own, bitmaps are loaded on the calling thread's pooled connection, so a job watching
+    # that connection follows the loads and can cancel them
+    def _connection(self):
+        return self.con if self.con is not None else connection.get_connection(self.db_filename)
+
+    def _to_bitmap(self, eids):
+        for eid in eids:
+            if eid not in self.ordinals:
+                self.ordinals[eid] = len(self.eids)
+                self.eids.append(eid)
+        bits = np.zeros(len(self.eids), dtype=bool)
+        bits[[self.ordinals[eid] for eid in eids]] = True
+        return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+    def to_eids(self, bitmap: int) -> list:
+        """Sorted eids of the participants in a bitmap"""
+        bits = np.unpackbits(np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'), dtype=np.uint8),
+                             bitorder='little')
+        if len(self._eids_array) != len(self.eids):
+            self._eids_array = np.array(self.eids, dtype=np.int64)
+        return sorted(self._eids_array[np.flatnonzero(bits)].tolist())
+
+    # Look up a bitmap, making it with load() if it isn't kept, then evict the least recently used over max_bytes
+    def _cached(self, key, load):
+        with self._lock:
+            if key in self.bitmaps:
+                self.hits += 1
+                self.bitmaps.move_to_end(key)
+                return self.bitmaps[key]
+            self.misses += 1
+            bitmap = load()
+            self.bitmaps[key] = bitmap
+            self.nbytes += _nbytes(bitmap)
+            while self.nbytes > self.max_bytes and len(self.bitmaps) > 1:
+                _, old = self.bitmaps.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+                self.evictions += 1
+            return bitmap
+
+    def bitmap(self, field: str, value: str) -> int:
+        """Bitmap of the participants with `value` in any column of `field` ('nan' for any value at all)"""
+        def load():
+            qt = db.create_query_tuples({'all_of': [(field, value)]}, self.field_desc)[0]
+            rows = self._connection().execute(db.criterion_select(qt, self.field_desc)).fetchall()
+            return self._to_bitmap([x[0] for x in rows])
+        return self._cached((field, value), load)
+
+    def universe(self) -> int:
+        """Bitmap of every participant, from the participants table, or everyone with a height in databases without
+        one"""
+        if not self.field_desc.participants:
+            return self.bitmap('50', 'nan')
+        return self._cached(('participants',),
+                            lambda: self._to_bitmap([x[0] for x in self._connection().execute(
+                                db.universe_select(self.field_desc))]))
+
+    def phenotype(self, name: str, criteria: list, operation: str = 'and') -> int:
+        """Bitmap of the participants matching all ('and') or any ('or') of the (field, value) criteria of a named
+        phenotype. It is kept under the name and criteria, so a phenotype which is redefined is combined again."""
+        assert operation in ['and', 'or']
+        key = ('phenotype', name, operation, tuple(sorted(criteria)))
+        def load():
+            bitmaps = [self.bitmap(f, v) for f, v in criteria]
+            return reduce(lambda a, b: a & b if operation == 'and' else a | b, bitmaps)
+        return self._cached(key, load)
+
+    def answerable(self, cohort_criteria: dict) -> bool:
+        """Can every criterion be answered from bitmaps? Only plain (field, value) criteria can."""
+        return all(isinstance(v, str) for terms in cohort_criteria.values() for _, v in terms)
+
+    def cohort(self, cohort_criteria: dict) -> int:
+        """Bitmap of the cohort, with the same meaning as db.compile_cohort_query: all_of is an AND, any_of an OR, and
+        none_of criteria are removed with ANDNOT, from every participant if there is nothing else"""
+        with self._lock:
+            return self._combine([self.bitmap(f, v) for f, v in cohort_criteria.get('all_of', [])],
+                                 [self.bitmap(f, v) for f, v in cohort_criteria.get('any_of', [])],
+                                 [self.bitmap(f, v) for f, v in cohort_criteria.get('none_of', [])])
+
+    def phenotypes_cohort(self, phenotypes: dict) -> int:
+        """Bitmap of a cohort of named phenotypes, e.g. {'all_of': {'diabetes': [('20002', '1223')]}, ...}. It is the
+        same as the cohort of the criteria of the phenotypes listed together, but made from the kept bitmap of each
+        phenotype."""
+        def bitmaps(k, operation):
+            return [self.phenotype(name, criteria, operation) for name, criteria in phenotypes.get(k, {}).items()
+                    if criteria]
+        with self._lock:
+            return self._combine(bitmaps('all_of', 'and'), bitmaps('any_of', 'or'), bitmaps('none_of', 'or'))
+
+    def query(self, cohort_criteria: dict) -> list:
+        """Sorted eids of the cohort"""
+        return self.to_eids(self.cohort(cohort_criteria))
+
+    def query_phenotypes(self, phenotypes: dict) -> list:
+        """Sorted eids of a cohort of named phenotypes"""
+        return self.to_eids(self.phenotypes_cohort(phenotypes))
+
+    def count(self, cohort_criteria: dict) -> int:
+        """Number of participants in the cohort, without listing them"""
+        return popcount(self.cohort(cohort_criteria))
+
+    def count_phenotypes(self, phenotypes: dict) -> int:
+        """Number of participants in a cohort of named phenotypes, without listing them"""
+        return popcount(self.phenotypes_cohort(phenotypes))
+
+    def _combine(self, all_of, any_of, none_of):
+        cohort = reduce(lambda a, b: a & b, all_of) if all_of else 0
+        if any_of:
+            any_bitmap = reduce(lambda a, b: a | b, any_of)
+            cohort = cohort & any_bitmap if all_of else any_bitmap
+        if none_of:
+            if not (all_of or any_of):
+                cohort = self.universe()
+            for bitmap in none_of:
+                cohort &= ~bitmap
+        return cohort
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the bitmaps"""
+        return self.nbytes
+
+    def stats(self) -> dict:
+        """Hits, misses, hit rate, evictions, and the number and size of the bitmaps kept"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'bitmaps': len(self.bitmaps), 'bytes': self.nbytes}
+
+
+def _nbytes(bitmap):
+    return (bitmap.bit_length() + 7) // 8
+
+
+def popcount(bitmap: int) -> int:
+    """Number of bits set in a bitmap"""
+    return bin(bitmap).count('1')
+
+
+# One index per database file, replaced when the file changes or it is served differently (see
+# connection.serving_mode)
+_indexes = {}
+
+def get_bitmap_index(db_filename: str) -> EidBitmapIndex:
+    """Returns the bitmap index of a database, creating it the first time and again whenever the file has changed,
+    been loaded into or released from memory, or switched to or from immutable.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+
+    Returns:
+    --------
+    index: EidBitmapIndex
+    """
+    path = os.path.abspath(db_filename)
+    stamp = (db.db_file_stamp(path), connection.serving_mode(path))
+    index = _indexes.get(path)
+    if index is None or index.stamp != stamp:
+        index = EidBitmapIndex(path)
+        index.stamp = stamp
+        _indexes[path] = index
+    return index
@@ -15,6 +15,26 @@ def main():
         path to gp_clinical tsv file
     showcase_path: str
         path to showcase csv file
+    workers: int
+        number of processes used to parse the main dataset
+    bulk_load: bool
+        load with the 'bulk' profile (no journal, no syncing, one transaction) instead of the 'safe' one
+    compact: bool
+        store fields as integer ids and each distinct string value once
+    clustered: bool
+        store the value tables clustered on the cohort search key (WITHOUT ROWID) rather than as tables plus indexes
+    gp_table: bool
+        put gp_clinical records in their own indexed table rather than the str table
+    commit_every: int
+        number of chunks between commits and checkpoints, 0 (the default) to commit once at the end
+    resume: bool
+        carry on an interrupted build from its last checkpoint
+    codings_path: str
+        path to codings csv file, used to build the code hierarchy for descendant code criteria
+    eid_index: bool
+        also index the value tables by participant, for fast extraction of a cohort's data
+    no_stats: bool
+        don't build the field and value statistics used to order cohort queries
 
     Returns:
     --------
@@ -31,8 +51,38 @@ def main():
                         default=None)
     parser.add_argument('--showcase_path', help='Please specify the path to the showcase data file',
                         default=None)
+    parser.add_argument('--workers', type=int, help='Number of processes used to parse the main dataset file',
+                        default=1)
+    parser.add_argument('--bulk_load', action='store_true',
+                        help='Load without journaling or syncing in a single transaction. Faster, but an interrupted '
+                             'build leaves an unusable database file')
+    parser.add_argument('--compact', action='store_true',
+                        help='Store fields as integer ids and intern string values, giving a smaller database')
+    parser.add_argument('--clustered', action='store_true',
+                        help='Store the value tables clustered on the cohort search key instead of building '
+                             'separate indexes')
+    parser.add_argument('--gp_table', action='store_true',
+                        help='Store GP clinical records in their own table, with typed dates and indexes on each code '
+                             'type')
+    parser.add_argument('--commit_every', type=int, default=0,
+                        help='Commit and record a checkpoint every this many chunks, so an interrupted build can be '
+                             'resumed. Not possible with --bulk_load. 0, the default, commits once at the end')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted build of the database from its last checkpoint. Use the same '
+                             'options as the interrupted build')
+    parser.add_argument('--eid_index', action='store_true',
+                        help='Also index the value tables by participant, so the data of a cohort can be extracted '
+                             'without scanning the tables')
+    parser.add_argument('--codings_path', default=None,
+                        help='Please specify the path to the codings csv file, to allow criteria matching a code '
+                             'and all of its descendants')
+    parser.add_argument('--no_stats', action='store_true',
+                        help="Don't build the field and value statistics which order cohort queries and count the "
+                             "participants of search results. Saves reading the whole database once more")
 
     args = parser.parse_args()
+    if args.bulk_load and args.commit_every:
+        parser.error("--bulk_load can't roll back to a checkpoint, so can't be combined with --commit_every")
     # db_file = args.db_path
     # main_file = args.main_path
     # gp_clin_file =  args.gp_clin_path
@@ -42,7 +92,7 @@ def main():
         print(cols['orange'] + 'No db file path provided' + cols['default'])
         db_file = input('Please specify path to write the sqlite database file to e.g ./ukb_data.sqlite: ')
         overwrite = 'N'
-        while os.path.exists(db_file) and overwrite not in ['y', 'Y']:
+        while not args.resume and os.path.exists(db_file) and overwrite not in ['y', 'Y']:
             overwrite = input('File exists. Overwrite? [Y/N]: ')
     else:
         db_file = args.db_path
@@ -70,7 +120,10 @@ def main():
             showcase_file = input("Please specify correct path to showcase file: ")
     else:
         showcase_file = args.showcase_path
-    db.create_sqlite_db(db_file, main_file, gp_clin_file, showcase_file)
+    db.create_sqlite_db(db_file, main_file, gp_clin_file, showcase_file, workers=args.workers,
+                        profile='bulk' if args.bulk_load else 'safe', compact=args.compact,
+                        clustered=args.clustered, gp_table=args.gp_table, commit_every=args.commit_every, resume=args.resume,
+                        codings_file=args.codings_path, eid_index=args.eid_index, stats=not args.no_stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import collections
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import pandas as pd
+from . import db, connection
+
+
+def canonical_criteria(cohort_criteria: dict) -> dict:
+    """cohort_criteria with every value as a string and the criteria of each kind sorted, so that definitions which
+    only differ in order compare equal"""
+    return {k: sorted(tuple(str(x) for x in criterion) for criterion in cohort_criteria.get(k, []))
+            for k in ['all_of', 'any_of', 'none_of']}
+
+
+def db_fingerprint(db_filename: str) -> str:
+    """Path, modification time, size and build id of a database, which change whenever the database does"""
+    path = os.path.abspath(db_filename)
+    build_id = db.get_build_id(connection.get_connection(path))
+    return json.dumps([path, db.db_file_stamp(path), build_id])
+
+
+def cache_key(db_filename: str, cohort_criteria: dict, **options) -> str:
+    """Hash of the database fingerprint, the canonical criteria and any other query options"""
+    options = {k: sorted(v) if isinstance(v, (list, set, tuple)) else v for k, v in options.items()}
+    key = json.dumps([db_fingerprint(db_filename), canonical_criteria(cohort_criteria), options], sort_keys=True,
+                     default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class CohortCache:
+    """Results of query_sqlite_db, kept in memory for the most recently used queries and optionally in a side SQLite
+    file, which survives restarts. Keys include the database fingerprint, so a rebuilt, appended or purged database
+    never gets results from its earlier version; those are left to be evicted.
+
+    Keyword arguments:
+    ------------------
+    max_entries: int
+        number of results to keep in memory
+    disk_filename: str
+        optional path and filename of the side SQLite file
+    max_disk_bytes: int
+        size of results to keep in the side file, least recently used are evicted first
+    """
+
+    def __init__(self, max_entries: int = 64, disk_filename: str = None, max_disk_bytes: int = 1024**3):
+        self.max_entries = max_entries
+        self.disk_filename = disk_filename
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_filename:
+            self._disk = sqlite3.connect(disk_filename, check_same_thread=False)
+            self._disk.execute('CREATE TABLE IF NOT EXISTS cohort_cache (key TEXT PRIMARY KEY, result BLOB, '
+                               'size INTEGER, last_used REAL)')
+            self._disk.execute('CREATE INDEX IF NOT EXISTS cohort_cache_last_used ON cohort_cache (last_used)')
+            self._disk.commit()
+
+    def _remember(self, key, res):
+        self.memory[key] = res
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        """Cached result for a key, or None"""
+        with self._lock:
+            if key in self.memory:
+                self.hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key].copy()
+            if self._disk is not None:
+                row = self._disk.execute('SELECT result FROM cohort_cache WHERE key=?', (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._disk.execute('UPDATE cohort_cache SET last_used=? WHERE key=?', (time.time(), key))
+                    self._disk.commit()
+                    res = pickle.loads(row[0])
+                    self._remember(key, res)
+                    return res.copy()
+            self.misses += 1
+            return None
+
+    def put(self, key: str, res: pd.DataFrame):
+        """Cache a result, evicting the least recently used ones over the limits"""
+        with self._lock:
+            self._remember(key, res.copy())
+            if self._disk is None:
+                return
+            blob = pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL)
+            self._disk.execute('INSERT OR REPLACE INTO cohort_cache VALUES (?, ?, ?, ?)',
+                               (key, blob, len(blob), time.time()))
+            total = self._disk.execute('SELECT coalesce(sum(size), 0) FROM cohort_cache').fetchone()[0]
+            for old_key, size in self._disk.execute('SELECT key, size FROM cohort_cache ORDER BY last_used').fetchall():
+                if total <= self.max_disk_bytes:
+                    break
+                self._disk.execute('DELETE FROM cohort_cache WHERE key=?', (old_key,))
+                total -= size
+            self._disk.commit()
+
+    def query(self, db_filename: str, cohort_criteria: dict, eids_list: list = [], wide: bool = False,
+              bitmap_index=None, compute=None) -> pd.DataFrame:
+        """query_sqlite_db through the cache. Arguments are as for db.query_sqlite_db, and compute is an optional
+        function to call for the result instead of query_sqlite_db, which must give the same result."""
+        key = cache_key(db_filename, cohort_criteria, eids_list=eids_list, wide=wide)
+        res = self.get(key)
+        if res is None:
+            if compute is not None:
+                res = compute()
+            else:
+                res = db.query_sqlite_db(cohort_criteria, db_filename=db_filename, eids_list=eids_list, wide=wide,
+                                         bitmap_index=bitmap_index)
+            self.put(key, res)
+        return res
+
+    def stats(self) -> dict:
+        """Memory and disk hits, misses and number of results held in memory"""
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'memory_entries': len(self.memory)}
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+
+# One cache per side file (or None for memory only)
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cohort_cache(disk_filename: str = None) -> CohortCache:
+    """Returns the cohort cache backed by disk_filename, or the memory-only one, creating it the first time.
+
+    Keyword arguments:
+    ------------------
+    disk_filename: str
+        optional path and filename of the side SQLite file
+
+    Returns:
+    --------
+    cache: CohortCache
+    """
+    path = os.path.abspath(disk_filename) if disk_filename else None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = CohortCache(disk_filename=path)
+        return _caches[path]
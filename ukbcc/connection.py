@@ -0,0 +1,366 @@
+import sqlite3
+import threading
+import os
+import time
+import hashlib
+from urllib.parse import quote
+
+# Settings of the read-only connections. mmap_size is in bytes, cache_size in pages or, if negative, KiB.
+read_settings = {'mmap_size': 1024**3, 'cache_size': -256 * 1024}
+
+
+class MemoryCopyConnection(sqlite3.Connection):
+    """Connection to the in-memory copy of a database made by load_into_memory. It knows the file it was copied from
+    and that file's stamp at the time, which the caches keyed on the database file use."""
+    source_filename = None
+    source_stamp = None
+
+
+# Database files opened immutable by set_immutable, by path, with the file's stamp when it was set
+_immutable = {}
+_immutable_lock = threading.Lock()
+
+
+def set_immutable(db_filename: str, immutable: bool = True):
+    """Serves a database file read-only and immutable, for databases on network filesystems such as Lustre or NFS,
+    where SQLite's file locking is slow and can deadlock. Connections to it are opened with `mode=ro&immutable=1`, so
+    SQLite takes no locks and never checks the file or its journal for changes, and the connection pool and the
+    caches keyed on the file's stamp stop looking at the file at all. The file must then not change while it is
+    served: building, refreshing or purging it raises a ValueError until set_immutable(db_filename, False) is called,
+    and writes through the connections fail with 'attempt to write a readonly database'.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+    immutable: bool
+        whether to serve it immutable
+    """
+    from . import db
+    path = os.path.abspath(db_filename)
+    with _immutable_lock:
+        if (path in _immutable) == immutable:
+            return
+        if immutable:
+            _immutable[path] = db.db_file_stamp(path)
+        else:
+            del _immutable[path]
+    # Connections already open were opened in the other mode
+    get_pool(path).close()
+    print(f'Serving {path} {"immutable" if immutable else "with locking"}')
+
+
+def is_immutable(db_filename: str) -> bool:
+    """Whether a database file is served immutable (see set_immutable)"""
+    return os.path.abspath(db_filename) in _immutable
+
+
+def immutable_stamp(db_filename: str) -> tuple:
+    """The stamp of a database file served immutable, as it was when set_immutable was called, or None"""
+    return _immutable.get(os.path.abspath(db_filename))
+
+
+def check_writable(db_filename: str):
+    """Raises a ValueError if a database file is served immutable, so must not be written to"""
+    if is_immutable(db_filename):
+        raise ValueError(f'{db_filename} is served read-only and immutable, so must not be written to. Call '
+                         f'connection.set_immutable(db_filename, False) (or turn off immutable in the config) first.')
+
+
+# In-memory copies of database files, by path: the URI of the copy, the connection keeping it alive, and how long it
+# took to make and how big it is
+_memory_copies = {}
+_memory_lock = threading.Lock()
+
+
+def load_into_memory(db_filename: str) -> dict:
+    """Copies a database into a shared-cache in-memory database with the sqlite3 backup API. From then on every
+    read-only connection to db_filename (connect_read_only, the connection pools, the bitmap index and with them
+    query_sqlite_db, count_cohort and compute_stats_db) reads the copy instead of the file. The copy is a snapshot:
+    call this again to pick up a rebuilt database, or release_memory_copy to go back to the file.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+
+    Returns:
+    --------
+    stats: dict
+        seconds taken to copy the database and bytes it takes in memory
+    """
+    from . import db
+    path = os.path.abspath(db_filename)
+    uri = 'file:ukbcc_{}?mode=memory&cache=shared'.format(hashlib.sha1(path.encode()).hexdigest())
+    print(f'Loading {path} into memory')
+    start = time.time()
+    stamp = db.db_file_stamp(path)
+    source = connect_read_only(path, check_same_thread=False, in_memory=False)
+    # A new copy replaces any earlier one, so a reload gets a fresh in-memory database
+    release_memory_copy(path)
+    keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    source.backup(keeper)
+    source.close()
+    page_size = keeper.execute('PRAGMA page_size').fetchone()[0]
+    nbytes = keeper.execute('PRAGMA page_count').fetchone()[0] * page_size
+    stats = {'seconds': time.time() - start, 'bytes': nbytes}
+    with _memory_lock:
+        _memory_copies[path] = dict(stats, uri=uri, keeper=keeper, stamp=stamp, loaded=start)
+    get_pool(path).close()
+    print(f'Loaded {nbytes / 1024**2:.1f}MB into memory in {stats["seconds"]:.1f}s')
+    return stats
+
+
+def release_memory_copy(db_filename: str):
+    """Drops the in-memory copy of a database, if it has one, so connections read the file again"""
+    path = os.path.abspath(db_filename)
+    with _memory_lock:
+        copy = _memory_copies.pop(path, None)
+    if copy is not None:
+        get_pool(path).close()
+        copy['keeper'].close()
+
+
+def serving_mode(db_filename: str) -> tuple:
+    """How connections to a database are opened: when its in-memory copy was made (None if it has none) and whether
+    it is served immutable. Anything kept from reads of the database, like its bitmap index, should be dropped when
+    this changes."""
+    path = os.path.abspath(db_filename)
+    copy = _memory_copies.get(path)
+    return (copy['loaded'] if copy is not None else None, path in _immutable)
+
+
+def memory_stats() -> dict:
+    """Seconds taken to load and bytes in memory of the in-memory copy of each database, by path"""
+    with _memory_lock:
+        return {path: {'seconds': copy['seconds'], 'bytes': copy['bytes']} for path, copy in _memory_copies.items()}
+
+
+def warm(db_filename: str, names: list) -> dict:
+    """Reads every page of some tables or indexes of a database file, so that queries using them find the pages in
+    the operating system's cache and the memory map rather than going to disk. An alternative to load_into_memory
+    when the whole database doesn't fit in memory.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+    names: list
+        names of tables and indexes to read, e.g. ['str_index', 'participants']
+
+    Returns:
+    --------
+    stats: dict
+        seconds taken to read each of them and, where SQLite can tell, their bytes
+    """
+    con = get_connection(db_filename)
+    stats = {}
+    for name in names:
+        row = con.execute("SELECT type, tbl_name FROM sqlite_master WHERE name=? AND type IN ('table', 'index')",
+                          (name,)).fetchone()
+        if row is None:
+            raise ValueError(f'{name} is not a table or index of {db_filename}')
+        start = time.time()
+        if row[0] == 'index':
+            con.execute(f'SELECT count(*) FROM "{row[1]}" INDEXED BY "{name}"').fetchone()
+        else:
+            con.execute(f'SELECT count(*) FROM "{name}" NOT INDEXED').fetchone()
+        stats[name] = {'seconds': time.time() - start, 'bytes': _btree_bytes(con, name)}
+        print(f'Warmed {name} in {stats[name]["seconds"]:.1f}s')
+    return stats
+
+
+# Bytes of a table or index, from the dbstat virtual table, which not every SQLite build has
+def _btree_bytes(con, name):
+    try:
+        return con.execute('SELECT sum(pgsize) FROM dbstat WHERE name=?', (name,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def connect_read_only(db_filename: str, mmap_size: int = None, cache_size: int = None,
+                      check_same_thread: bool = True, in_memory: bool = True,
+                      immutable: bool = None) -> sqlite3.Connection:
+    """Opens a read-only connection to a database, in URI mode so SQLite itself refuses writes, with query_only set
+    and the given memory map and page cache sizes (read_settings by default). If the database has been loaded into
+    memory with load_into_memory, the connection is to the in-memory copy, unless in_memory is False. If it is served
+    immutable (see set_immutable), the file is opened with immutable=1 and SQLite doesn't lock it.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+    mmap_size: int
+        bytes of the database file to memory map
+    cache_size: int
+        page cache size, in pages or in KiB if negative
+    check_same_thread: bool
+        passed on to sqlite3.connect
+    in_memory: bool
+        connect to the in-memory copy of the database if there is one
+    immutable: bool
+        open the file immutable. Defaults to whether it is served immutable.
+
+    Returns:
+    --------
+    con: sqlite3.Connection
+    """
+    path = os.path.abspath(db_filename)
+    copy = _memory_copies.get(path) if in_memory else None
+    if copy is not None:
+        con = sqlite3.connect(copy['uri'], uri=True, check_same_thread=check_same_thread,
+                              factory=MemoryCopyConnection)
+        con.source_filename = path
+        con.source_stamp = copy['stamp']
+        con.execute('PRAGMA query_only=ON')
+        return con
+    mmap_size = read_settings['mmap_size'] if mmap_size is None else mmap_size
+    cache_size = read_settings['cache_size'] if cache_size is None else cache_size
+    immutable = path in _immutable if immutable is None else immutable
+    uri = 'file:{}?mode=ro{}'.format(quote(path), '&immutable=1' if immutable else '')
+    con = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    con.execute('PRAGMA query_only=ON')
+    con.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+    con.execute(f'PRAGMA cache_size={int(cache_size)}')
+    return con
+
+
+class ConnectionPool:
+    """Read-only connections to one database, one per thread, kept open so that queries reuse a warm page cache.
+
+    Servers such as werkzeug handle each request on a new thread, so the connection of a thread which has exited is
+    handed on to the next thread without one, rather than opening another; any others left by exited threads are
+    closed. There are never more connections than threads using the pool.
+
+    A thread's connection is reopened if the database file has been replaced since it was opened (e.g. rebuilt), as
+    it would otherwise keep reading the old file. Files served immutable aren't looked at.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+    mmap_size: int
+        bytes of the database file to memory map
+    cache_size: int
+        page cache size, in pages or in KiB if negative
+    """
+
+    def __init__(self, db_filename: str, mmap_size: int = None, cache_size: int = None):
+        self.db_filename = os.path.abspath(db_filename)
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # Bumped by close(). Connections opened before then are reopened by their thread on its next query.
+        self.generation = 0
+        self._local = threading.local()
+        # Open connections by id, with the thread using each, the inode of the file it was opened on and the
+        # generation it was opened in
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection, taken over from an exited thread or opened on first use"""
+        # An immutable file is promised not to change, which saves a stat of it per query on network filesystems
+        inode = None if self.db_filename in _immutable else os.stat(self.db_filename).st_ino
+        generation = self.generation
+        con = getattr(self._local, 'con', None)
+        if con is not None and self._local.inode == inode and self._local.generation == generation:
+            with self._lock:
+                self.hits += 1
+            return con
+        if con is not None:
+            self._close(con)
+        con = None
+        stale = []
+        with self._lock:
+            for key, (other, thread, other_inode, other_generation) in list(self._connections.items()):
+                if thread.is_alive():
+                    continue
+                if con is None and other_inode == inode and other_generation == generation:
+                    con = other
+                    self._connections[key] = (con, threading.current_thread(), inode, generation)
+                else:
+                    stale.append(self._connections.pop(key)[0])
+            if con is not None:
+                self.hits += 1
+        for other in stale:
+            other.close()
+        if con is None:
+            # Connections are only used by one thread at a time, but are passed on and may be closed by any thread
+            con = connect_read_only(self.db_filename, self.mmap_size, self.cache_size, check_same_thread=False)
+            with self._lock:
+                self.misses += 1
+                self._connections[id(con)] = (con, threading.current_thread(), inode, generation)
+        self._local.con = con
+        self._local.inode = inode
+        self._local.generation = generation
+        return con
+
+    def _close(self, con):
+        with self._lock:
+            self._connections.pop(id(con), None)
+        con.close()
+
+    def close(self):
+        """Closes the calling thread's connection and those left by exited threads. Other threads may be in the
+        middle of a query, so their connections are closed and reopened by the threads themselves on their next
+        query."""
+        current = threading.current_thread()
+        with self._lock:
+            self.generation += 1
+            closing = [key for key, (_, thread, _, _) in self._connections.items()
+                       if thread is current or not thread.is_alive()]
+            connections = [self._connections.pop(key)[0] for key in closing]
+        for con in connections:
+            con.close()
+        self._local.con = None
+
+    def stats(self) -> dict:
+        """Pool hits and misses, and the number of open connections"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'open_connections': len(self._connections)}
+
+
+# One pool per database file
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_filename: str) -> ConnectionPool:
+    """Returns the connection pool of a database, creating it the first time.
+
+    Keyword arguments:
+    ------------------
+    db_filename: str
+        path and filename of db
+
+    Returns:
+    --------
+    pool: ConnectionPool
+    """
+    path = os.path.abspath(db_filename)
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+
+def get_connection(db_filename: str) -> sqlite3.Connection:
+    """Returns the calling thread's pooled read-only connection to a database. Don't close it."""
+    return get_pool(db_filename).connection()
+
+
+def pool_stats() -> dict:
+    """Hits, misses and open connections of the pool of every database, by path"""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {path: pool.stats() for path, pool in pools.items()}
+
+
+def close_all():
+    """Closes every pooled connection, those of other live threads once they next ask for one (see
+    ConnectionPool.close)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
@@ -1,15 +1,30 @@
 import pandas as pd
+import numpy as np
 import sqlite3
 import progressbar
 from datetime import datetime
 import re
 import os
-
-# Create a table for a given category ('cat')
-def create_long_value_table_query(tab_name, tab_type):
+import collections
+import multiprocessing
+import time
+import random
+import contextlib
+from io import StringIO
+from . import connection
+
+# Create a table for a given category ('cat'). In the compact schema field is the field_id from field_desc and str
+# values are ids into the str_values table. A clustered table is a WITHOUT ROWID table whose primary key is the
+# cohort search path (the columns of the index made by create_index, plus array), so it needs no separate index.
+clustered_key = ["field", "value", "time", "eid", "array"]
+
+def create_long_value_table_query(tab_name, tab_type, compact=False, clustered=False):
 	field_cols = ["eid", "field", "time","array", "value"]
-	field_col_types = ["INTEGER", "VARCHAR", "INTEGER", "INTEGER", tab_type]
+	field_col_types = ["INTEGER", "INTEGER" if compact else "VARCHAR", "INTEGER", "INTEGER",
+					   "INTEGER" if compact and tab_name == 'str' else tab_type]
 	cols = ','.join(map(' '.join, zip(field_cols, field_col_types)))
+	if clustered:
+		return f"CREATE TABLE {tab_name} ({cols},PRIMARY KEY ({','.join(clustered_key)})) WITHOUT ROWID ;"
 	cmd = f"CREATE TABLE {tab_name} ({cols}) ;"
 	return (cmd)
 
@@ -77,44 +92,115 @@ def create_field_desc(main_df, showcase_file):
 	return field_desc.append(field_desc_new)
 
 
-def create_table_queries(tabs):
+def create_table_queries(tabs, compact=False, clustered=False):
 	#
 	# Create a table for every sqltype
 	#print("create tables")
 	queries=[]
 	for tab_name, field_type in tabs.items():
 		queries.append(f"DROP TABLE IF EXISTS {tab_name};")
-		queries.append(create_long_value_table_query(tab_name=tab_name, tab_type=field_type))
+		queries.append(create_long_value_table_query(tab_name=tab_name, tab_type=field_type, compact=compact,
+													 clustered=clustered))
+	if compact:
+		queries.append("DROP TABLE IF EXISTS str_values;")
+		queries.append("CREATE TABLE str_values (id INTEGER PRIMARY KEY,value VARCHAR UNIQUE) ;")
 	return queries
 
 
-def insert_main_chunk(chunk, tab_name, tab_fields):
-	# Convert to triples, remove nulls and then explode field
-	#TODO: Why is this crazy tab_fields thing here, why not jsut make this a list?
-	#trips = chunk[tab_fields[tab_name].append(tf_eid)].melt(id_vars='eid', value_vars=tab_fields[tab_name])
-	curr_tab_fields = set(chunk.columns.to_list())&set(tab_fields)
-	trips = chunk[['eid'] + list(curr_tab_fields)].melt(id_vars='eid', value_vars=curr_tab_fields)
-	trips = trips[trips['value'].notnull()]
+# Give every field an integer id, used in place of the field name by the compact schema
+def add_field_ids_to_field_desc(field_desc):
+	field_ids = {f: i for i, f in enumerate(field_desc['field'].unique())}
+	field_desc['field_id'] = list(map(field_ids.get, field_desc['field']))
+	return field_desc
 
-	# This is constant if we have it in the row before?
-	trips['field'], trips['time'], trips['array'] = trips['variable'].str.split("[-.]", 2).str
-	trips = trips[['eid', 'field', 'time', 'array', 'value']]
+
+# Does field_desc describe a database with the compact schema?
+def is_compact(field_desc):
+	if isinstance(field_desc, FieldMetadata):
+		return field_desc.compact
+	return 'field_id' in field_desc.columns
+
+
+# Each build, append and purge stamps the database with a new random build id, kept in its user_version, so that
+# results computed from an earlier version of the database can be told apart from current ones
+def set_build_id(con):
+	con.execute(f'PRAGMA user_version={random.randint(1, 2**31 - 1)}')
+
+
+def get_build_id(con):
+	return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Were the value tables of the database created clustered (WITHOUT ROWID)?
+def is_clustered(con):
+	sql = con.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='str'").fetchone()
+	return sql is not None and 'WITHOUT ROWID' in sql[0].upper()
+
+
+# Split the main dataset column names into field, instance and array once, so inserting a chunk needs no string
+# operations. For each table gives the list of columns along with integer arrays of their field, time and array.
+# Columns which are not in `columns` (e.g. the header of the main file) or are not main dataset columns are dropped.
+# If field_ids is given (compact schema) fields are mapped to their ids.
+def create_column_map(tab_fields, columns=None, field_ids=None):
+	columns = None if columns is None else set(columns)
+	column_map = {}
+	for tab_name, fields in tab_fields.items():
+		cols = [f for f in fields if re.match(r'^\d+-\d+\.\d+$', f) and (columns is None or f in columns)]
+		parts = [re.split(r'[-.]', f) for f in cols]
+		if field_ids is not None:
+			parts = [[field_ids[p[0]]] + p[1:] for p in parts]
+		parts = np.array(parts, dtype=np.int64).reshape(-1, 3)
+		column_map[tab_name] = {'cols': cols, 'field': parts[:, 0], 'time': parts[:, 1], 'array': parts[:, 2]}
+	return column_map
+
+
+def insert_main_chunk(chunk, tab_name, tab_fields, column_map=None):
+	# Convert to triples and remove nulls. Values are taken column by column (like a melt), with the field, time and
+	# array of each value looked up from the precomputed column map
+	if column_map is None:
+		column_map = create_column_map({tab_name: tab_fields}, chunk.columns)
+	tab_map = column_map[tab_name]
+	n_rows, n_cols = len(chunk), len(tab_map['cols'])
+
+	values = chunk[tab_map['cols']]
+	notnull = values.notna().to_numpy(dtype=bool).T.ravel()
+	col_idx = np.repeat(np.arange(n_cols), n_rows)[notnull]
+	row_idx = np.tile(np.arange(n_rows), n_cols)[notnull]
+
+	trips = pd.DataFrame({'eid': chunk['eid'].to_numpy()[row_idx],
+						  'field': tab_map['field'][col_idx],
+						  'time': tab_map['time'][col_idx],
+						  'array': tab_map['array'][col_idx],
+						  'value': values.to_numpy(dtype=object).T.ravel()[notnull]})
 	if (tab_name == 'datetime'):
-		trips['value'] = pd.to_numeric(trips['value'])
-	#
-	# if not trips.shape[0]:
-	#    continue
+		trips['value'] = pd.to_numeric(pd.Series(trips['value'].to_numpy()))
+	# Go column by column so integer columns stay integers rather than being upcast alongside real values
 	return (f'INSERT INTO {tab_name} values({",".join("?" * len(trips.columns))})',
-							trips.values.tolist())
+							list(zip(*[trips[c].tolist() for c in trips.columns])))
 
 
-#TODO: Give gp_clinical data its own table. I think the event dates cannot be fit into the form we currently have
-def insert_gp_clin_chunk(chunk):
+# Convert gp_clinical event dates (dd/mm/yyyy) to days since 1970-01-01
+def event_dt_to_days(event_dt):
+	dates = pd.to_datetime(event_dt, format='%d/%m/%Y', errors='coerce')
+	return ((dates - pd.Timestamp('1970-01-01')).dt.days).astype('Int64')
+
+
+# Insert gp_clinical records into the str table, as read_2/read_3 fields. Builds with gp_table use the gp_clinical
+# table instead, see insert_gp_clinical_table_chunk
+def insert_gp_clin_chunk(chunk, field_ids=None, clustered=False):
 	#chunk['read_2'] = chunk.read_2.combine_first(chunk.read_3)
 	#print("chunk: {}".format(chunk))
 
 	chunk = chunk.melt(id_vars=['eid', 'data_provider', 'event_dt'], value_vars=['read_2', 'read_3']).query('~value.isna()')
 	chunk['array'] = '0'
+	# The compact schema stores field ids and event dates as day numbers, so time is an integer like the main data
+	if field_ids is not None:
+		chunk['variable'] = chunk['variable'].map(field_ids)
+		chunk['event_dt'] = event_dt_to_days(chunk['event_dt'])
+		chunk['array'] = 0
+	# Primary key columns can't be NULL, so a clustered table records a missing event date as -1
+	if clustered:
+		chunk['event_dt'] = chunk['event_dt'].fillna(-1)
 	# To have field as data_provider and value as read2/3
 	trips = chunk.rename(columns={'variable': 'field', 'event_dt': 'time'})[
 		['eid', 'field', 'time', 'array', 'value']]
@@ -122,18 +208,368 @@ def insert_gp_clin_chunk(chunk):
 	#trips['field'] = 'read_' + trips['field'].astype(str)
 	#print(trips)
 	return (f'INSERT INTO {"str"} values({",".join("?" * len(trips.columns))})',
-						trips.values.tolist())
+						list(zip(*[trips[c].astype(object).where(trips[c].notnull(), None).tolist()
+								   for c in trips.columns])))
+
+
+# Columns of the gp_clinical table, as in the gp_clinical file but with event_dt as a day number (see event_dt_to_days)
+gp_clinical_cols = ['eid', 'data_provider', 'event_dt', 'read_2', 'read_3', 'value1', 'value2', 'value3']
+
+def create_gp_clinical_table_query():
+	types = ['INTEGER', 'INTEGER', 'INTEGER', 'VARCHAR', 'VARCHAR', 'VARCHAR', 'VARCHAR', 'VARCHAR']
+	return f"CREATE TABLE gp_clinical ({','.join(map(' '.join, zip(gp_clinical_cols, types)))}) ;"
+
+
+# Read the codes and values of gp_clinical as strings, otherwise a chunk of purely numeric codes (e.g. '4662.') is
+# read as floats
+gp_clinical_dtypes = {'read_2': str, 'read_3': str, 'value1': str, 'value2': str, 'value3': str}
+
+# Insert a chunk of the gp_clinical file into the gp_clinical table
+def insert_gp_clinical_table_chunk(chunk):
+	chunk = chunk.reindex(columns=gp_clinical_cols)
+	chunk['event_dt'] = event_dt_to_days(chunk['event_dt'])
+	return (f'INSERT INTO gp_clinical values({",".join("?" * len(gp_clinical_cols))})',
+			list(zip(*[chunk[c].astype(object).where(chunk[c].notnull(), None).tolist() for c in gp_clinical_cols])))
+
+
+# Do read_2/read_3 queries go to the gp_clinical table?
+def has_gp_clinical_table(field_desc):
+	if isinstance(field_desc, FieldMetadata):
+		return field_desc.tab.get('read_2') == 'gp_clinical'
+	return (field_desc[field_desc['field'] == 'read_2']['tab'] == 'gp_clinical').any()
+
+
+# Swap the str values in rows for their id in str_values, adding any values we haven't seen before.
+# value_ids maps value to id and is updated in place, so pass the same dictionary for the whole build.
+def intern_str_values(con, rows, value_ids):
+	new_values = []
+	def value_id(value):
+		id = value_ids.get(value)
+		if id is None:
+			id = value_ids[value] = len(value_ids) + 1
+			new_values.append((id, value))
+		return id
+	rows = [row[:4] + (value_id(row[4]),) for row in rows]
+	con.executemany('INSERT INTO str_values values(?,?)', new_values)
+	return rows
+
+
+# Columns which identify a row when refreshing an existing database. A main dataset value is replaced if the new
+# basket has a different one, while a gp_clinical record is added unless the same record is already there.
+main_refresh_key = ['eid', 'field', 'time', 'array']
+gp_refresh_key = ['eid', 'field', 'time', 'array', 'value']
+
+
+# Write rows into a table that may already hold them. Rows whose key is already in the table with a different value
+# are deleted, then rows whose key isn't in the table are inserted, so unchanged rows aren't touched. Looks rows up
+# with the index made by create_eid_index (or the gp_clinical eid index). Returns the number of rows inserted.
+def upsert_rows(con, tab_name, rows, key, clustered=False):
+	cols = gp_clinical_cols if tab_name == 'gp_clinical' else ['eid', 'field', 'time', 'array', 'value']
+	match = ' AND '.join(f'{c} IS ?' for c in key)
+	if 'value' in cols and 'value' not in key:
+		con.executemany(f'DELETE FROM {tab_name} WHERE {match} AND value IS NOT ?',
+						[tuple(row[cols.index(c)] for c in key) + (row[4],) for row in rows])
+	return con.executemany(f'INSERT {"OR IGNORE " if clustered else ""}INTO {tab_name} SELECT {",".join("?" * len(cols))} '
+						   f'WHERE NOT EXISTS (SELECT 1 FROM {tab_name} WHERE {match})',
+						   [tuple(row) + tuple(row[cols.index(c)] for c in key) for row in rows]).rowcount
+
+
+# Run an insert created by insert_main_chunk or insert_gp_clin_chunk. With the compact schema (value_ids given),
+# str values are interned first. Clustered tables have a primary key, so rows which are exact repeats (the same
+# gp_clinical code on the same day) are skipped. If refresh_key is given the rows are upserted on those columns.
+# Returns the number of rows inserted.
+def write_chunk(con, tab_name, query, rows, value_ids=None, clustered=False, refresh_key=None):
+	# Participants are upserted, so a refresh keeps their flags, and aren't counted as data rows
+	if tab_name == 'participants':
+		con.executemany(query, rows)
+		return 0
+	if value_ids is not None and tab_name == 'str':
+		rows = intern_str_values(con, rows, value_ids)
+	if refresh_key is not None:
+		return upsert_rows(con, tab_name, rows, refresh_key, clustered)
+	if clustered:
+		query = query.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+	return con.executemany(query, rows).rowcount
 
 
 def create_index(con):
 	print('Creating string index')
-	con.execute('CREATE INDEX str_index ON str (field, value, time, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS str_index ON str (field, value, time, eid)')
 	print('Creating integer index')
-	con.execute('CREATE INDEX int_index ON int (field, value, time, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS int_index ON int (field, value, time, eid)')
 	print('Creating continuous index')
-	con.execute('CREATE INDEX real_index ON real (field, value, time, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS real_index ON real (field, value, time, eid)')
 	print('Creating date index')
-	con.execute('CREATE INDEX dt_index ON datetime (field, value, time, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS dt_index ON datetime (field, value, time, eid)')
+
+
+# Index the value tables by participant, for changes to existing participants' data
+def create_eid_index(con):
+	for tab_name in ['str', 'int', 'real', 'datetime']:
+		print(f'Creating {tab_name} participant index')
+		con.execute(f'CREATE INDEX IF NOT EXISTS {tab_name}_eid_index ON {tab_name} (eid, field, time, array, value)')
+
+
+def drop_eid_index(con):
+	for tab_name in ['str', 'int', 'real', 'datetime']:
+		con.execute(f'DROP INDEX IF EXISTS {tab_name}_eid_index')
+
+
+# Index gp_clinical for code lookups, optionally within a date window, and by participant
+def create_gp_clinical_index(con):
+	print('Creating gp_clinical indexes')
+	con.execute('CREATE INDEX IF NOT EXISTS gp_read_2_index ON gp_clinical (read_2, event_dt, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS gp_read_3_index ON gp_clinical (read_3, event_dt, eid)')
+	con.execute('CREATE INDEX IF NOT EXISTS gp_eid_index ON gp_clinical (eid, event_dt)')
+
+
+# One row per participant, the universe that none_of criteria are taken away from. Sex is taken from field 31 when the
+# basket has it, and withdrawn participants are flagged by mark_withdrawn. A database without the table gets it
+# filled from the participants in its value tables.
+participant_cols = ['eid', 'sex', 'withdrawn']
+
+def create_participants_table(con):
+	if has_participants_table(con):
+		return
+	print('Creating participants table')
+	con.execute('CREATE TABLE participants (eid INTEGER PRIMARY KEY, sex INTEGER, withdrawn INTEGER DEFAULT 0)')
+	eids = " union ".join(f"select eid from {tab_name}" for tab_name in ['str', 'int', 'real', 'datetime'])
+	con.execute(f'INSERT INTO participants (eid) {eids}')
+
+
+# Make the participants upsert for a chunk of the main file
+def insert_participants_chunk(chunk):
+	sex = chunk['31-0.0'] if '31-0.0' in chunk.columns else pd.Series([None] * len(chunk))
+	rows = [(int(eid), None if pd.isna(x) else int(x)) for eid, x in zip(chunk['eid'], sex)]
+	return ('INSERT INTO participants (eid, sex) values(?,?) ON CONFLICT (eid) DO UPDATE SET '
+			'sex=coalesce(excluded.sex, sex)', rows)
+
+
+def mark_withdrawn(con, eids):
+	"""Flag participants as withdrawn in the participants table
+
+	Keyword arguments:
+	------------------
+	con: sqlite3.Connection
+		connection to the db
+	eids: list
+		EIDs of the withdrawn participants
+
+	Returns:
+	--------
+	n: int
+		number of participants flagged
+
+	"""
+	return con.executemany('UPDATE participants SET withdrawn=1 WHERE eid=?', [(int(e),) for e in eids]).rowcount
+
+
+# Codings (from showcase.csv) whose tree can be worked out from the codes themselves, as codings.csv has no node ids.
+# A code's parent is the longest other code of the coding which it starts with (A000 -> A00), and codes with no such
+# parent fall under the block whose range they are in (A00 -> Block A00-A09).
+prefix_codings = ['19', '87', '240']
+
+def coding_parents(values):
+	codes = set(values)
+	blocks = [(v, m.group(1), m.group(2)) for v in codes for m in [re.fullmatch(r'Block (\S+)-(\S+)', v)] if m]
+	parents = {}
+	for code in codes:
+		if code.startswith('Block ') or code.startswith('Chapter '):
+			continue
+		parent = next((code[:k] for k in range(len(code) - 1, 0, -1) if code[:k] in codes), None)
+		if parent is None:
+			# The innermost block, if they are nested
+			in_blocks = sorted([(lo, b) for b, lo, hi in blocks if lo <= code[:len(lo)] <= hi[:len(lo)]], reverse=True)
+			parent = in_blocks[0][1] if in_blocks else None
+		if parent is not None:
+			parents[code] = parent
+	return parents
+
+
+# Read codes are five characters, padded with '.' below the top of the tree, so the parent of XE0Gu is XE0G. and the
+# parent of 229.. is 22...
+def read_code_parent(code):
+	stripped = code.rstrip('.')
+	if len(stripped) <= 1:
+		return None
+	return stripped[:-1].ljust(len(code), '.')
+
+
+# Rows of the closure table from a child -> parent map: every (ancestor, descendant) pair, including each code with
+# itself, so looking up the descendants of a code also matches the code
+def closure_pairs(parents, codes=()):
+	pairs = set()
+	for code in set(codes) | set(parents) | set(parents.values()):
+		ancestor = code
+		while ancestor is not None and (ancestor, code) not in pairs:
+			pairs.add((ancestor, code))
+			ancestor = parents.get(ancestor)
+	return pairs
+
+
+# The distinct values a field has in the database
+def distinct_values(con, field, field_desc):
+	field_desc = as_field_metadata(field_desc)
+	if field_desc.tab.get(field) == 'gp_clinical':
+		query = f"SELECT DISTINCT {field} FROM gp_clinical WHERE {field} IS NOT NULL"
+	elif field_desc.compact:
+		query = (f"SELECT DISTINCT str_values.value FROM str JOIN str_values ON str_values.id=str.value "
+				 f"WHERE field={field_id(field, field_desc)}")
+	else:
+		query = f"SELECT DISTINCT value FROM {field_desc.tab[field]} WHERE field='{field}'"
+	return [x[0] for x in con.execute(query).fetchall()]
+
+
+def create_code_closure(con, showcase_file: str, codings_file: str):
+	"""(Re)creates the code_closure table, which holds every (ancestor, descendant) pair of codes of the fields using
+	a tree coding (prefix_codings) and of the read_2 and read_3 codes in the database. ('descendants', code) criteria
+	are looked up there.
+
+	Keyword arguments:
+	------------------
+	con: sqlite3.Connection
+		connection to the database
+	showcase_file: str
+		path and filename of showcase file, giving the coding of each field
+	codings_file: str
+		path and filename of codings file
+
+	Returns:
+	--------
+	n_pairs: int
+		number of rows in code_closure
+	"""
+	print('Creating code closure table')
+	field_desc = as_field_metadata(pd.read_sql('SELECT * from field_desc', con))
+	showcase = pd.read_csv(showcase_file, dtype=str)
+	codings = pd.read_csv(codings_file, dtype=str)
+	field_coding = dict(zip(showcase['FieldID'], showcase['Coding']))
+	rows = []
+	for field in field_desc.tab:
+		coding = field_coding.get(field)
+		if coding in prefix_codings:
+			parents = coding_parents(codings[codings['Coding'] == coding]['Value'].dropna())
+			rows += [(field, a, d) for a, d in closure_pairs(parents)]
+	for field in ['read_2', 'read_3']:
+		if field in field_desc.tab:
+			codes = distinct_values(con, field, field_desc)
+			parents = {}
+			for code in codes:
+				while read_code_parent(code) is not None:
+					parents[code] = read_code_parent(code)
+					code = parents[code]
+			rows += [(field, a, d) for a, d in closure_pairs(parents, codes)]
+	con.execute('DROP TABLE IF EXISTS code_closure')
+	con.execute('CREATE TABLE code_closure (field VARCHAR, ancestor VARCHAR, descendant VARCHAR, '
+				'PRIMARY KEY (field, ancestor, descendant)) WITHOUT ROWID')
+	con.executemany('INSERT INTO code_closure VALUES (?,?,?)', rows)
+	return len(rows)
+
+
+# Participant counts for the query planner and the keyword search. They are built with a new database; a refresh drops
+# them and a purge leaves them as upper bounds, unless either is asked to rebuild them with stats=True.
+# field_stats has a row per field and instance, and one with instance -1 for all instances together, holding the
+# number of participants with a value and of distinct values, and for numeric fields the min, quartiles and max.
+# value_stats holds the number of participants with each value of the str and int fields and of the read codes.
+all_instances = -1
+stats_quantiles = {'min_value': 0, 'q25': 0.25, 'median': 0.5, 'q75': 0.75, 'max_value': 1}
+
+def create_stats_tables(con):
+	"""(Re)creates the field_stats and value_stats tables, then runs ANALYZE so SQLite has statistics of its
+	indexes too
+
+	Keyword arguments:
+	------------------
+	con: sqlite3.Connection
+		connection to the database
+
+	Returns:
+	--------
+	n_rows: (int, int)
+		number of rows in field_stats and value_stats
+	"""
+	print('Creating field and value statistics')
+	field_desc = as_field_metadata(pd.read_sql('SELECT * from field_desc', con))
+	names = {v: k for k, v in field_desc.field_id.items()} if field_desc.compact else None
+	name = lambda f: names.get(f, str(f)) if names is not None else str(f)
+	read_fields = [f for f in ['read_2', 'read_3'] if f in field_desc.tab]
+	field_rows, value_rows = [], []
+	for tab_name in ['str', 'int', 'real', 'datetime']:
+		# Read codes' times are event dates, not instances
+		not_read = ' and '.join(f"field<>{field_id(f, field_desc) if field_desc.compact else quote_text(f)}"
+								 for f in read_fields if field_desc.tab[f] == tab_name) or '1'
+		counts = con.execute(f'SELECT field, {all_instances}, count(distinct eid), count(distinct value) FROM {tab_name} '
+							 f'GROUP BY field').fetchall()
+		counts += con.execute(f'SELECT field, time, count(distinct eid), count(distinct value) FROM {tab_name} '
+							  f'WHERE {not_read} GROUP BY field, time').fetchall()
+		for field, instance, n_eids, n_values in counts:
+			quantiles = [None] * len(stats_quantiles)
+			if tab_name != 'str' and instance == all_instances:
+				quantiles = field_quantiles(con, tab_name, field)
+			field_rows.append((name(field), instance, n_eids, n_values, *quantiles))
+		if tab_name == 'str' and field_desc.compact:
+			value_rows += con.execute('SELECT field, str_values.value, count(distinct eid) FROM str JOIN str_values '
+									  'ON str_values.id=str.value GROUP BY field, str.value').fetchall()
+		elif tab_name in ['str', 'int']:
+			value_rows += con.execute(f'SELECT field, value, count(distinct eid) FROM {tab_name} '
+									  f'GROUP BY field, value').fetchall()
+	for field in read_fields:
+		if field_desc.tab[field] == 'gp_clinical':
+			n_eids, n_values = con.execute(f'SELECT count(distinct eid), count(distinct {field}) FROM gp_clinical '
+										   f'WHERE {field} IS NOT NULL').fetchone()
+			field_rows.append((field, all_instances, n_eids, n_values) + (None,) * len(stats_quantiles))
+			value_rows += con.execute(f"SELECT '{field}', {field}, count(distinct eid) FROM gp_clinical "
+									  f"WHERE {field} IS NOT NULL GROUP BY {field}").fetchall()
+	con.execute('DROP TABLE IF EXISTS field_stats')
+	con.execute(f'CREATE TABLE field_stats (field VARCHAR, instance INTEGER, n_eids INTEGER, n_values INTEGER, '
+				f'{", ".join(q + " REAL" for q in stats_quantiles)}, PRIMARY KEY (field, instance)) WITHOUT ROWID')
+	con.executemany(f'INSERT INTO field_stats VALUES ({",".join("?" * (4 + len(stats_quantiles)))})', field_rows)
+	# value keeps the type of the table it comes from, so int values compare as numbers and str values as text
+	con.execute('DROP TABLE IF EXISTS value_stats')
+	con.execute('CREATE TABLE value_stats (field VARCHAR, value, n_eids INTEGER, PRIMARY KEY (field, value)) '
+				'WITHOUT ROWID')
+	con.executemany('INSERT INTO value_stats VALUES (?,?,?)', [(name(f), v, n) for f, v, n in value_rows])
+	# Sample the indexes rather than reading them whole
+	con.execute('PRAGMA analysis_limit=1000')
+	con.execute('ANALYZE')
+	return len(field_rows), len(value_rows)
+
+
+def drop_stats_tables(con):
+	con.execute('DROP TABLE IF EXISTS field_stats')
+	con.execute('DROP TABLE IF EXISTS value_stats')
+
+
+# Min, quartiles and max of a numeric field's values. The count, min and max come from one pass over the field's
+# entries in its (field, value) index; each quartile is then read by skipping that many entries along it with OFFSET,
+# which SQLite does one entry at a time, so this costs about 2.5 reads of the field's entries
+def field_quantiles(con, tab_name, field):
+	n, min_value, max_value = con.execute(f'SELECT count(*), min(value), max(value) FROM {tab_name} WHERE field=?',
+										  (field,)).fetchone()
+	quartiles = [con.execute(f'SELECT value FROM {tab_name} WHERE field=? ORDER BY value LIMIT 1 OFFSET ?',
+							 (field, int(q * (n - 1)))).fetchone()[0] for q in list(stats_quantiles.values())[1:-1]]
+	return [min_value] + quartiles + [max_value]
+
+# Pragmas used while building. 'bulk' gives up crash safety for insert speed, which is fine for a first build since
+# it is all-or-nothing anyway. Whatever profile is used to load, the database is switched back to 'safe' at the end.
+build_profiles = {
+	'safe': {'locking_mode': 'NORMAL', 'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000,
+			 'temp_store': 'DEFAULT'},
+	'bulk': {'locking_mode': 'EXCLUSIVE', 'journal_mode': 'OFF', 'synchronous': 'OFF', 'cache_size': -1024**2,
+			 'temp_store': 'MEMORY'},
+	# As fast as it can be while still able to roll back to the last checkpoint if the build is killed
+	'resumable': {'locking_mode': 'EXCLUSIVE', 'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+				  'cache_size': -1024**2, 'temp_store': 'MEMORY'}
+}
+
+def set_build_profile(con, profile):
+	if profile not in build_profiles:
+		raise ValueError(f"Unknown build profile {profile}, expected one of {', '.join(build_profiles)}")
+	for pragma, value in build_profiles[profile].items():
+		con.execute(f'PRAGMA {pragma}={value}')
+	# Dropping an exclusive lock only happens on the next access to the database
+	con.execute('SELECT count(*) FROM sqlite_master').fetchall()
+
 
 # Get estimate of number of lines in a file. If file is <10MB, get exact, otherwise estimate based
 # on the number of lines in the first 10MB and add 10%
@@ -148,6 +584,110 @@ def estimate_line_count(filename):
 		nlines = 1.1* os.path.getsize(filename) // nlines_est
 	return nlines
 
+# Read a delimited file in blocks of `step` data lines starting at byte `offset` (0 for the first data line). Each
+# block is returned with the header line prepended so it can be parsed on its own, along with the byte offset of the
+# end of the block. Quoted fields which run over a line break are kept in the same block.
+def read_offset_blocks(filename, step, offset=0, encoding="ISO-8859-1"):
+	with open(filename, 'rb') as f:
+		header = f.readline()
+		if offset:
+			f.seek(offset)
+		block = []
+		record = b''
+		for line in f:
+			record += line
+			if record.count(b'"') % 2:
+				continue
+			block.append(record)
+			record = b''
+			if len(block) == step:
+				yield f.tell(), (header + b''.join(block)).decode(encoding)
+				block = []
+		if record:
+			block.append(record)
+		if block:
+			yield f.tell(), (header + b''.join(block)).decode(encoding)
+
+
+# Read a delimited file in blocks of `step` data lines, see read_offset_blocks
+def read_line_blocks(filename, step, encoding="ISO-8859-1"):
+	for _, block in read_offset_blocks(filename, step, encoding=encoding):
+		yield block
+
+
+# State shared by the worker processes of a parallel build, set once per worker by the pool initializer
+_worker_state = {}
+
+def _init_main_worker(tabs, tab_fields, column_map, dtypes_dict, date_cols):
+	_worker_state.update(tabs=tabs, tab_fields=tab_fields, column_map=column_map, dtypes_dict=dtypes_dict,
+						 date_cols=date_cols)
+
+
+# Parse a block of the main file and convert it into one (tab_name, insert) per table
+def _parse_main_block(block):
+	chunk = pd.read_csv(StringIO(block), low_memory=False, dtype=_worker_state['dtypes_dict'],
+						parse_dates=_worker_state['date_cols'])
+	return [(tab_name, insert_main_chunk(chunk, tab_name, _worker_state['tab_fields'][tab_name],
+										 _worker_state['column_map']))
+			for tab_name in _worker_state['tabs']] + [('participants', insert_participants_chunk(chunk))]
+
+
+# Parse blocks from read_offset_blocks in a pool of worker processes, yielding (offset, result) in file order.
+# At most 2*workers blocks are in flight.
+def parse_blocks_parallel(blocks, parse, workers, initializer, initargs):
+	pending = collections.deque()
+	with multiprocessing.Pool(processes=workers, initializer=initializer, initargs=initargs) as pool:
+		for offset, block in blocks:
+			pending.append((offset, pool.apply_async(parse, (block,))))
+			if len(pending) >= 2 * workers:
+				offset, result = pending.popleft()
+				yield offset, result.get()
+		while pending:
+			offset, result = pending.popleft()
+			yield offset, result.get()
+
+
+# The build_checkpoint table records, for each source file, how many chunks have been committed and the byte offset
+# they run up to, so an interrupted build can carry on from there
+def create_checkpoint_table(con):
+	con.execute('DROP TABLE IF EXISTS build_checkpoint')
+	con.execute('CREATE TABLE build_checkpoint (source VARCHAR PRIMARY KEY, chunk INTEGER, byte_offset INTEGER, '
+				'done INTEGER)')
+
+
+def read_checkpoints(con):
+	if not con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='build_checkpoint'").fetchone():
+		return {}
+	rows = con.execute('SELECT source, chunk, byte_offset, done FROM build_checkpoint').fetchall()
+	return {source: {'chunk': chunk, 'byte_offset': byte_offset, 'done': bool(done)}
+			for source, chunk, byte_offset, done in rows}
+
+
+def write_checkpoint(con, source, chunk, byte_offset, done=False):
+	con.execute('INSERT OR REPLACE INTO build_checkpoint values(?,?,?,?)', (source, chunk, byte_offset, int(done)))
+
+
+# Write parsed chunks of a source file. Each result is a list of (tab_name, (query, rows)) inserts. Every
+# `commit_every` chunks the checkpoint for the source is updated and committed along with the rows, and the source is
+# marked done at the end. Without commit_every no checkpoints are written. Returns the number of rows inserted.
+def insert_parsed_chunks(con, source, parsed, checkpoint, commit_every=None, bar=None, value_ids=None,
+						 clustered=False, refresh_key=None):
+	n_rows = 0
+	chunk, byte_offset = checkpoint['chunk'], checkpoint['byte_offset']
+	for byte_offset, result in parsed:
+		for tab_name, (query, rows) in result:
+			n_rows += write_chunk(con, tab_name, query, rows, value_ids, clustered, refresh_key)
+		chunk += 1
+		if commit_every and chunk % commit_every == 0:
+			write_checkpoint(con, source, chunk, byte_offset)
+			con.commit()
+		if bar:
+			bar.update(chunk)
+	if commit_every:
+		write_checkpoint(con, source, chunk, byte_offset, done=True)
+	return n_rows
+
+
 # Add columns to field_desc indicate which table each field goes into
 def add_tabs_to_field_desc(field_desc, tab_fields):
 	field_tab_map = {item: k for k, v in tab_fields.items() for item in v}#.to_list()}
@@ -156,9 +696,33 @@ def add_tabs_to_field_desc(field_desc, tab_fields):
 	return field_desc
 
 
+# Add the columns of a new basket which the database doesn't have yet to its field_desc, both in the database and the
+# returned copy. New fields get the next free field ids in the compact schema.
+def update_field_desc(con, basket_field_desc, tab_fields):
+	field_desc = pd.read_sql('SELECT * from field_desc', con)
+	new_fields = basket_field_desc[~basket_field_desc['field_col'].isin(field_desc['field_col'])].copy()
+	if new_fields.empty:
+		return field_desc
+	print(f'Adding {len(new_fields)} new columns to field_desc')
+	new_fields = add_tabs_to_field_desc(new_fields, tab_fields)
+	if is_compact(field_desc):
+		field_ids = dict(zip(field_desc['field'], field_desc['field_id']))
+		for f in new_fields['field'].unique():
+			if f not in field_ids:
+				field_ids[f] = max(field_ids.values()) + 1
+		new_fields['field_id'] = list(map(field_ids.get, new_fields['field']))
+	new_fields = new_fields[field_desc.columns]
+	new_fields.to_sql("field_desc", con, if_exists='append', index=False)
+	return pd.concat([field_desc, new_fields], ignore_index=True)
+
+
 # TODO: do more checks on whether the files exist
 def create_sqlite_db(db_filename: str, main_filename: str, gp_clin_filename: str,
-					 showcase_file: str, step: int = 5000, append=False) -> sqlite3.Connection:
+					 showcase_file: str, step: int = 5000, append=False, workers: int = 1,
+					 profile: str = 'safe', compact: bool = False, clustered: bool = False,
+					 commit_every: int = None, resume: bool = False, gp_table: bool = False,
+					 codings_file: str = None, withdrawn_eids: list = None,
+					 eid_index: bool = False, stats: bool = None) -> sqlite3.Connection:
 	"""Creates an sql database
 
 	Keyword arguments:
@@ -173,6 +737,52 @@ def create_sqlite_db(db_filename: str, main_filename: str, gp_clin_filename: str
 		path and filename of showcase file
 	step: int
 		number of lines to read in at a time from main file.
+	append: bool
+		refresh an existing database with a new basket. Columns which aren't in the database's field_desc are added
+		to it. A value already held for the same (eid, field, instance, array) is replaced if it differs and left
+		alone otherwise, and gp_clinical records already in the database are skipped. Participants' existing rows
+		are found through an eid index, which is created the first time a database is refreshed.
+	workers: int
+		number of processes used to parse the main file. With more than one worker, chunks are parsed in
+		parallel and written by this process.
+	profile: str
+		pragmas to load the data with, one of `build_profiles`. 'bulk' turns off journaling and syncing and loads
+		everything, indexes included, in a single transaction. The database is switched back to 'safe' settings
+		before it is returned.
+	compact: bool
+		use the compact schema: fields are stored as integer ids from field_desc and str values as ids into the
+		str_values table. Queries work out which schema a database has from its field_desc. When appending, the
+		schema of the existing database is used.
+	clustered: bool
+		create the value tables WITHOUT ROWID, clustered on (field, value, time, eid, array). Every cohort lookup is
+		then answered from the table itself and no separate indexes are built. Can be combined with compact. When
+		appending, the layout of the existing database is used.
+	commit_every: int
+		commit every `commit_every` chunks, recording in the build_checkpoint table how far through the main and
+		gp_clinical files the build has got. If not given the data is committed once it has all been inserted. The
+		bulk profile can't roll back to a checkpoint, so use 'resumable' with it. The build_checkpoint table is
+		dropped once the build has finished.
+	resume: bool
+		carry on an interrupted build from its last checkpoint, skipping straight to that point in each file. The
+		other arguments should be the same as for the interrupted build. If the database has no checkpoint the
+		build starts from the beginning.
+	gp_table: bool
+		put the gp_clinical records in their own gp_clinical table, with event dates as day numbers and indexes on
+		each code type and date, rather than in the str table. read_2 and read_3 criteria are looked up there. When
+		appending, the layout of the existing database is used.
+	codings_file: str
+		path and filename of codings file. If given, the code_closure table of ICD and Read code hierarchies is
+		(re)built after loading, so criteria can ask for a code and all its descendants.
+	withdrawn_eids: list
+		EIDs of participants to flag as withdrawn in the participants table
+	eid_index: bool
+		also index the value tables by participant, with covering indexes on (eid, field, time, array, value), so
+		extract_participants reads only the rows of the participants asked for. A refresh creates them anyway.
+	stats: bool
+		(re)build the field_stats and value_stats tables, which order and short-circuit cohort queries, and ANALYZE
+		the database. This reads the whole database, so by default it is only done for a new database. A refresh
+		without it drops the stats tables, as the new data would make their counts wrong; call create_stats_tables
+		or refresh with stats=True to have them back.
 
 	Returns:
 	--------
@@ -180,75 +790,282 @@ def create_sqlite_db(db_filename: str, main_filename: str, gp_clin_filename: str
 		Connection to the written database
 
 	"""
+	connection.check_writable(db_filename)
+	# Rolling back to the last checkpoint needs a journal, which the bulk profile doesn't keep
+	if commit_every and profile == 'bulk':
+		raise ValueError("The bulk profile can't roll back to a checkpoint. Use the resumable profile with "
+						 "commit_every, or leave commit_every out")
 	main_df = pd.read_csv(main_filename, nrows=1)
 	field_desc = create_field_desc(main_df, showcase_file)
 
 	# Connect to db
 	con = sqlite3.connect(database=db_filename)
+	checkpoints = read_checkpoints(con) if resume else {}
+	if resume and not checkpoints:
+		print('UKBCC database - no checkpoint to resume from, starting from the beginning')
+	set_build_profile(con, profile)
 	tabs = dict(zip(['str', 'int', 'real', 'datetime'], ["VARCHAR", "INTEGER", "REAL", "REAL"]))
 	tab_fields = create_tab_fields_map(tabs, field_desc)
 	#Create queries to drop and create tables.
-	if(not append):
+	if(not append and not checkpoints):
 		print ("Create tables")
-		x=con.executescript("".join(create_table_queries(tabs)))
+		x=con.executescript("".join(create_table_queries(tabs, compact, clustered)))
+		con.execute("DROP TABLE IF EXISTS gp_clinical;")
+		con.execute("DROP TABLE IF EXISTS participants;")
+		if gp_table:
+			con.execute(create_gp_clinical_table_query())
 
 		# Add columns to field_desc indicate which table each field goes into
 		# Then write fields to a table in the database
 		field_desc = add_tabs_to_field_desc(field_desc, tab_fields)
+		if compact:
+			field_desc = add_field_ids_to_field_desc(field_desc)
+		if gp_table:
+			field_desc.loc[field_desc['field'].isin(['read_2', 'read_3']), 'tab'] = 'gp_clinical'
 		field_desc.to_sql("field_desc", con, if_exists='replace', index=False)
 	else:
-		field_desc = pd.read_sql('SELECT * from field_desc', con)
+		field_desc = update_field_desc(con, field_desc, tab_fields)
+		compact = is_compact(field_desc)
+		clustered = is_clustered(con)
+		gp_table = has_gp_clinical_table(field_desc)
+		# Fields already in the database stay in the table they were put in
+		tab_fields = {tab_name: field_desc[field_desc['tab'] == tab_name]['field_col'].tolist() for tab_name in tabs}
+
+	# With the compact schema, fields are written as their ids and str values are interned as we go
+	field_ids, value_ids = None, None
+	if compact:
+		field_ids = dict(zip(field_desc['field'], field_desc['field_id'].astype(int)))
+		value_ids = dict(con.execute('SELECT value, id from str_values').fetchall())
+	column_map = create_column_map(tab_fields, main_df.columns, field_ids)
 
 	# Create list of dates, dictionary of all column types and a boolean vector of where 'eid' sits
 	date_cols = field_desc['field_col'][
-		(field_desc['ukb_type'] == 'Date') | (field_desc['ukb_type'] == 'Time')].to_list()
+		((field_desc['ukb_type'] == 'Date') | (field_desc['ukb_type'] == 'Time')) &
+		field_desc['field_col'].isin(main_df.columns)].to_list()
 	dtypes_dict = dict(zip(field_desc['field_col'].to_list(), field_desc['pd_type'].to_list()))
 
 	pb_widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.ETA(), ]
-	# GP clinical data
-	if gp_clin_filename:
-		print ("Insert GP data")
-		max_pb = int(estimate_line_count(gp_clin_filename) / step) + 1
-		reader = pd.read_csv(gp_clin_filename, chunksize=step, low_memory=False, encoding="ISO-8859-1", delimiter='\t')
-		with progressbar.ProgressBar(widgets=pb_widgets, max_value=max_pb)	as bar:
-			for i, chunk in enumerate(reader):
-				x = con.executemany(*insert_gp_clin_chunk(chunk))
-				bar.update(i)
-
-	# TODO: This is slow. We can parallelise this using Queue
-	# TODO: Repeats the specific code above, except insert call and delimiter
-	lines = estimate_line_count(main_filename)
-	print ("Insert main data from {}.\n Est lines={}".format(main_filename, lines))
-	max_pb = int(lines/ step)+ 1
-	reader = pd.read_csv(main_filename, chunksize=step, low_memory=False, encoding="ISO-8859-1",
-						 dtype=dtypes_dict, parse_dates=date_cols)
-	with progressbar.ProgressBar(widgets=pb_widgets, max_value=max_pb) as bar:
-		for i, chunk in enumerate(reader):
-			for tab_name, field_type in tabs.items():
-				x = con.executemany(*insert_main_chunk(chunk, tab_name, tab_fields[tab_name]))
-			bar.update(i)
-	#
-	con.commit()
-	print('UKBCC database - finished populating')
-
-	if (not append):
-		create_index(con)
+	n_rows = 0
+	start_time = time.time()
+	if not con.in_transaction:
+		con.execute('BEGIN')
+	if commit_every and not checkpoints:
+		create_checkpoint_table(con)
+	no_checkpoint = {'chunk': 0, 'byte_offset': 0, 'done': False}
+	# Appending refreshes the data already there, finding each participant's rows through the eid index
+	main_key, gp_key = (main_refresh_key, gp_clinical_cols if gp_table else gp_refresh_key) if append else (None, None)
+	try:
+		if append:
+			create_eid_index(con)
+		create_participants_table(con)
+		# GP clinical data
+		gp_checkpoint = checkpoints.get('gp_clinical', no_checkpoint)
+		if gp_clin_filename and gp_checkpoint['done']:
+			print("GP data already inserted")
+		elif gp_clin_filename:
+			print ("Insert GP data")
+			max_pb = int(estimate_line_count(gp_clin_filename) / step) + 1
+			def parse_gp_block(block):
+				chunk = pd.read_csv(StringIO(block), low_memory=False, delimiter='\t', dtype=gp_clinical_dtypes)
+				if gp_table:
+					return [('gp_clinical', insert_gp_clinical_table_chunk(chunk))]
+				return [('str', insert_gp_clin_chunk(chunk, field_ids, clustered))]
+			parsed = ((offset, parse_gp_block(block))
+					  for offset, block in read_offset_blocks(gp_clin_filename, step, gp_checkpoint['byte_offset']))
+			with progressbar.ProgressBar(widgets=pb_widgets, max_value=max_pb)	as bar:
+				n_rows += insert_parsed_chunks(con, 'gp_clinical', parsed, gp_checkpoint, commit_every, bar, value_ids,
+											   clustered, gp_key)
+
+		main_checkpoint = checkpoints.get('main', no_checkpoint)
+		if main_checkpoint['done']:
+			print("Main data already inserted")
+		else:
+			lines = estimate_line_count(main_filename)
+			print ("Insert main data from {}.\n Est lines={}".format(main_filename, lines))
+			max_pb = int(lines/ step)+ 1
+			blocks = read_offset_blocks(main_filename, step, main_checkpoint['byte_offset'])
+			worker_args = (list(tabs), tab_fields, column_map, dtypes_dict, date_cols)
+			if workers > 1:
+				parsed = parse_blocks_parallel(blocks, _parse_main_block, workers, _init_main_worker, worker_args)
+			else:
+				_init_main_worker(*worker_args)
+				parsed = ((offset, _parse_main_block(block)) for offset, block in blocks)
+			with progressbar.ProgressBar(widgets=pb_widgets, max_value=max_pb) as bar:
+				n_rows += insert_parsed_chunks(con, 'main', parsed, main_checkpoint, commit_every, bar, value_ids,
+											   clustered, main_key)
+		elapsed = time.time() - start_time
+		print(f'UKBCC database - finished populating: {n_rows} rows in {elapsed:.1f}s '
+			  f'({n_rows / max(elapsed, 1e-9):.0f} rows/sec, {profile} profile)')
+
+		# With the bulk profile the indexes are built inside the load transaction, so the first build commits once
+		if profile != 'bulk':
+			con.commit()
+		if (not append) and (not clustered):
+			create_index(con)
+		if (not append) and gp_table:
+			create_gp_clinical_index(con)
+		if (not append) and eid_index:
+			create_eid_index(con)
+		if codings_file:
+			create_code_closure(con, showcase_file, codings_file)
+		if withdrawn_eids is not None:
+			print(f'Flagged {mark_withdrawn(con, withdrawn_eids)} withdrawn participants')
+		if stats is None:
+			stats = not append
+		if stats:
+			create_stats_tables(con)
+		elif append:
+			drop_stats_tables(con)
+		# A finished build has nothing to resume
+		con.execute('DROP TABLE IF EXISTS build_checkpoint')
+		set_build_id(con)
+		con.commit()
+	except BaseException:
+		# Leave the database as it was at the last checkpoint
+		con.rollback()
+		con.close()
+		raise
+	set_build_profile(con, 'safe')
 	print('UKBCC database - finished')
 
 	return (con)
 
 
+def purge_eids(db_filename: str, eids: list, stats: bool = False, keep_eid_index: bool = False) -> dict:
+	"""Remove participants from the database, e.g. those who have withdrawn
+
+	Keyword arguments:
+	------------------
+	db_filename: str
+		path and filename of db to purge
+	eids: list
+		EIDs of the participants to remove
+	stats: bool
+		rebuild the stats tables, which reads the whole database. Otherwise their counts still include the removed
+		participants, so are upper bounds, which is all ordering cohort queries needs.
+	keep_eid_index: bool
+		keep the covering eid indexes the deletes go through. They take about as much space as the value tables,
+		so unless the database already had them (see create_sqlite_db's eid_index) they are dropped again
+		afterwards. Keeping them makes later purges and extract_participants fast.
+
+	Returns:
+	--------
+	deleted: dict
+		number of rows deleted from each table with an eid column
+
+	"""
+	connection.check_writable(db_filename)
+	con = sqlite3.connect(database=db_filename)
+	# Deletes go through eid indexes, joining against the eids in a temp table
+	had_eid_index = has_eid_index(con)
+	create_eid_index(con)
+	con.execute('CREATE TEMP TABLE purge_eids (eid INTEGER PRIMARY KEY)')
+	con.executemany('INSERT OR IGNORE INTO temp.purge_eids values(?)', [(int(e),) for e in eids])
+	tabs = [x[0] for x in con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+			if 'eid' in [c[1] for c in con.execute(f'PRAGMA table_info({x[0]})').fetchall()]]
+	deleted = {}
+	for tab_name in tabs:
+		deleted[tab_name] = con.execute(f'DELETE FROM {tab_name} WHERE eid IN (SELECT eid FROM temp.purge_eids)').rowcount
+		print(f'Deleted {deleted[tab_name]} rows from {tab_name}')
+	if not (had_eid_index or keep_eid_index):
+		drop_eid_index(con)
+	if stats:
+		create_stats_tables(con)
+	set_build_id(con)
+	con.commit()
+	con.execute('DROP TABLE temp.purge_eids')
+	con.close()
+	return deleted
+
+
+
+
+
+
+# The field_desc lookups needed to compile queries, built once so that each criterion or column is a dictionary lookup
+# rather than a scan of field_desc. A field with several columns takes its type, table and id from its first row.
+# The query helpers below take either a field_desc DataFrame or one of these.
+class FieldMetadata:
+	def __init__(self, field_desc, participants=False):
+		self.field_desc = field_desc
+		self.compact = 'field_id' in field_desc.columns
+		# Whether the database has a participants table
+		self.participants = participants
+		self.columns = {}
+		self.sql_type = {}
+		self.tab = {}
+		self.field_id = {}
+		field_ids = field_desc['field_id'] if self.compact else [None] * len(field_desc)
+		for field, field_col, sql_type, tab, fid in zip(field_desc['field'], field_desc['field_col'],
+														field_desc['sql_type'], field_desc['tab'], field_ids):
+			self.columns.setdefault(field, []).append(re.split(r'[-.]', field_col))
+			if field not in self.tab:
+				self.sql_type[field] = sql_type
+				self.tab[field] = tab
+				self.field_id[field] = None if pd.isna(fid) else int(fid)
+		self.tabs = [t for t in field_desc['tab'].iloc[1:].unique()]
+
+
+def as_field_metadata(field_desc):
+	if isinstance(field_desc, FieldMetadata):
+		return field_desc
+	return FieldMetadata(field_desc)
+
+
+def has_participants_table(con):
+	return con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='participants'").fetchone() is not None
+
+
+# Modification time and size of a database file and its write-ahead log, which change whenever the database does
+def db_file_stamp(db_filename):
+	# A file served immutable isn't looked at again, as every stat is a round trip on a network filesystem
+	stamp = connection.immutable_stamp(db_filename)
+	if stamp is not None:
+		return stamp
+	stamp = ()
+	for filename in [db_filename, db_filename + '-wal']:
+		if os.path.exists(filename):
+			stat = os.stat(filename)
+			stamp += (stat.st_mtime_ns, stat.st_size)
+	return stamp
 
 
+# FieldMetadata of each database file, with the stamp of the file it was read from
+_field_metadata_cache = {}
+
+def load_field_metadata(con):
+	"""Get the FieldMetadata of a database, reading its field_desc only the first time and whenever the database file
+	has changed since. In-memory databases, other than copies of a file, are read every time.
+
+	Keyword arguments:
+	------------------
+	con: sqlite3.Connection
+		connection to the database
+
+	Returns:
+	--------
+	field_desc: FieldMetadata
+	"""
+	# In-memory copies made by connection.load_into_memory are cached under the file they were copied from
+	db_filename = getattr(con, 'source_filename', None) or con.execute('PRAGMA database_list').fetchone()[2]
+	read = lambda: FieldMetadata(pd.read_sql('SELECT * from field_desc', con), participants=has_participants_table(con))
+	if not db_filename:
+		return read()
+	stamp = getattr(con, 'source_stamp', None) or db_file_stamp(db_filename)
+	cached = _field_metadata_cache.get(db_filename)
+	if cached is None or cached[0] != stamp:
+		cached = (stamp, read())
+		_field_metadata_cache[db_filename] = cached
+	return cached[1]
 
 
 #Are we looking at varchat?
 def is_varchar(x,field_desc):
-	field_in_field_desc =  any (field_desc['field'] == re.sub('^f', '', x) )
-	#print("field_in_field_desc: {}".format(field_in_field_desc))
-	if not field_in_field_desc:
-		raise ValueError(f"{re.sub('^f', '', x)} not in field_desc['field']")
-	return field_desc[field_desc['field'] == re.sub('^f', '', x)]['sql_type'].iloc[0] == 'VARCHAR'
+	field_desc = as_field_metadata(field_desc)
+	field = re.sub('^f', '', x)
+	if field not in field_desc.sql_type:
+		raise ValueError(f"{field} not in field_desc['field']")
+	return field_desc.sql_type[field] == 'VARCHAR'
 
 #If varchar, need to quote, otherwise don't quote
 def quote_char(x,field_desc):
@@ -265,17 +1082,80 @@ def prepare_value(qt,field_desc) :
 	return  '={}{}{}'.format(quote, qt['val'], quote)
 
 
+# Range and prefix criteria have a tuple (or list) value instead of a single value: ('between', low, high), ('>=', x),
+# ('>', x), ('<', x), ('<=', x) or ('prefix', p). Bounds are inclusive for between. Dates can be given as date strings.
+# ('descendants', code) matches a code and everything below it in the code_closure table made by create_code_closure.
+range_operators = ['between', '>=', '>', '<', '<=', 'prefix', 'descendants']
+
+def is_range(val):
+	return isinstance(val, (tuple, list))
+
+
+def quote_text(x):
+	return "'{}'".format(str(x).replace("'", "''"))
+
+
+# A bound of a range criterion in SQL. str values are quoted, anything else has to be a number, apart from dates,
+# which are compared as the nanoseconds since 1970 stored in the datetime table.
+def range_bound(x, qt, field_desc):
+	if is_varchar(qt['field'], field_desc):
+		return quote_text(x)
+	try:
+		float(x)
+	except (TypeError, ValueError):
+		if qt.get('tab') != 'datetime':
+			raise ValueError(f"{x} is not a number, for field {qt['field']}")
+		return str(pd.Timestamp(x).value)
+	return str(x)
+
+
+# Condition for a range or prefix criterion on a column. A prefix is the range from the prefix up to the next prefix
+# (E1 to E2), so like the other ranges it is a single range scan of an index on the value.
+def range_condition(column, qt, field_desc):
+	op, *bounds = qt['val']
+	if op not in range_operators or len(bounds) != (2 if op == 'between' else 1):
+		raise ValueError(f"{qt['val']} is not a range criterion, use one of {range_operators}")
+	if op == 'between':
+		return f"{column} between {range_bound(bounds[0], qt, field_desc)} and {range_bound(bounds[1], qt, field_desc)}"
+	if op == 'descendants':
+		return (f"{column} in (select descendant from code_closure where field='{qt['field']}' and "
+				f"ancestor={quote_text(bounds[0])})")
+	if op == 'prefix':
+		prefix = str(bounds[0])
+		if not prefix or not is_varchar(qt['field'], field_desc):
+			raise ValueError(f"prefix criteria need a prefix and a text field, not {qt['field']}")
+		upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+		return f"{column} >= {range_bound(prefix, qt, field_desc)} and {column} < {range_bound(upper, qt, field_desc)}"
+	return f"{column} {op} {range_bound(bounds[0], qt, field_desc)}"
+
+
+# Condition for any criterion on a column: a value, 'nan' (not null), or a range
+def value_condition(column, qt, field_desc):
+	if is_range(qt['val']):
+		return range_condition(column, qt, field_desc)
+	return f"{column} {prepare_value(qt, field_desc)}"
+
+
+# Name for a criterion value in a column name, e.g. prefix_E11 for ('prefix', 'E11')
+def criterion_label(val):
+	if is_range(val):
+		return "_".join([str(x) for x in val])
+	return val
+
+
 def field_value_query_template(f,v,f_ex, field_desc, null=False):
-	val_str=prepare_value({'field': f, 'val': v if null==False else 'nan'}, field_desc)
+	field_desc = as_field_metadata(field_desc)
+	qt = {'field': f, 'val': v if null==False else 'nan', 'tab': field_desc.tab.get(f)}
 	if len(f_ex) == 3:
-		return "'f{}-{}.{}' {}".format(f_ex[0], f_ex[1], f_ex[2], val_str)
+		return value_condition("'f{}-{}.{}'".format(f_ex[0], f_ex[1], f_ex[2]), qt, field_desc)
 	#print(f_ex)
-	return "'f{}-{}' {}".format(f_ex[0],v, val_str)
+	return value_condition("'f{}-{}'".format(f_ex[0], criterion_label(v)), qt, field_desc)
 
 # field_val_pairs: list of tuples from a cohort criteria, e.g. [('6070', "1"), ('6119', "1")]
 def join_field_vals(field_val_pairs, field_desc, operation):
 	if (not field_val_pairs):
 		return []
+	field_desc = as_field_metadata(field_desc)
 	assert operation in ['all_of', 'any_of', 'none_of']
 
 	if operation == 'none_of':
@@ -290,6 +1170,7 @@ def join_field_vals(field_val_pairs, field_desc, operation):
 
 def filter_pivoted_results(main_criteria, field_desc):
 	#NB: which fields do we one-hot-encode? Those with array values. Need to do some checks to see if this all types of fields.
+	field_desc = as_field_metadata(field_desc)
 	q = {}
 
 	q['all_of'] = " AND ".join(join_field_vals(main_criteria['all_of'], field_desc, 'all_of'))
@@ -299,43 +1180,260 @@ def filter_pivoted_results(main_criteria, field_desc):
 	selection_query = " AND ".join([qv for qk, qv in q.items() if main_criteria[qk]])
 	return re.sub("'", '"',selection_query)
 
+# Restrict a where condition to the eids in a temp table made by load_eids_table
+def restrict_to_eids(condition, eids_table=None):
+	if eids_table is None:
+		return condition
+	return f"({condition}) and eid in (select eid from temp.{eids_table})"
+
+
+# query_only also stops writes to temp tables, so lift it while they are written. A read-only (mode=ro) connection
+# still cannot write the database itself.
+@contextlib.contextmanager
+def temp_writes(con):
+	query_only = con.execute('PRAGMA query_only').fetchone()[0]
+	con.execute('PRAGMA query_only=OFF')
+	try:
+		yield con
+		con.commit()
+	finally:
+		con.execute(f'PRAGMA query_only={query_only}')
+
+
+# Load a list of eids into an indexed temp table, so queries can be restricted to them inside SQL
+def load_eids_table(con, eids, name='query_eids'):
+	with temp_writes(con):
+		con.execute(f'DROP TABLE IF EXISTS temp.{name}')
+		con.execute(f'CREATE TEMP TABLE {name} (eid INTEGER PRIMARY KEY)')
+		con.executemany(f'INSERT OR IGNORE INTO temp.{name} VALUES (?)', [(int(e),) for e in eids])
+	return name
+
+
+def drop_eids_table(con, name='query_eids'):
+	with temp_writes(con):
+		con.execute(f'DROP TABLE IF EXISTS temp.{name}')
+
+
+# Look up the id of a field in a compact schema field_desc
+def field_id(field, field_desc):
+	return as_field_metadata(field_desc).field_id[field]
+
+# tab_select for the compact schema. Fields are matched on their id. str values are swapped for their id to search the
+# index and swapped back in the results, so rows come out the same as they do from the original schema.
+def compact_tab_select(tab, query_tuples, field_desc, eids_table=None):
+	field_desc = as_field_metadata(field_desc)
+	def value_query(q):
+		if tab == 'str' and is_range(q['val']):
+			return "str.value in (select id from str_values where {})".format(value_condition('value', q, field_desc))
+		if tab == 'str' and q['val'] != 'nan':
+			return "str.value =(select id from str_values where value='{}')".format(q['val'])
+		return value_condition('str.value' if tab == 'str' else 'value', q, field_desc)
+
+	tab_selection = " or ".join(["field={} and {}".format(field_id(q['field'], field_desc), value_query(q)) for q in query_tuples])
+	tab_selection = restrict_to_eids(tab_selection, eids_table)
+	if tab == 'str':
+		return 'select eid, field, time, array, str_values.value as value from str join str_values on str_values.id=str.value where {}'.format(tab_selection)
+	return 'select * from {} where {}'.format(tab, tab_selection)
+
+# Condition on a code column of the gp_clinical table
+def gp_code_condition(code_type, code, field_desc=None):
+	if is_range(code):
+		return f"({range_condition(code_type, {'field': code_type, 'val': code, 'tab': 'gp_clinical'}, field_desc)})"
+	return f"{code_type} is not NULL" if code == 'nan' else f"{code_type}='{code}'"
+
+# tab_select for the gp_clinical table. Each code type is a column, looked up through its own index. Rows are given
+# in the same form as the value tables, with the event day number as time.
+def gp_clinical_select(query_tuples, field_desc, eids_table=None):
+	field_desc = as_field_metadata(field_desc)
+	selects = []
+	for code_type in ['read_2', 'read_3']:
+		codes = [q['val'] for q in query_tuples if q['field'] == code_type]
+		if not codes:
+			continue
+		field = field_id(code_type, field_desc) if is_compact(field_desc) else f"'{code_type}'"
+		code_selection = " or ".join([gp_code_condition(code_type, c, field_desc) for c in codes])
+		code_selection = restrict_to_eids(code_selection, eids_table)
+		selects.append(f"select eid, {field} as field, event_dt as time, 0 as array, {code_type} as value "
+					   f"from gp_clinical where {code_selection}")
+	return " union ".join(selects)
+
 # Make query: select * from tab where field=f1 and value=v1 or field=f2 and value=v2 ...
 # Make query: select * from tab where field=f1 and value=v1 or field=f2 and value=v2 ...
-def tab_select(tab, query_tuples, field_desc):
+def tab_select(tab, query_tuples, field_desc, eids_table=None):
 	query_tuples = [qt for qt in query_tuples if qt['tab'] == tab]
 	if not query_tuples:
 		return ""
+	field_desc = as_field_metadata(field_desc)
+	if tab == 'gp_clinical':
+		return gp_clinical_select(query_tuples, field_desc, eids_table)
+	if is_compact(field_desc):
+		return compact_tab_select(tab, query_tuples, field_desc, eids_table)
 
 	# Get the right field/value queries for all query_tuples
-	tab_selection = " or ".join(["field='{}' and value {}".format(q['field'], prepare_value(q,field_desc)) for q in query_tuples])
+	tab_selection = " or ".join(["field='{}' and {}".format(q['field'], value_condition('value', q, field_desc)) for q in query_tuples])
+	tab_selection = restrict_to_eids(tab_selection, eids_table)
 	return 'select * from {} where {}'.format(tab,tab_selection)
 
 
+# Make query: select eid from tab where field=f and value=v, for one query tuple
+def criterion_select(qt, field_desc, eids_table=None):
+	if qt['tab'] == 'gp_clinical':
+		return f"select eid from gp_clinical where {restrict_to_eids(gp_code_condition(qt['field'], qt['val'], field_desc), eids_table)}"
+	field_desc = as_field_metadata(field_desc)
+	field = f"'{qt['field']}'"
+	condition = f"field={field} and {value_condition('value', qt, field_desc)}"
+	if is_compact(field_desc):
+		field = field_id(qt['field'], field_desc)
+		condition = f"field={field} and {value_condition('value', qt, field_desc)}"
+		if qt['tab'] == 'str' and is_range(qt['val']):
+			condition = f"field={field} and value in (select id from str_values where {value_condition('value', qt, field_desc)})"
+		elif qt['tab'] == 'str' and qt['val'] != 'nan':
+			condition = f"field={field} and value =(select id from str_values where value='{qt['val']}')"
+	return f"select eid from {qt['tab']} where {restrict_to_eids(condition, eids_table)}"
+
+
+def has_stats_tables(con):
+	return con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name IN ('field_stats', "
+					   "'value_stats')").fetchone()[0] == 2
+
+
+# A criterion value as it is kept in value_stats: int fields' values are numbers, anything else is text. None if the
+# value can't be an int.
+def stats_value(val, tab):
+	if tab != 'int':
+		return str(val)
+	try:
+		x = float(val)
+	except ValueError:
+		return None
+	return int(x) if x.is_integer() else x
+
+
+def criterion_counts(con, cohort_criteria: dict, field_desc=None) -> dict:
+	"""Number of participants matching each criterion, from the field_stats and value_stats tables made by the build.
+	Single values of str and int fields and read codes are counted exactly, as are criteria on fields nobody has. For
+	anything else the number of participants with a value for the field is given, which is an upper bound.
+
+	Keyword arguments:
+	------------------
+	con: sqlite3.Connection
+		connection to the db
+	cohort_criteria: dict
+		cohort_criteria, or any dict of lists of (field, value) criteria
+	field_desc: FieldMetadata
+		field_desc of the db, read from it if not given
+
+	Returns:
+	--------
+	counts: dict
+		participants for each (field, value) criterion, with range values as tuples. Empty if the database has no
+		stats tables.
+	"""
+	if not has_stats_tables(con):
+		return {}
+	field_desc = as_field_metadata(field_desc if field_desc is not None else load_field_metadata(con))
+	counts = {}
+	for field, val in [c for criteria in cohort_criteria.values() for c in criteria]:
+		val = tuple(val) if is_range(val) else val
+		tab = field_desc.tab.get(field)
+		if tab is None:
+			continue
+		row = con.execute('SELECT n_eids FROM field_stats WHERE field=? AND instance=?', (field, all_instances)).fetchone()
+		if row is None:
+			counts[(field, val)] = 0
+		elif is_range(val) or val == 'nan' or tab not in ['str', 'int', 'gp_clinical']:
+			counts[(field, val)] = row[0]
+		else:
+			row = con.execute('SELECT n_eids FROM value_stats WHERE field=? AND value=?',
+							  (field, stats_value(val, tab))).fetchone()
+			counts[(field, val)] = row[0] if row else 0
+	return counts
+
+
+# A query which finds no one, for cohorts the stats show to be empty
+empty_cohort_query = 'select NULL as eid where 0'
+
+# Is a cohort empty according to its criterion counts? It is if an all_of criterion, or every any_of criterion,
+# matches no one.
+def empty_cohort(cohort_criteria, counts):
+	count = lambda c: counts.get((c[0], tuple(c[1]) if is_range(c[1]) else c[1]))
+	any_of = cohort_criteria.get('any_of', [])
+	return (any(count(c) == 0 for c in cohort_criteria.get('all_of', [])) or
+			(bool(any_of) and all(count(c) == 0 for c in any_of)))
+
+
+# The eids of every participant, which a query with only none_of criteria starts from: the participants table, or for
+# databases built without one everyone with a height (field 50)
+def universe_select(field_desc, eids_table=None):
+	field_desc = as_field_metadata(field_desc)
+	if field_desc.participants:
+		return f"select eid from participants where {restrict_to_eids('1', eids_table)}"
+	return criterion_select(create_query_tuples({'none_of': [('50', 'nan')]}, field_desc)[0], field_desc, eids_table)
+
+
+# Compile cohort criteria into set operations on the eids matching each criterion. all_of criteria are intersected,
+# that is intersected with the union of the any_of criteria, then each none_of criterion is taken away. A query with
+# only none_of criteria starts from every participant (see universe_select).
+# With eids_table, each criterion only looks at the eids in that temp table. With the counts of criterion_counts, the
+# most selective all_of criteria are intersected first and the largest none_of criteria taken away first, and a
+# cohort the counts show to be empty is not queried at all.
+def compile_cohort_query(cohort_criteria, field_desc, eids_table=None, counts=None):
+	field_desc = as_field_metadata(field_desc)
+	if counts:
+		# Unknown fields still raise, as they would if the cohort was queried
+		create_query_tuples(cohort_criteria, field_desc)
+		if empty_cohort(cohort_criteria, counts):
+			return empty_cohort_query
+		# Criteria without a count keep their place after the counted ones
+		count = lambda c: counts.get((c[0], tuple(c[1]) if is_range(c[1]) else c[1]))
+		order = lambda k, sign: sorted(cohort_criteria.get(k, []),
+									   key=lambda c: (count(c) is None, sign * (count(c) or 0)))
+		cohort_criteria = {'all_of': order('all_of', 1), 'any_of': cohort_criteria.get('any_of', []),
+						   'none_of': order('none_of', -1)}
+	probes = {k: [criterion_select(qt, field_desc, eids_table) for qt in create_query_tuples({k: cohort_criteria.get(k, [])}, field_desc)]
+			  for k in ['all_of', 'any_of', 'none_of']}
+	query = " intersect ".join(probes['all_of'])
+	if probes['any_of']:
+		any_query = " union ".join(probes['any_of'])
+		query = f"{query} intersect select eid from ({any_query})" if query else any_query
+	if probes['none_of']:
+		if not query:
+			query = universe_select(field_desc, eids_table)
+		# Compound selects associate to the left, so the excepts apply to everything before them
+		query = " except ".join([query] + probes['none_of'])
+	return query
+
+
 def create_query_tuples(cohort_criteria, field_desc):
 	query_tuples = [(vi[0], vi[1]) for v in cohort_criteria.values() for vi in v]
 	# query_tuples = [list(qt) + [field_desc[field_desc['field'] == str(int(float(qt[0])))]['tab'].iloc[0]] for qt in query_tuples]
 
-	fields_not_in_field_desc = [qt[0] for qt in query_tuples if not any(field_desc['field']==qt[0])]
+	field_desc = as_field_metadata(field_desc)
+	fields_not_in_field_desc = [qt[0] for qt in query_tuples if qt[0] not in field_desc.tab]
 	#print("all_fields_in_field_desc: {}".format([x in field_desc['field'] for x in fields_not_in_field_desc]))
 	#print(fields_not_in_field_desc)
 
 	if fields_not_in_field_desc:
 		raise ValueError(f"{','.join(fields_not_in_field_desc)} not in field_desc['field']")
 
-	query_tuples = [list(qt) + [field_desc[field_desc['field'] == qt[0]]['tab'].iloc[0]] for qt in query_tuples]
+	query_tuples = [list(qt) + [field_desc.tab[qt[0]]] for qt in query_tuples]
 	query_tuples = [dict(zip(('field', 'val', 'tab'), q)) for q in query_tuples]
 	return(query_tuples)
 
 
-def unify_query_tuples(query_tuples, field_desc, has_none=False):
+def unify_query_tuples(query_tuples, field_desc, has_none=False, eids_table=None):
 	# print('derive unique tabs')
 
-	#If we have a none-of query, we need a way to include all possible eids. So we extract all fields that have
-	#a value of height, i.e  everyone
-	if has_none:
+	#If we have a none-of query, we need a way to include all possible eids. Every participant gets a row with no
+	#field from the participants table, or in databases without it we extract all fields that have a value of height
+	field_desc = as_field_metadata(field_desc)
+	universe = []
+	if has_none and field_desc.participants:
+		universe = [f"select eid, NULL as field, NULL as time, NULL as array, NULL as value from participants "
+					f"where {restrict_to_eids('1', eids_table)}"]
+	elif has_none:
 		query_tuples = query_tuples + create_query_tuples({'none_of': [('50', 'nan')]}, field_desc)
-	tabs = [t for t in field_desc['tab'].iloc[1:].unique()]
-	tab_queries = filter(len, [tab_select(tab, query_tuples, field_desc) for tab in tabs])
+	tab_queries = list(filter(len, [tab_select(tab, query_tuples, field_desc, eids_table) for tab in field_desc.tabs])) + universe
 	# Look at the fields in each table, form into query, take union
 	union_q = "(" + " union ".join(tab_queries) + ")"
 
@@ -343,14 +1441,16 @@ def unify_query_tuples(query_tuples, field_desc, has_none=False):
 
 
 def expand_field(field, field_desc):
-	fs = field_desc[field_desc["field"] == field]["field_col"].to_list()
-	return [re.split(r'[-.]', f) for f in fs]
+	return list(as_field_metadata(field_desc).columns.get(field, []))
 
 
 def generate_main_column_queries(field, field_desc,field_sql_map):
-
+	field_desc = as_field_metadata(field_desc)
 	fs = expand_field(field, field_desc)
 	distinct_str = lambda f: f"distinct case when field='{f[0]}' and time='{f[1]}' and array='{f[2]}' then value end"
+	if is_compact(field_desc):
+		fid = field_id(field, field_desc)
+		distinct_str = lambda f: f"distinct case when field={fid} and time={f[1]} and array={f[2]} then value end"
 
 	return([f"cast(max({distinct_str(f)}) as {field_sql_map[f[0]]}) as 'f{f[0]}-{f[1]}.{f[2]}'" for f in fs])
 
@@ -358,69 +1458,259 @@ def generate_main_column_queries(field, field_desc,field_sql_map):
 #TODO: When we allow searches using specific times/arrays this will need to be extended.
 # In fact, it already does with the gp_clinical data
 def pivot_results(field_desc, query_tuples):
-	field_sql_map = {f: field_desc[field_desc['field'] == f]['sql_type'].iloc[0] for f in
-					 set([q['field'] for q in query_tuples])}
+	field_desc = as_field_metadata(field_desc)
+	field_sql_map = {f: field_desc.sql_type[f] for f in set([q['field'] for q in query_tuples])}
 
 	uniq_fields=set([q['field'] for q in query_tuples])
 	pivot_queries = [",".join(generate_main_column_queries(f,field_desc,field_sql_map)) for f in uniq_fields if f not in ['read_2', 'read_3']]
 	if 'read_2' in uniq_fields or  'read_3' in uniq_fields:
-		pivot_queries = pivot_queries + [f"cast(max(distinct case when field='{q['field']}' and value='{q['val']}' then value end) as VARCHAR) as 'f{q['field']}-{q['val']}'" for
+		field_str = lambda f: str(field_id(f, field_desc)) if is_compact(field_desc) else f"'{f}'"
+		code_str = lambda q: value_condition('value', q, field_desc) if is_range(q['val']) else f"value='{q['val']}'"
+		pivot_queries = pivot_queries + [f"cast(max(distinct case when field={field_str(q['field'])} and {code_str(q)} then value end) as VARCHAR) as 'f{q['field']}-{criterion_label(q['val'])}'" for
 									 q in query_tuples if q['field'] in ['read_2', 'read_3'] ]
 
 	return(",".join(pivot_queries))
 
 
-def query_sqlite_db(cohort_criteria: dict, con: sqlite3.Connection=None, db_filename: str=None, eids_list: list=[]):
+def query_sqlite_db(cohort_criteria: dict, con: sqlite3.Connection=None, db_filename: str=None, eids_list: list=[],
+					wide: bool=False, bitmap_index=None):
 	"""Query the triple store
 
 		Keyword arguments:
 		------------------
 		db_filename: str
-			path and filename of db to query
+			path and filename of db to query, through the calling thread's pooled read-only connection
 		cohort_criteria: dict
 			cohort_criteria defining query
 		eids_list: list
-			optional list of EIDs to filter the resulting dataframe for
+			optional list of EIDs to restrict the query to. They are loaded into an indexed temp table which the
+			query joins against, so only the rows of these participants are pivoted.
+		wide: bool
+			also return the values of the fields in the criteria, one column per field column (instance and array).
+			This pivots every matching value per participant, which is much slower than finding the participants.
+		bitmap_index: bitmap.EidBitmapIndex
+			optional bitmap index of the database, used instead of SQL when every criterion can be answered from it
+			and wide is False
 
 		Returns:
 		--------
 		res: pd.DataFrame
-			DataFrame of query results
+			DataFrame of query results, with an eid column (and the field columns if wide)
 
 		"""
 
 	# TODO: Fix cohort criteria generation so that its more inline with the db we create.
 	if(db_filename):
-		con = sqlite3.connect(database=db_filename)
+		con = connection.get_connection(db_filename)
 
 
-	field_desc = pd.read_sql('SELECT * from field_desc', con)
+	field_desc = load_field_metadata(con)
 	if(not any(cohort_criteria.values())):
 	  return pd.DataFrame({'eid':[]})
 
 	print("generate main criteria: {}".format(cohort_criteria))
+	if not wide and bitmap_index is not None and bitmap_index.answerable(cohort_criteria):
+		res = pd.DataFrame({'eid': bitmap_index.query(cohort_criteria)})
+		if len(eids_list):
+			res = res[res['eid'].isin(eids_list)].reset_index(drop=True)
+		print(f'Done {datetime.now()}')
+		return (res)
+
+	eids_table = load_eids_table(con, eids_list) if len(eids_list) else None
+	try:
+		if not wide:
+			counts = criterion_counts(con, cohort_criteria, field_desc)
+			res = pd.read_sql(compile_cohort_query(cohort_criteria, field_desc, eids_table, counts), con)
+		else:
+			res = pd.read_sql(pivot_query(cohort_criteria, field_desc, eids_table), con)
+	finally:
+		if eids_table:
+			drop_eids_table(con, eids_table)
+	print(f'Done {datetime.now()}')
+	return (res)
+
 
-	has_none = 'none_of' in cohort_criteria and cohort_criteria['none_of']
+# The wide query: pivot the values matching the criteria to one column per field column for each participant, then
+# select the participants whose columns meet the criteria
+def pivot_query(cohort_criteria, field_desc, eids_table=None):
+	field_desc = as_field_metadata(field_desc)
+	# Participants matching all_of or any_of criteria have rows already, so only a query with nothing but none_of
+	# criteria needs every participant
+	has_none = cohort_criteria.get('none_of') and not (cohort_criteria.get('all_of') or cohort_criteria.get('any_of'))
 	query_tuples = create_query_tuples(cohort_criteria, field_desc)
-	long_tables_query = unify_query_tuples(query_tuples, field_desc, has_none)
+	long_tables_query = unify_query_tuples(query_tuples, field_desc, has_none, eids_table)
 
-	pivot_query = pivot_results(field_desc, query_tuples)
+	pivot_columns = pivot_results(field_desc, query_tuples)
 	selection_query = filter_pivoted_results(cohort_criteria, field_desc)
 
 	# Add the table for the field inop each query and turn in them into dictionaries to help readability
 	# query_tuples = [(int(float(vi[0])), vi[1]) for v in cohort_criteria.values() for vi in v]
 
 	q = f'''select * from (
-            select eid, {pivot_query}
+            select eid, {pivot_columns}
           from {long_tables_query}
          GROUP BY eid) where {selection_query}'''.strip('\n')
 	#print("Query: {}".format(q))
-	# print(f'Run query {datetime.now()}\n {q}')
-	res = pd.read_sql(q, con)
-	if eids_list:
-		print(f"filtering for ids")
-		res_filt = res.set_index(['eid']).iloc[res.set_index(['eid']).index.isin(eids_list)].reset_index()
-		res = res_filt
-		print(f"res_filt shape {res.shape}")
-	print(f'Done {datetime.now()}')
+	return q
+
+
+def count_cohort(cohort_criteria: dict, con: sqlite3.Connection=None, db_filename: str=None,
+				 bitmap_index=None) -> int:
+	"""Count the participants matching cohort criteria, without listing them or pivoting their values
+
+		Keyword arguments:
+		------------------
+		cohort_criteria: dict
+			cohort_criteria defining query
+		con: sqlite3.Connection
+			connection to the db
+		db_filename: str
+			path and filename of db to query, through the calling thread's pooled read-only connection
+		bitmap_index: bitmap.EidBitmapIndex
+			optional bitmap index of the database, counted from instead of SQL when every criterion can be answered
+			from it
+
+		Returns:
+		--------
+		n: int
+			number of participants in the cohort
+
+		"""
+	if not any(cohort_criteria.values()):
+		return 0
+	if bitmap_index is not None and bitmap_index.answerable(cohort_criteria):
+		return bitmap_index.count(cohort_criteria)
+	if(db_filename):
+		con = connection.get_connection(db_filename)
+	field_desc = load_field_metadata(con)
+	query = compile_cohort_query(cohort_criteria, field_desc, counts=criterion_counts(con, cohort_criteria, field_desc))
+	return con.execute(f'select count(distinct eid) from ({query})').fetchone()[0]
+
+
+def has_eid_index(con):
+	return con.execute("SELECT count(*) FROM sqlite_master WHERE type='index' AND name='str_eid_index'").fetchone()[0] == 1
+
+
+# The selects of extract_participants, one per table holding some of the fields. With eid indexes, CROSS JOIN keeps
+# the eids temp table as the outer loop, so each participant's rows are a range of the eid index rather than the
+# planner scanning the field index instead. Without them the planner is left to pick.
+def extract_queries(fields, field_desc, eids_table, eid_index=True):
+	field_desc = as_field_metadata(field_desc)
+	join = 'cross join' if eid_index else 'join'
+	field_str = lambda f: str(field_id(f, field_desc)) if field_desc.compact else quote_text(f)
+	all_fields = [f for f in field_desc.tab if f != 'eid']
+	selects = []
+	for tab in ['str', 'int', 'real', 'datetime']:
+		tab_fields = [field_str(f) for f in fields if field_desc.tab[f] == tab]
+		if not tab_fields:
+			continue
+		value = 'str_values.value' if tab == 'str' and field_desc.compact else 't.value'
+		values_join = 'join str_values on str_values.id=t.value' if tab == 'str' and field_desc.compact else ''
+		field_filter = '' if len(tab_fields) == len([f for f in all_fields if field_desc.tab[f] == tab]) else \
+			f"and t.field in ({','.join(tab_fields)})"
+		selects.append(f"select t.eid, t.field, t.time, t.array, {value} as value from temp.{eids_table} e "
+					   f"{join} {tab} t on t.eid=e.eid {field_filter} {values_join}")
+	for code_type in ['read_2', 'read_3']:
+		if code_type in fields and field_desc.tab[code_type] == 'gp_clinical':
+			selects.append(f"select g.eid, {field_str(code_type)} as field, g.event_dt as time, 0 as array, "
+						   f"g.{code_type} as value from temp.{eids_table} e {join} gp_clinical g on g.eid=e.eid "
+						   f"where g.{code_type} is not NULL")
+	return selects
+
+
+def extract_participants(eids: list, fields: list=None, con: sqlite3.Connection=None, db_filename: str=None,
+						 wide: bool=False) -> pd.DataFrame:
+	"""Get all the data, or the data of some fields, of a list of participants. With the eid indexes (built with
+	eid_index, or by the first refresh of a database) each participant's rows are read straight from them, so the time
+	taken goes with the amount of data the participants have rather than the size of the database.
+
+		Keyword arguments:
+		------------------
+		eids: list
+			EIDs of the participants
+		fields: list
+			fields to extract, e.g. ['34', '21003', 'read_2'], or None for all of them
+		con: sqlite3.Connection
+			connection to the db
+		db_filename: str
+			path and filename of db, through the calling thread's pooled read-only connection
+		wide: bool
+			return one row per participant, with a column 'f<field>-<instance>.<array>' for each field column, instead
+			of the long (eid, field, time, array, value) rows. read_2 and read_3 records are events rather than
+			columns, so they are only in the long form.
+
+		Returns:
+		--------
+		res: pd.DataFrame
+			DataFrame of the participants' values
+
+		"""
+	if(db_filename):
+		con = connection.get_connection(db_filename)
+	field_desc = load_field_metadata(con)
+	fields = [f for f in field_desc.tab if f != 'eid'] if fields is None else [str(f) for f in fields]
+	fields_not_in_field_desc = [f for f in fields if f not in field_desc.tab]
+	if fields_not_in_field_desc:
+		raise ValueError(f"{','.join(fields_not_in_field_desc)} not in field_desc['field']")
+	if wide:
+		fields = [f for f in fields if f not in ['read_2', 'read_3']]
+	eid_index = has_eid_index(con)
+	if not eid_index:
+		print('No eid index, the fields will be scanned. Build with eid_index to extract participants faster')
+
+	eids_table = load_eids_table(con, eids, name='extract_eids')
+	try:
+		selects = extract_queries(fields, field_desc, eids_table, eid_index)
+		res = pd.concat([pd.read_sql(q, con) for q in selects], ignore_index=True) if selects else \
+			pd.DataFrame(columns=['eid', 'field', 'time', 'array', 'value'])
+	finally:
+		drop_eids_table(con, eids_table)
+	if field_desc.compact:
+		names = {v: k for k, v in field_desc.field_id.items()}
+		res['field'] = res['field'].map(names)
+	res['field'] = res['field'].astype(str)
+	if not wide:
+		return res.sort_values(['eid', 'field'], kind='stable').reset_index(drop=True)
+
+	res['column'] = ['f{}-{}.{}'.format(f, t, a) for f, t, a in zip(res['field'], res['time'], res['array'])]
+	columns = ['f{}-{}.{}'.format(f, t, a) for f in fields for _, t, a in expand_field(f, field_desc)]
+	res = res.pivot(index='eid', columns='column', values='value').reindex(columns=columns)
+	return res.rename_axis(None, axis=1).reset_index()
+
+
+def query_gp_clinical_events(codes: list, code_type: str = 'read_2', start=None, end=None,
+							 con: sqlite3.Connection=None, db_filename: str=None) -> pd.DataFrame:
+	"""Get the gp_clinical events with the given codes, optionally within a date window. Needs a database built with
+	gp_table, where each code lookup is a range scan of the index on (code, event date).
+
+		Keyword arguments:
+		------------------
+		codes: list
+			codes to look for, e.g. ['XE0of']
+		code_type: str
+			'read_2' or 'read_3'
+		start: date, str or None
+			earliest event date to include
+		end: date, str or None
+			latest event date to include
+		db_filename: str
+			path and filename of db to query
+
+		Returns:
+		--------
+		res: pd.DataFrame
+			DataFrame of matching events, with event_dt as a date
+
+		"""
+	if code_type not in ['read_2', 'read_3']:
+		raise ValueError(f"code_type must be read_2 or read_3, not {code_type}")
+	if(db_filename):
+		con = connection.get_connection(db_filename)
+
+	to_days = lambda d: (pd.Timestamp(d) - pd.Timestamp('1970-01-01')).days
+	window = "".join([" and event_dt >= {}".format(to_days(start)) if start is not None else "",
+					  " and event_dt <= {}".format(to_days(end)) if end is not None else ""])
+	q = " union all ".join([f"select * from gp_clinical where {code_type}=?{window}" for _ in codes])
+	res = pd.read_sql(q, con, params=list(codes)) if codes else pd.DataFrame(columns=gp_clinical_cols)
+	res['event_dt'] = pd.Timestamp('1970-01-01') + pd.to_timedelta(res['event_dt'], unit='D')
 	return (res)
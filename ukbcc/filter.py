@@ -1,4 +1,6 @@
 import pandas as pd
+import re
+from . import db
 
 
 def construct_search_df(showcase_filename: str, coding_filename: str, readcode_filename: str) -> pd.DataFrame:
@@ -80,6 +82,32 @@ def construct_candidate_df(searchable_df: pd.DataFrame, search_terms: list) -> p
     return candidate_df
 
 
+def add_participant_counts(candidate_df: pd.DataFrame, con) -> pd.DataFrame:
+    """Returns candidate_df with the number of participants having each candidate value (or, for rows without a
+    value, having the field at all) in a Participants column. Counts are looked up in the stats tables made when the
+    database was built, so none of the data is queried. Databases without them give candidate_df unchanged.
+
+    Keyword arguments:
+    ------------------
+    candidate_df: pd.DataFrame
+        dataframe with the keys [Field, FieldID, Coding, Value, Meaning]
+    con: sqlite3.Connection
+        connection to the database
+
+    Returns:
+    --------
+    candidate_df: pd.DataFrame
+        candidate_df with the keys [Field, FieldID, Coding, Value, Meaning, Participants]
+    """
+    if not db.has_stats_tables(con):
+        return candidate_df
+    criteria = [(str(f), 'nan' if pd.isna(v) else str(v)) for f, v in zip(candidate_df.FieldID, candidate_df.Value)]
+    counts = db.criterion_counts(con, {'candidates': criteria})
+    candidate_df = candidate_df.copy()
+    candidate_df['Participants'] = pd.array([counts.get(c) for c in criteria], dtype='Int64')
+    return candidate_df
+
+
 def construct_cohort_criteria(all_of: list, any_of: list, none_of: list) -> dict:
     """Returns formatted cohort_criteria dictionary.
 
@@ -92,6 +120,9 @@ def construct_cohort_criteria(all_of: list, any_of: list, none_of: list) -> dict
 
     To include a column entirely, set value to 'not null'.
     To exclude anyone who has a value recorded in a column, add tuple (<column_key>, 'not null') to 'none_of' list.
+    To match a range of values, set value to a tuple: ('between', low, high), ('>=', x), ('>', x), ('<', x), ('<=', x)
+    for numbers and dates, or ('prefix', p) for codes, e.g. ('41270', ('prefix', 'E11')). parse_value turns the text
+    forms 'between 25 and 30', '>=30' and 'E11*' into these.
 
 
     Keyword arguments:
@@ -116,3 +147,34 @@ def construct_cohort_criteria(all_of: list, any_of: list, none_of: list) -> dict
     }
 
     return cohort_criteria
+
+
+def parse_value(value: str):
+    """Returns the criterion value for a text value. Besides a single value, it can be
+    - a range: 'between x and y', '>= x', '> x', '< x' or '<= x'
+    - codes starting with a prefix: 'E11*'
+    - a code and every code below it in its hierarchy: 'descendants of E11'
+
+    Keyword arguments:
+    ------------------
+    value: str
+        value as typed, e.g. '1', '>= 30' or 'E11*'
+
+    Returns:
+    --------
+    value: str or tuple
+        the value, or a range tuple such as ('>=', '30') or ('prefix', 'E11')
+    """
+    text = str(value).strip()
+    descendants = re.fullmatch(r'descendants\s+of\s+(.+)', text, flags=re.IGNORECASE)
+    if descendants:
+        return ('descendants', descendants.group(1).strip())
+    between = re.fullmatch(r'between\s+(\S+)\s+and\s+(\S+)', text, flags=re.IGNORECASE)
+    if between:
+        return ('between', between.group(1), between.group(2))
+    comparison = re.fullmatch(r'(>=|<=|>|<)\s*(\S+)', text)
+    if comparison:
+        return (comparison.group(1), comparison.group(2))
+    if len(text) > 1 and text.endswith('*'):
+        return ('prefix', text[:-1])
+    return value
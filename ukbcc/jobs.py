@@ -0,0 +1,206 @@
+import concurrent.futures
+import collections
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# SQLite virtual machine instructions between calls of a watched connection's progress handler
+progress_interval = 10000
+
+
+class JobCancelled(Exception):
+    """Raised inside a job which has been cancelled"""
+
+
+class QueryJob:
+    """A function run in the background by a JobRunner, with its status and progress.
+
+    The function is called with the job, and reports its progress by starting each of its stages with stage() and
+    running its queries inside watch(), which counts the steps of the queries with SQLite's progress handler. Cancelling
+    the job interrupts the queries running on the watched connections, and any later query or stage raises
+    JobCancelled, so the function gives up at the next opportunity.
+
+    Keyword arguments:
+    ------------------
+    fn: function
+        function to run, called with the job
+    stages: list
+        names of the stages of the function, in order
+    """
+
+    def __init__(self, fn, stages: list = ()):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.stages = list(stages)
+        self.status = 'queued'
+        self.stage_name = None
+        self.stages_done = 0
+        self.steps = 0
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancelled = threading.Event()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Raises JobCancelled if the job has been cancelled"""
+        if self.cancelled:
+            raise JobCancelled(self.id)
+
+    def stage(self, name: str):
+        """Marks the start of the next stage of the job, or raises JobCancelled if the job has been cancelled"""
+        self.check()
+        with self._lock:
+            if self.stage_name is not None:
+                self.stages_done += 1
+            self.stage_name = name
+
+    # Counts progress and aborts the running statement once the job is cancelled
+    def _progress(self):
+        self.steps += 1
+        return 1 if self.cancelled else 0
+
+    @contextmanager
+    def watch(self, con: sqlite3.Connection):
+        """Context in which the queries run on a connection count towards the job's progress and are interrupted if
+        the job is cancelled. The connection's progress handler is removed again afterwards, so pooled connections can
+        be watched."""
+        self.check()
+        con.set_progress_handler(self._progress, progress_interval)
+        with self._lock:
+            self._connections.append(con)
+        try:
+            yield con
+        finally:
+            with self._lock:
+                self._connections.remove(con)
+            con.set_progress_handler(None, 0)
+
+    def cancel(self) -> bool:
+        """Cancels the job, interrupting its running queries. Returns False if it had already finished."""
+        if self.status in ['done', 'error', 'cancelled']:
+            return False
+        self._cancelled.set()
+        with self._lock:
+            connections = list(self._connections)
+        for con in connections:
+            con.interrupt()
+        if self.future is not None and self.future.cancel():
+            self._finish('cancelled')
+        return True
+
+    def _finish(self, status):
+        self.status = status
+        self.finished = time.time()
+
+    def run(self):
+        if self.cancelled:
+            self._finish('cancelled')
+            return
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.result = self.fn(self)
+        except Exception as e:
+            # An interrupted query fails with 'interrupted', as an sqlite3.OperationalError or wrapped by pandas in a
+            # pandas.errors.DatabaseError, so any failure once the job has been cancelled is the cancellation
+            if isinstance(e, JobCancelled) or self.cancelled:
+                self._finish('cancelled')
+                print(f'Cancelled job {self.id}')
+                return
+            self.error = str(e)
+            self._finish('error')
+            print(f'Job {self.id} failed: {e}')
+        else:
+            self.stages_done = len(self.stages)
+            self._finish('done')
+
+    def progress(self) -> dict:
+        """Status, current stage, fraction of stages done, query steps counted, elapsed seconds and error of the job"""
+        with self._lock:
+            fraction = self.stages_done / len(self.stages) if self.stages else float(self.status == 'done')
+            end = self.finished if self.finished is not None else time.time()
+            return {'id': self.id, 'status': self.status, 'stage': self.stage_name, 'stages_done': self.stages_done,
+                    'stages': len(self.stages), 'fraction': fraction, 'steps': self.steps,
+                    'elapsed': end - self.started if self.started is not None else 0.0, 'error': self.error}
+
+
+class JobRunner:
+    """Runs QueryJobs on a pool of background threads and keeps them, by id, so their progress and results can be
+    polled. The oldest finished jobs are forgotten once more than keep jobs are held.
+
+    Keyword arguments:
+    ------------------
+    max_workers: int
+        number of jobs to run at the same time
+    keep: int
+        number of jobs to hold
+    """
+
+    def __init__(self, max_workers: int = 2, keep: int = 100):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='ukbcc-job')
+        self.keep = keep
+        self.jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, stages: list = ()) -> str:
+        """Queues fn(job) to run in the background and returns the id of its job"""
+        job = QueryJob(fn, stages)
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [k for k, j in self.jobs.items() if j.status in ['done', 'error', 'cancelled']]
+            for k in finished[:max(0, len(self.jobs) - self.keep)]:
+                del self.jobs[k]
+        job.future = self.executor.submit(job.run)
+        return job.id
+
+    def get(self, job_id: str) -> QueryJob:
+        """The job with an id, or None if there is none"""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels a job. Returns False if there is no such job or it had already finished."""
+        job = self.get(job_id)
+        return job.cancel() if job is not None else False
+
+    def progress(self, job_id: str) -> dict:
+        """Progress of a job (see QueryJob.progress), or None if there is no such job"""
+        job = self.get(job_id)
+        return job.progress() if job is not None else None
+
+    def shutdown(self, cancel: bool = True):
+        """Stops the runner, cancelling the jobs which haven't finished unless cancel is False"""
+        if cancel:
+            with self._lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                job.cancel()
+        self.executor.shutdown(wait=True)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def get_job_runner() -> JobRunner:
+    """Returns the job runner shared by the app, creating it the first time.
+
+    Returns:
+    --------
+    runner: JobRunner
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
@@ -0,0 +1,41 @@
+from . import db, colors
+import argparse
+import os
+
+def main():
+    """Remove withdrawn participants from a sqlite database.
+
+    Keyword arguments:
+    ------------------
+    db_path: str
+        path to the sqlite database
+    eids_path: str
+        path to a file listing the EIDs to remove, one per line, e.g. a UK Biobank withdrawal file
+
+    Returns:
+    --------
+    success: bool
+
+    """
+    parser = argparse.ArgumentParser(description='Remove participants from the sqlite database.')
+    parser.add_argument('--db_path', help='Please specify the path to the sqlite database file e.g ./ukb_data.sqlite',
+                        default=None)
+    parser.add_argument('--eids_path', help='Please specify the path to the file of EIDs to remove, one per line',
+                        default=None)
+
+    args = parser.parse_args()
+    cols = colors.terminal
+    db_file = args.db_path
+    while not db_file or not os.path.exists(db_file):
+        print(cols['orange'] + 'Database file not found' + cols['default'])
+        db_file = input('Please specify path to the sqlite database file: ')
+    eids_file = args.eids_path
+    while not eids_file or not os.path.exists(eids_file):
+        print(cols['orange'] + 'EIDs file not found' + cols['default'])
+        eids_file = input('Please specify path to the file of EIDs to remove: ')
+
+    with open(eids_file) as f:
+        eids = [line.strip() for line in f if line.strip()]
+    print(f'Removing {len(eids)} participants from {db_file}')
+    db.purge_eids(db_file, eids)
+    return True
@@ -35,8 +35,8 @@ def compute_stats_db(db_filename: str, eids_list: list, showcase_filename: str,
 
 
     orig_column_keys = ['34-0.0', '52-0.0', '22001-0.0', '21000-0.0', '22021-0.0']
-    criteria_dict = {'any_of': [(col, 'nan') for col in column_keys], 'all_of': [], 'none_of': []}
-    stats_df = db.query_sqlite_db(db_filename=db_filename, cohort_criteria=criteria_dict, eids_list=eids_list).set_index(['eid'])
+    stats_df = db.extract_participants(eids_list, fields=column_keys, db_filename=db_filename,
+                                       wide=True).set_index(['eid'])
 
     stats_filt = stats_df.iloc[stats_df.index.isin(eids_list)]
 
@@ -102,6 +102,24 @@ def sqlite_db(db_file):
     con = sqlite3.connect(database=db_file)
     return(con)
 
+
+# Keyword arguments of create_sqlite_db for each storage layout
+db_layouts = {'default': {}, 'compact': {'compact': True}, 'clustered': {'clustered': True},
+              'gp_table': {'gp_table': True}}
+
+
+# A database in each storage layout. Tests of one layout pick it with
+# @pytest.mark.parametrize('layout_db', ['compact'], indirect=True)
+@pytest.fixture(scope='module', params=list(db_layouts))
+def layout_db(request, main_csv, showcase_csv, gp_csv, tmpdir_factory):
+    db_file = str(tmpdir_factory.mktemp("sqlite").join(f"db_{request.param}.sqlite"))
+    con = db.create_sqlite_db(db_filename=db_file,
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2, **db_layouts[request.param])
+    return(con)
+
 @pytest.fixture(scope='module')
 def field_desc():
     field_desc = pd.read_csv(StringIO(re.sub('[ \t][ \t]+', ',', (
@@ -183,3 +201,37 @@ def main_criteria():
 #    ''')
 #    cursor.execute(stmt.format(project_id = project_id))
 #    yield project_id
+
+
+@pytest.fixture(scope='module')
+def codings_csv(tmpdir_factory):
+    test_codings_dat = (
+"Coding,Value,Meaning\n"
+"19,Chapter VII,Chapter VII Diseases of the eye and adnexa\n"
+"19,Block H40-H42,H40-H42 Glaucoma\n"
+"19,H40,H40 Glaucoma\n"
+"19,H400,H40.0 Glaucoma suspect\n"
+"19,H402,H40.2 Primary angle-closure glaucoma\n"
+"19,H42,H42 Glaucoma in diseases classified elsewhere\n"
+"19,Block E10-E14,E10-E14 Diabetes mellitus\n"
+"19,E11,E11 Non-insulin-dependent diabetes mellitus\n"
+"19,E119,E11.9 Without complications\n"
+"19,E14,E14 Unspecified diabetes mellitus\n"
+"19,E148,E14.8 With unspecified complications\n"
+"100274,1,Right\n"
+"100274,2,Left\n"
+        )
+    fn = tmpdir_factory.mktemp("codings").join("codings.csv")
+    fn.write(test_codings_dat)
+    return str(fn)
+
+
+@pytest.fixture(scope='module', params=['default', 'compact', 'gp_table'])
+def closure_db(request, main_csv, showcase_csv, gp_csv, codings_csv, tmpdir_factory):
+    db_file = str(tmpdir_factory.mktemp("sqlite").join("db_closure.sqlite"))
+    con = db.create_sqlite_db(db_filename=db_file,
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2, codings_file=codings_csv, **db_layouts[request.param])
+    return(con)
@@ -0,0 +1,76 @@
+import pytest
+from ukbcc import db, bitmap, connection
+from ukbcc.tests.test_db_query import layout_queries
+import os
+
+
+@pytest.mark.parametrize("cohort_criteria,exp_ids", layout_queries + [
+    ({'all_of': [], 'any_of': [], 'none_of': [('6070', "1")]}, [1037918, 1033149, 1033388, 1031625, 1031595, 1008947]),
+])
+def test_bitmap_query(db_file, cohort_criteria, exp_ids):
+    index = bitmap.EidBitmapIndex(db_file)
+    assert index.answerable(cohort_criteria)
+    assert index.query(cohort_criteria) == sorted(exp_ids)
+    obs = db.query_sqlite_db(db_filename=db_file, cohort_criteria=cohort_criteria, bitmap_index=index)
+    assert obs['eid'].tolist() == sorted(exp_ids)
+
+
+def test_bitmap_lazy_load(db_file):
+    index = bitmap.EidBitmapIndex(db_file)
+    assert index.bitmaps == {}
+    index.query({'all_of': [('6070', "1")], 'any_of': [('6148', "4")], 'none_of': []})
+    assert set(index.bitmaps) == {('6070', "1"), ('6148', "4")}
+    assert (index.hits, index.misses) == (0, 2)
+    index.query({'all_of': [('6070', "1")], 'any_of': [], 'none_of': [('6148', "4")]})
+    assert (index.hits, index.misses) == (2, 2)
+    assert index.memory_usage() > 0
+
+
+def test_bitmap_not_answerable(db_file):
+    index = bitmap.EidBitmapIndex(db_file)
+    assert not index.answerable({'all_of': [('21003', ('between', '50', '60'))], 'any_of': [], 'none_of': []})
+
+
+def test_get_bitmap_index(main_csv, showcase_csv, gp_csv, tmpdir):
+    db_filename = str(tmpdir.join("db.sqlite"))
+    db.create_sqlite_db(db_filename=db_filename, main_filename=main_csv, gp_clin_filename=gp_csv,
+                        showcase_file=showcase_csv, step=2)
+    index = bitmap.get_bitmap_index(db_filename)
+    assert bitmap.get_bitmap_index(db_filename) is index
+    #A changed database gets a new index
+    db.purge_eids(db_filename, [1041796])
+    os.utime(db_filename, ns=(0, 0))
+    new_index = bitmap.get_bitmap_index(db_filename)
+    assert new_index is not index
+    assert 1041796 not in new_index.query({'all_of': [('6070', "1")], 'any_of': [], 'none_of': []})
+    #So does a database loaded into or released from memory, or switched to or from immutable
+    indexes = [new_index]
+    for switch in [lambda: connection.load_into_memory(db_filename), lambda: connection.set_immutable(db_filename),
+                   lambda: connection.release_memory_copy(db_filename),
+                   lambda: connection.set_immutable(db_filename, False)]:
+        switch()
+        indexes.append(bitmap.get_bitmap_index(db_filename))
+        assert indexes[-1] is not indexes[-2] and bitmap.get_bitmap_index(db_filename) is indexes[-1]
+
+
+def test_bitmap_phenotypes(db_file):
+    index = bitmap.EidBitmapIndex(db_file)
+    phenotypes = {'all_of': {'a': [('6070', "1")]}, 'any_of': {},
+                  'none_of': {'b': [('6148', "4"), ('21003', "55")], 'empty': []}}
+    exp = index.query({'all_of': [('6070', "1")], 'any_of': [], 'none_of': [('6148', "4"), ('21003', "55")]})
+    assert index.query_phenotypes(phenotypes) == exp
+    misses = index.misses
+    #The phenotype is reused as a whole in the next cohort
+    index.query_phenotypes({'all_of': {'b': [('6148', "4"), ('21003', "55")]}})
+    index.query_phenotypes({'any_of': {'b': [('6148', "4"), ('21003', "55")]}})
+    assert index.misses == misses + 1
+    assert index.stats()['hit_rate'] == index.hits / (index.hits + index.misses)
+
+
+def test_bitmap_eviction(db_file):
+    index = bitmap.EidBitmapIndex(db_file, max_bytes=1)
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [('6148', "4")], 'none_of': []}
+    exp = bitmap.EidBitmapIndex(db_file).query(cohort_criteria)
+    assert index.query(cohort_criteria) == exp
+    assert len(index.bitmaps) == 1 and index.evictions == 1
+    assert index.memory_usage() == index.stats()['bytes']
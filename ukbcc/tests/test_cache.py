@@ -0,0 +1,60 @@
+import pytest
+from ukbcc import db, cache
+import shutil
+
+
+def test_canonical_criteria():
+    a = {'all_of': [('6070', '1'), ('21003', 55)], 'any_of': [], 'none_of': []}
+    b = {'none_of': [], 'all_of': [('21003', '55'), ('6070', '1')]}
+    assert cache.canonical_criteria(a) == cache.canonical_criteria(b)
+
+
+def test_cache_key(db_file):
+    a = {'all_of': [('6070', '1'), ('6148', '4')], 'any_of': [], 'none_of': []}
+    b = {'all_of': [('6148', '4'), ('6070', '1')], 'any_of': [], 'none_of': []}
+    assert cache.cache_key(db_file, a) == cache.cache_key(db_file, b)
+    assert cache.cache_key(db_file, a) != cache.cache_key(db_file, a, wide=True)
+    assert cache.cache_key(db_file, a) != cache.cache_key(db_file, {'all_of': [('6070', '1')]})
+
+
+def test_cohort_cache_memory(db_file):
+    cohort_cache = cache.CohortCache(max_entries=1)
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []}
+    exp = db.query_sqlite_db(db_filename=db_file, cohort_criteria=cohort_criteria)
+    assert cohort_cache.query(db_file, cohort_criteria).equals(exp)
+    assert cohort_cache.query(db_file, cohort_criteria).equals(exp)
+    assert cohort_cache.stats() == {'hits': 1, 'disk_hits': 0, 'misses': 1, 'memory_entries': 1}
+    cohort_cache.query(db_file, {'all_of': [('6148', "4")], 'any_of': [], 'none_of': []})
+    assert cohort_cache.stats()['memory_entries'] == 1
+
+
+def test_cohort_cache_disk(db_file, tmp_path):
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []}
+    disk_filename = str(tmp_path / 'cache.sqlite')
+    exp = cache.CohortCache(disk_filename=disk_filename).query(db_file, cohort_criteria, wide=True)
+    # A new cache on the same file, as after a restart
+    cohort_cache = cache.CohortCache(disk_filename=disk_filename)
+    assert cohort_cache.query(db_file, cohort_criteria, wide=True).equals(exp)
+    assert cohort_cache.stats()['disk_hits'] == 1
+
+
+def test_cohort_cache_disk_eviction(db_file, tmp_path):
+    cohort_cache = cache.CohortCache(disk_filename=str(tmp_path / 'cache.sqlite'), max_disk_bytes=1)
+    cohort_cache.query(db_file, {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []})
+    cohort_cache.query(db_file, {'all_of': [('6148', "4")], 'any_of': [], 'none_of': []})
+    assert cohort_cache._disk.execute('SELECT count(*) FROM cohort_cache').fetchone()[0] == 0
+
+
+#Purging participants gives the database a new build id, so cached cohorts are not reused
+def test_cohort_cache_invalidation(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    cohort_cache = cache.CohortCache()
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []}
+    before = cohort_cache.query(db_copy, cohort_criteria)
+    build_id = db.get_build_id(db.connection.get_connection(db_copy))
+    db.purge_eids(db_copy, [before['eid'].iloc[0]])
+    assert db.get_build_id(db.connection.get_connection(db_copy)) != build_id
+    after = cohort_cache.query(db_copy, cohort_criteria)
+    assert len(after) == len(before) - 1
+    assert cohort_cache.stats()['misses'] == 2
@@ -0,0 +1,180 @@
+import pytest
+from ukbcc import db, connection
+import sqlite3
+import shutil
+import threading
+
+
+def test_connect_read_only(db_file):
+    con = connection.connect_read_only(db_file, mmap_size=2**20, cache_size=-1024)
+    assert con.execute('PRAGMA query_only').fetchone()[0] == 1
+    assert con.execute('PRAGMA cache_size').fetchone()[0] == -1024
+    with pytest.raises(sqlite3.OperationalError):
+        con.execute('DELETE FROM str')
+    con.close()
+
+
+def test_pool_reuses_thread_connection(db_file):
+    pool = connection.ConnectionPool(db_file)
+    con = pool.connection()
+    assert pool.connection() is con
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not con
+    assert pool.stats() == {'hits': 1, 'misses': 2, 'open_connections': 2}
+    pool.close()
+    assert pool.stats()['open_connections'] == 0
+    assert pool.connection() is not con
+
+
+#A server thread per request shouldn't leave a connection per request behind
+def test_pool_hands_on_exited_threads_connections(db_file):
+    pool = connection.ConnectionPool(db_file)
+    for _ in range(50):
+        thread = threading.Thread(target=lambda: pool.connection().execute('select count(*) from str').fetchone())
+        thread.start()
+        thread.join()
+    assert pool.stats() == {'hits': 49, 'misses': 1, 'open_connections': 1}
+    # Threads still running keep their own connections
+    opened = threading.Barrier(4)
+    cons = []
+    def hold():
+        cons.append(pool.connection())
+        opened.wait(10)
+    threads = [threading.Thread(target=hold) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    opened.wait(10)
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, cons))) == 3 and pool.stats()['open_connections'] == 3
+    pool.connection()
+    assert pool.stats()['open_connections'] == 1
+    pool.close()
+
+
+#Closing the pool, as switching a database to immutable does, leaves a query running on another thread alone
+def test_pool_close_during_query(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    pool = connection.get_pool(db_copy)
+    query = 'with recursive r(i) as (select 1 union all select i + 1 from r where i < 2000000) select count(*) from r'
+    started = threading.Event()
+    results = []
+    def worker():
+        con = connection.get_connection(db_copy)
+        con.set_progress_handler(lambda: started.set(), 1000)
+        results.append(con.execute(query).fetchone()[0])
+        con.set_progress_handler(None, 0)
+        results.append(connection.get_connection(db_copy) is not con)
+        results.append(connection.get_connection(db_copy).execute('select count(*) from str').fetchone()[0])
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert started.wait(10)
+    mine = connection.get_connection(db_copy)
+    connection.set_immutable(db_copy)
+    assert pool.stats()['open_connections'] == 1
+    thread.join(30)
+    assert results[:2] == [2000000, True] and results[2] > 0
+    assert connection.get_connection(db_copy) is not mine
+    connection.set_immutable(db_copy, False)
+    pool.close()
+
+
+#A rebuilt database file is a new file, which the pool should switch to
+def test_pool_reopens_replaced_file(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    pool = connection.ConnectionPool(db_copy)
+    con = pool.connection()
+    shutil.copy(db_file, db_copy + '.new')
+    shutil.move(db_copy + '.new', db_copy)
+    assert pool.connection() is not con
+    assert pool.stats()['open_connections'] == 1
+    pool.close()
+
+
+def test_query_uses_pool(db_file):
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []}
+    db.query_sqlite_db(db_filename=db_file, cohort_criteria=cohort_criteria)
+    before = connection.pool_stats()[db_file]
+    db.query_sqlite_db(db_filename=db_file, cohort_criteria=cohort_criteria)
+    after = connection.pool_stats()[db_file]
+    assert after['hits'] == before['hits'] + 1 and after['misses'] == before['misses']
+
+
+#Once loaded into memory, queries read the copy, so changes to the file aren't seen until it is released
+def test_load_into_memory(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    criteria = {'all_of': [('6070', '1')], 'any_of': [], 'none_of': []}
+    exp = db.query_sqlite_db(criteria, db_filename=db_copy)
+    stats = connection.load_into_memory(db_copy)
+    assert stats['bytes'] > 0 and connection.memory_stats()[db_copy] == stats
+    con = connection.get_connection(db_copy)
+    assert isinstance(con, connection.MemoryCopyConnection) and con.source_filename == db_copy
+    with pytest.raises(sqlite3.OperationalError):
+        con.execute('DELETE FROM str')
+
+    writer = sqlite3.connect(db_copy)
+    writer.execute('DELETE FROM str')
+    writer.commit()
+    assert db.query_sqlite_db(criteria, db_filename=db_copy).equals(exp)
+    assert db.query_sqlite_db(criteria, db_filename=db_copy, eids_list=exp['eid'].tolist()[:2])['eid'].tolist() == \
+           exp['eid'].tolist()[:2]
+    assert db.count_cohort(criteria, db_filename=db_copy) == len(exp)
+    assert len(db.extract_participants(exp['eid'].tolist(), fields=['6070'], db_filename=db_copy)) == len(exp)
+
+    connection.release_memory_copy(db_copy)
+    assert db_copy not in connection.memory_stats()
+    assert db.query_sqlite_db(criteria, db_filename=db_copy).empty
+    connection.get_pool(db_copy).close()
+
+
+def test_warm(db_file):
+    stats = connection.warm(db_file, ['str_index', 'participants'])
+    assert set(stats) == {'str_index', 'participants'} and stats['str_index']['seconds'] >= 0
+    with pytest.raises(ValueError):
+        connection.warm(db_file, ['no_such_index'])
+
+
+#Immutable databases are opened without locking, aren't looked at again, and refuse to be rebuilt
+def test_set_immutable(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    criteria = {'all_of': [('6070', '1')], 'any_of': [], 'none_of': []}
+    exp = db.query_sqlite_db(criteria, db_filename=db_copy)
+    stamp = db.db_file_stamp(db_copy)
+    connection.set_immutable(db_copy)
+    assert connection.is_immutable(db_copy)
+    con = connection.get_connection(db_copy)
+    # No locks are taken, so reading goes ahead while another process holds an exclusive lock
+    locker = sqlite3.connect(db_copy, timeout=0)
+    locker.execute('BEGIN EXCLUSIVE')
+    assert db.query_sqlite_db(criteria, db_filename=db_copy).equals(exp)
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        sqlite3.connect(f'file:{db_copy}?mode=ro', uri=True, timeout=0).execute('SELECT count(*) FROM str').fetchone()
+    locker.rollback()
+    locker.close()
+    with pytest.raises(sqlite3.OperationalError, match='readonly'):
+        con.execute('DELETE FROM str')
+    with pytest.raises(ValueError, match='immutable'):
+        db.purge_eids(db_copy, [1])
+    with pytest.raises(ValueError, match='immutable'):
+        db.create_sqlite_db(db_copy, 'main.csv', None, 'showcase.csv')
+
+    # The file isn't stat'ed again, so a change (which breaks the promise) goes unnoticed
+    writer = sqlite3.connect(db_copy)
+    writer.execute('DELETE FROM str')
+    writer.commit()
+    writer.close()
+    assert db.db_file_stamp(db_copy) == stamp
+    assert connection.get_connection(db_copy) is con
+
+    connection.set_immutable(db_copy, False)
+    assert not connection.is_immutable(db_copy) and db.db_file_stamp(db_copy) != stamp
+    assert connection.get_connection(db_copy) is not con
+    assert db.query_sqlite_db(criteria, db_filename=db_copy).empty
+    connection.get_pool(db_copy).close()
@@ -1,5 +1,5 @@
 import pytest
-from ukbcc import db
+from ukbcc import db, bitmap
 # from ukbcc.tests import conftest as cf
 import pandas as pd
 from io import StringIO
@@ -162,7 +162,8 @@ def test_db_create(sqlite_db):#main_csv, showcase_csv, gp_csv, tmpdir):
     con = sqlite_db
     #Check we've created the right tables
     tabs=con.execute("select name from sqlite_master where type = 'table';").fetchall()
-    exp_tabs=set(["int", "str", "real", "datetime", "field_desc"])
+    exp_tabs=set(["int", "str", "real", "datetime", "field_desc", "participants", "field_stats", "value_stats",
+                  "sqlite_stat1"])
     assert set([x[0] for x in tabs]) == exp_tabs
 
     #Check some main dataset fields exist
@@ -197,9 +198,9 @@ def test_db_create_append(db_file, showcase_csv, main_append_csv):#main_csv, sho
                         showcase_file=showcase_csv,
                         step=1, append=True)
 
-    #Check we've created the right tables
+    #Check we've created the right tables. The stats tables are dropped by a refresh, as they would be out of date
     tabs=con.execute("select name from sqlite_master where type = 'table';").fetchall()
-    exp_tabs=set(["int", "str", "real", "datetime", "field_desc"])
+    exp_tabs=set(["int", "str", "real", "datetime", "field_desc", "participants", "sqlite_stat1"])
     assert set([x[0] for x in tabs]) == exp_tabs
 
     vals_6148 = con.execute("select * from str where field='6070' and value='3'").fetchall()
@@ -224,3 +225,280 @@ def test_db_main_insert(main_csv):
     main_df = pd.read_csv(main_csv, low_memory=False, encoding="ISO-8859-1", dtype=dtypes_dict, parse_dates=date_cols)
     query=db.insert_main_chunk(main_df, tab_name="datetime", tab_fields=['53-0.0', '4286-0.0'])
     print(query)
+
+
+def test_read_line_blocks(main_csv):
+    blocks = list(db.read_line_blocks(main_csv, step=4))
+    assert len(blocks) == 4
+    header = blocks[0].split('\n')[0]
+    assert all(b.startswith(header + '\n') for b in blocks)
+    #Each block holds the header plus up to step rows, quoted commas and all
+    assert sum(len(pd.read_csv(StringIO(b))) for b in blocks) == 14
+
+
+def test_read_offset_blocks(main_csv):
+    blocks = list(db.read_offset_blocks(main_csv, step=4))
+    assert [b for _, b in blocks] == list(db.read_line_blocks(main_csv, step=4))
+    #Starting from the end of a block gives the blocks after it
+    assert list(db.read_offset_blocks(main_csv, step=4, offset=blocks[1][0])) == blocks[2:]
+
+
+# Parsing in worker processes should give exactly the same rows as the serial build
+def test_db_create_parallel(main_csv, showcase_csv, gp_csv, tmpdir):
+    serial_con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_serial.sqlite")),
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2)
+    con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_parallel.sqlite")),
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2, workers=2)
+    for tab in ['str', 'int', 'real', 'datetime']:
+        exp = sorted(serial_con.execute(f"select * from {tab}").fetchall(), key=str)
+        obs = sorted(con.execute(f"select * from {tab}").fetchall(), key=str)
+        assert exp == obs
+
+
+# A bulk load gives the same rows and indexes, and hands back a database with safe settings
+def test_db_create_bulk_profile(main_csv, showcase_csv, gp_csv, tmpdir):
+    serial_con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_safe.sqlite")),
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2)
+    con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_bulk.sqlite")),
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2, profile='bulk')
+    for tab in ['str', 'int', 'real', 'datetime']:
+        exp = sorted(serial_con.execute(f"select * from {tab}").fetchall(), key=str)
+        obs = sorted(con.execute(f"select * from {tab}").fetchall(), key=str)
+        assert exp == obs
+    indexes = con.execute("select name from sqlite_master where type = 'index';").fetchall()
+    assert set([x[0] for x in indexes]) == set(["str_index", "int_index", "real_index", "dt_index"])
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+    assert con.execute("PRAGMA synchronous").fetchone()[0] == 2
+
+    #Another connection can use the database once the build has finished
+    other_con = sqlite3.connect(str(tmpdir.join("db_bulk.sqlite")))
+    assert other_con.execute("select count(*) from str").fetchone()[0] > 0
+
+
+def test_unknown_build_profile(tmpdir):
+    con = sqlite3.connect(str(tmpdir.join("db.sqlite")))
+    with pytest.raises(ValueError, match=r"Unknown build profile .*"):
+        db.set_build_profile(con, 'fastest')
+
+
+def test_column_map():
+    tab_fields = {'str': ['21017-0.0', '6148-0.1', '6148-2.12', 'read_3'], 'int': ['21003-0.0'], 'real': []}
+    column_map = db.create_column_map(tab_fields, columns=['eid', '21017-0.0', '6148-0.1', '6148-2.12', '21003-0.0'])
+    assert column_map['str']['cols'] == ['21017-0.0', '6148-0.1', '6148-2.12']
+    assert column_map['str']['field'].tolist() == [21017, 6148, 6148]
+    assert column_map['str']['time'].tolist() == [0, 0, 2]
+    assert column_map['str']['array'].tolist() == [0, 1, 12]
+    assert column_map['real']['cols'] == []
+
+
+def test_db_main_insert_triples():
+    chunk = pd.DataFrame({'eid': [1, 2, 3],
+                          '6148-0.1': ['4', None, '2'],
+                          '6148-0.2': [None, None, '5'],
+                          '21003-0.0': pd.array([55, 62, None], dtype='Int64')})
+    query, rows = db.insert_main_chunk(chunk, tab_name='str', tab_fields=['6148-0.1', '6148-0.2'])
+    assert query == 'INSERT INTO str values(?,?,?,?,?)'
+    assert rows == [(1, 6148, 0, 1, '4'), (3, 6148, 0, 1, '2'), (3, 6148, 0, 2, '5')]
+
+    query, rows = db.insert_main_chunk(chunk, tab_name='int', tab_fields=['21003-0.0'])
+    assert rows == [(1, 21003, 0, 0, 55), (2, 21003, 0, 0, 62)]
+
+
+#Fields are stored as text and instance/array as integers, whatever type they were inserted as
+def test_db_stored_types(sqlite_db):
+    types = sqlite_db.execute("select distinct typeof(field), typeof(time), typeof(array) from int").fetchall()
+    assert types == [('text', 'integer', 'integer')]
+
+
+class BuildKilled(Exception):
+    pass
+
+
+# A build killed part way through the main file can be resumed and gives the same rows as an uninterrupted one
+def test_db_create_resume(main_csv, showcase_csv, gp_csv, tmpdir, monkeypatch):
+    exp_con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_full.sqlite")),
+                     main_filename=main_csv,
+                     gp_clin_filename = gp_csv,
+                     showcase_file = showcase_csv,
+                     step=2)
+
+    write_chunk = db.write_chunk
+    n_writes = 0
+    def killed_write_chunk(*args):
+        nonlocal n_writes
+        n_writes += args[1] != 'participants'
+        if n_writes == 20:
+            raise BuildKilled()
+        return write_chunk(*args)
+    monkeypatch.setattr(db, 'write_chunk', killed_write_chunk)
+    db_file = str(tmpdir.join("db_resume.sqlite"))
+    with pytest.raises(BuildKilled):
+        db.create_sqlite_db(db_filename=db_file, main_filename=main_csv, gp_clin_filename=gp_csv,
+                            showcase_file=showcase_csv, step=2, commit_every=2)
+
+    checkpoints = db.read_checkpoints(sqlite3.connect(db_file))
+    assert checkpoints['gp_clinical']['done']
+    #Killed part way through the main file, after its 4th chunk was committed
+    end_of_chunk_4 = list(db.read_offset_blocks(main_csv, step=2))[3][0]
+    assert checkpoints['main'] == {'chunk': 4, 'byte_offset': end_of_chunk_4, 'done': False}
+
+    monkeypatch.setattr(db, 'write_chunk', write_chunk)
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=main_csv, gp_clin_filename=gp_csv,
+                              showcase_file=showcase_csv, step=2, commit_every=2, resume=True)
+    for tab in ['str', 'int', 'real', 'datetime']:
+        exp = sorted(exp_con.execute(f"select * from {tab}").fetchall(), key=str)
+        obs = sorted(con.execute(f"select * from {tab}").fetchall(), key=str)
+        assert exp == obs
+    #The finished build has no checkpoints left
+    assert db.read_checkpoints(con) == {}
+    assert len(con.execute("select name from sqlite_master where type = 'index' and sql is not null").fetchall()) == 4
+    with pytest.raises(ValueError, match='bulk'):
+        db.create_sqlite_db(db_filename=str(tmpdir.join("db_bulk.sqlite")), main_filename=main_csv,
+                            gp_clin_filename=gp_csv, showcase_file=showcase_csv, step=2, commit_every=2, profile='bulk')
+
+
+# Refreshing with a new basket replaces changed values, adds new participants and columns and leaves the rest alone
+@pytest.mark.parametrize("compact", [False, True])
+def test_db_refresh(main_csv, showcase_csv, gp_csv, tmpdir, compact):
+    showcase_file = str(tmpdir.join("showcase.csv"))
+    with open(showcase_csv) as f:
+        showcase = f.read()
+    with open(showcase_file, 'w') as f:
+        f.write(showcase + "Medical conditions,100074,20002,Non-cancer illness code self-reported,,,Complete,"
+                           "Categorical multiple,,Data,Primary,Unisex,4,34,6,,\n")
+    basket_file = str(tmpdir.join("basket.csv"))
+    with open(basket_file, 'w') as f:
+        f.write("eid,6070-0.0,6070-1.0,21003-0.0,20002-0.0\n"
+                "1037918,2,1,68,1065\n"
+                "1041796,3,,62,\n"
+                "1099999,1,,40,1065\n")
+
+    db_file = str(tmpdir.join("db.sqlite"))
+    db.create_sqlite_db(db_filename=db_file, main_filename=main_csv, gp_clin_filename=gp_csv,
+                        showcase_file=showcase_file, step=2, compact=compact)
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=basket_file, gp_clin_filename=gp_csv,
+                              showcase_file=showcase_file, step=2, append=True)
+    counts = [con.execute(f"select count(*) from {tab}").fetchone()[0] for tab in ['str', 'int', 'real', 'datetime']]
+
+    field_desc = pd.read_sql("select * from field_desc", con)
+    assert {'6070-1.0', '20002-0.0'} <= set(field_desc['field_col'])
+    assert set(field_desc[field_desc['field_col'].isin(['6070-1.0', '20002-0.0'])]['tab']) == {'str'}
+    if compact:
+        ids = field_desc.drop_duplicates('field').set_index('field')['field_id']
+        assert ids.is_unique and ids['20002'] == ids.drop('20002').max() + 1
+
+    def ids(criteria):
+        return set(db.query_sqlite_db(con=con, cohort_criteria={'all_of': criteria, 'any_of': [], 'none_of': []})['eid'])
+    assert ids([('6070', '1')]) == {1037058, 1024938, 1016017, 1038882, 1030520, 1003670, 1027017, 1037918, 1099999}
+    assert ids([('6070', '3')]) == {1041796}
+    assert ids([('21003', '67')]) == set()
+    assert ids([('21003', '68')]) == {1037918, 1033149, 1033388}
+    assert ids([('20002', '1065')]) == {1037918, 1099999}
+    #gp_clinical records already in the database aren't added again
+    assert ids([('read_2', 'XE0of')]) == {1016017}
+    assert con.execute("select count(*) from str where field in (select field_id from field_desc where "
+                       "field like 'read_%')" if compact else
+                       "select count(*) from str where field like 'read_%'").fetchone()[0] == 6
+
+    #Refreshing with the same files again changes nothing
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=basket_file, gp_clin_filename=gp_csv,
+                              showcase_file=showcase_file, step=2, append=True)
+    assert counts == [con.execute(f"select count(*) from {tab}").fetchone()[0] for tab in ['str', 'int', 'real', 'datetime']]
+
+
+def test_purge_eids(main_csv, showcase_csv, gp_csv, tmpdir):
+    db_file = str(tmpdir.join("db.sqlite"))
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=main_csv, gp_clin_filename=gp_csv,
+                              showcase_file=showcase_csv, step=2)
+    tabs = ['str', 'int', 'real', 'datetime']
+    exp = {tab: [x for x in con.execute(f"select * from {tab}").fetchall() if x[0] not in [1037918, 1016017]]
+           for tab in tabs}
+
+    deleted = db.purge_eids(db_file, ['1037918', 1016017, 1016017])
+    assert set(deleted) == set(tabs + ['participants']) and deleted['participants'] == 2
+    #The eid indexes the deletes went through are dropped again, unless asked to keep them
+    assert not db.has_eid_index(con)
+    db.purge_eids(db_file, [1], keep_eid_index=True)
+    assert db.has_eid_index(con)
+    db.purge_eids(db_file, [1])
+    assert db.has_eid_index(con)
+    for tab in tabs:
+        assert con.execute(f"select * from {tab}").fetchall() == exp[tab]
+    obs = db.query_sqlite_db(con=con, cohort_criteria={'all_of': [], 'any_of': [('read_2', "XE0of"), ('read_3', 'XE0Gu')],
+                                                       'none_of': []})
+    assert obs.empty
+
+
+#Stats are only rebuilt on request after a refresh or a purge, which would otherwise read the whole database again
+def test_refresh_stats(main_csv, showcase_csv, main_append_csv, tmpdir):
+    db_file = str(tmpdir.join("db.sqlite"))
+    db.create_sqlite_db(db_filename=db_file, main_filename=main_csv, gp_clin_filename='', showcase_file=showcase_csv,
+                        step=2).close()
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=main_append_csv, gp_clin_filename='',
+                              showcase_file=showcase_csv, step=2, append=True, stats=True)
+    n_eids = lambda: con.execute("select n_eids from field_stats where field='6070' and instance=-1").fetchone()[0]
+    before = n_eids()
+    assert before == db.count_cohort({'all_of': [('6070', 'nan')]}, con=con)
+    eid = con.execute("select eid from str where field='6070'").fetchone()[0]
+    db.purge_eids(db_file, [eid])
+    assert n_eids() == before
+    db.purge_eids(db_file, [], stats=True)
+    assert n_eids() == before - 1
+
+
+#Participants without a height are still in the universe of none_of queries
+def test_participants_table(main_csv, showcase_csv, main_append_csv, tmpdir):
+    no_height_csv = str(tmpdir.join("ukb_no_height.csv"))
+    with open(main_csv) as f:
+        main = f.read()
+    with open(no_height_csv, 'w') as f:
+        f.write(main.replace('2010-06-28T12:31:51,168,', '2010-06-28T12:31:51,,'))
+    db_file = str(tmpdir.join("db.sqlite"))
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=no_height_csv, gp_clin_filename='',
+                              showcase_file=showcase_csv, step=2, withdrawn_eids=[1030520])
+    eids = set(pd.read_csv(main_csv)['eid'])
+    assert set(x[0] for x in con.execute('select eid from participants')) == eids
+    assert con.execute('select eid from participants where withdrawn=1').fetchall() == [(1030520,)]
+
+    criteria = {'all_of': [], 'any_of': [], 'none_of': [('6070', '1')]}
+    exp = {1037918, 1033149, 1033388, 1031625, 1031595, 1008947}
+    assert set(db.query_sqlite_db(criteria, con=con)['eid']) == exp
+    assert set(db.query_sqlite_db(criteria, con=con, wide=True)['eid']) == exp
+    assert db.count_cohort(criteria, con=con) == len(exp)
+    assert bitmap.EidBitmapIndex(con=con).count(criteria) == len(exp)
+    assert 'participants' in db.compile_cohort_query(criteria, db.load_field_metadata(con))
+    #Databases without the table fall back to everyone with a height
+    field_desc = pd.read_sql('select * from field_desc', con)
+    assert set(x[0] for x in con.execute(db.compile_cohort_query(criteria, field_desc))) == exp - {1008947}
+
+    #Refreshing a database built without the table fills it from the value tables
+    con.execute('drop table participants')
+    con.commit()
+    con = db.create_sqlite_db(db_filename=db_file, main_filename=main_append_csv, gp_clin_filename='',
+                              showcase_file=showcase_csv, step=2, append=True)
+    assert set(x[0] for x in con.execute('select eid from participants')) == eids | {1037912}
+
+
+def test_insert_participants_chunk():
+    chunk = pd.DataFrame({'eid': [1, 2], '31-0.0': [0.0, None]})
+    query, rows = db.insert_participants_chunk(chunk)
+    assert rows == [(1, 0), (2, None)]
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE participants (eid INTEGER PRIMARY KEY, sex INTEGER, withdrawn INTEGER DEFAULT 0)')
+    con.executemany(query, rows)
+    #A basket without sex leaves it as it was
+    con.executemany(query, db.insert_participants_chunk(pd.DataFrame({'eid': [1]}))[1])
+    assert db.mark_withdrawn(con, [2, 3]) == 1
+    assert con.execute('select * from participants').fetchall() == [(1, 0, 0), (2, None, 1)]
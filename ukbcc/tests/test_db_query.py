@@ -1,8 +1,11 @@
 import pytest
-from ukbcc import db 
+from ukbcc import db, bitmap
+from ukbcc import filter as ukbcc_filter
 import pandas as pd
 from io import StringIO
 import re
+import shutil
+import sqlite3
 
 def test_create_query_tuples(field_desc):
     cohort_criteria = {'all_of': [('6070', '1')], 'any_of': [], 'none_of': []}
@@ -287,3 +290,354 @@ def test_db_empty_query(sqlite_db):
     obs=db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria)    
     exp_ids = set([])
     assert exp_ids == set(obs['eid'].tolist())
+
+
+#The compact schema and clustered layout should answer every query the same way as the original one
+layout_queries = [
+    ({'all_of': [('6070', "1")], 'any_of': [], 'none_of': []},
+     [1041796, 1037058, 1024938, 1016017, 1038882, 1030520, 1003670, 1027017]),
+    ({'all_of': [('6148', "4")], 'any_of': [], 'none_of': [("6070", "2")]},
+     [1033149, 1016017, 1033388, 1030520, 1003670]),
+    ({'all_of': [('6070', "nan")], 'any_of': [], 'none_of': []},
+     [1003670, 1016017, 1024938, 1027017, 1030520, 1037058, 1037918, 1038882, 1041796]),
+    ({'all_of': [('41270', "Block H40-H42")], 'any_of': [], 'none_of': []}, [1033149, 1041796]),
+    ({'all_of': [], 'any_of': [('read_2', "XE0of"), ('read_3', 'XE0Gu')], 'none_of': []}, [1016017, 1037918]),
+    ({'all_of': [('21003', "55")], 'any_of': [('50', 'nan')], 'none_of': []}, [1024938, 1031625, 1003670, 1027017]),
+    ({'any_of': [('41270', "Block H40-H42"), ('6119', "3"), ('6148', '4')], 'all_of': [('6070', "1")],
+      'none_of': [('read_2', "XE0of")]}, [1041796, 1037058, 1030520, 1003670]),
+]
+
+
+@pytest.mark.parametrize("cohort_criteria,exp_ids", layout_queries)
+def test_db_layout_query(layout_db, cohort_criteria, exp_ids):
+    obs = db.query_sqlite_db(con=layout_db, cohort_criteria=cohort_criteria)
+    assert set(exp_ids) == set(obs['eid'].tolist())
+
+
+@pytest.mark.parametrize('layout_db', ['compact'], indirect=True)
+def test_db_compact_values(layout_db):
+    obs = db.query_sqlite_db(con=layout_db, cohort_criteria={'all_of': [('6148', "4")], 'any_of': [], 'none_of': []}, wide=True)
+    assert obs.set_index('eid').loc[1030520].tolist() == ['4', None]
+    assert list(obs.columns) == ['eid', 'f6148-0.1', 'f6148-0.2']
+
+
+@pytest.mark.parametrize('layout_db', ['compact'], indirect=True)
+def test_db_compact_schema(layout_db):
+    types = layout_db.execute("select distinct typeof(field), typeof(time), typeof(array), typeof(value) from str").fetchall()
+    assert types == [('integer', 'integer', 'integer', 'integer')]
+    #Each distinct string is stored once
+    n_values = layout_db.execute("select count(*) from str_values").fetchone()[0]
+    n_distinct = layout_db.execute("select count(distinct value) from str").fetchone()[0]
+    assert n_values == n_distinct
+
+
+@pytest.mark.parametrize('layout_db', ['clustered'], indirect=True)
+def test_db_clustered_layout(layout_db, field_desc):
+    #The tables are their own index
+    indexes = layout_db.execute("select name from sqlite_master where type = 'index' and sql is not null").fetchall()
+    assert indexes == []
+    assert db.is_clustered(layout_db)
+    query_tuples = [{'field':'6070', 'val':'1', 'tab':'str'}, {'field':'read_3', 'val':'229..', 'tab':'str'}]
+    plan = layout_db.execute("explain query plan " + db.tab_select('str', query_tuples, field_desc)).fetchall()
+    assert all('PRIMARY KEY' in x[-1] for x in plan if x[-1].startswith('SEARCH'))
+
+
+@pytest.mark.parametrize('layout_db', ['gp_table'], indirect=True)
+def test_db_gp_table(layout_db):
+    #No gp_clinical records are left in the str table
+    assert layout_db.execute("select count(*) from str where field like 'read_%'").fetchone()[0] == 0
+    rows = layout_db.execute("select * from gp_clinical where eid=1016017 order by event_dt").fetchall()
+    #24/12/1964 and 31/10/1967 as days since 1970
+    assert rows == [(1016017, 3, -1834, 'XE0of', None, None, None, None),
+                    (1016017, 3, -793, 'XE0of', None, '1.0', '2.0', '3.0')]
+    #A purely numeric code stays a string
+    assert layout_db.execute("select read_2 from gp_clinical where eid=1041796").fetchall() == [('4662.',)]
+
+
+@pytest.mark.parametrize('layout_db', ['gp_table'], indirect=True)
+def test_db_gp_table_select(layout_db):
+    field_desc = pd.read_sql("select * from field_desc", layout_db)
+    query_tuples = db.create_query_tuples({'all_of': [('read_2', 'XE0of'), ('read_3', 'XE0Gu'), ('6070', '1')]}, field_desc)
+    obs_query = db.tab_select('gp_clinical', query_tuples, field_desc)
+    exp_query = ("select eid, 'read_2' as field, event_dt as time, 0 as array, read_2 as value from gp_clinical where read_2='XE0of' union "
+                 "select eid, 'read_3' as field, event_dt as time, 0 as array, read_3 as value from gp_clinical where read_3='XE0Gu'")
+    assert obs_query == exp_query
+    plan = layout_db.execute("explain query plan " + obs_query).fetchall()
+    assert {'gp_read_2_index', 'gp_read_3_index'} <= set(re.findall('gp_read_[23]_index', str(plan)))
+
+
+@pytest.mark.parametrize('layout_db', ['gp_table'], indirect=True)
+def test_query_gp_clinical_events(layout_db):
+    obs = db.query_gp_clinical_events(['XE0of', '4662.'], con=layout_db)
+    assert sorted(obs['eid'].tolist()) == [1016017, 1016017, 1041796]
+    obs = db.query_gp_clinical_events(['XE0of', '4662.'], start='1965-01-01', end='1967-12-31', con=layout_db)
+    assert obs['eid'].tolist() == [1016017, 1041796]
+    assert obs['event_dt'].dt.strftime('%d/%m/%Y').tolist() == ['31/10/1967', '21/09/1966']
+    plan = layout_db.execute("explain query plan select * from gp_clinical where read_3=? and event_dt >= 0",
+                               ('XE0Gu',)).fetchall()
+    assert 'gp_read_3_index (read_3=? AND event_dt>?)' in str(plan)
+
+
+def test_compile_cohort_query(field_desc):
+    cohort_criteria = {'all_of': [('6070', '1'), ('21003', 'nan')], 'any_of': [('6148', '4'), ('read_3', '229..')],
+                       'none_of': [('41270', 'H402')]}
+    obs = db.compile_cohort_query(cohort_criteria, field_desc)
+    exp = ("select eid from str where field='6070' and value ='1' intersect "
+           "select eid from int where field='21003' and value is not NULL intersect "
+           "select eid from (select eid from str where field='6148' and value ='4' union "
+           "select eid from str where field='read_3' and value ='229..') except "
+           "select eid from str where field='41270' and value ='H402'")
+    assert obs == exp
+
+
+def test_compile_cohort_query_none_only(field_desc):
+    obs = db.compile_cohort_query({'all_of': [], 'any_of': [], 'none_of': [('6070', '1'), ('6070', '2')]}, field_desc)
+    exp = ("select eid from real where field='50' and value is not NULL except "
+           "select eid from str where field='6070' and value ='1' except "
+           "select eid from str where field='6070' and value ='2'")
+    assert obs == exp
+
+
+#The set operations should find the same participants as pivoting
+@pytest.mark.parametrize("cohort_criteria", [q[0] for q in layout_queries] + [
+    {'all_of': [], 'any_of': [], 'none_of': [('6070', "1")]},
+    {'all_of': [('6148', "4")], 'any_of': [], 'none_of': [("6070", "2"), ("6070", "1")]},
+    {'all_of': [], 'any_of': [('6070', "1"), ('6119', "1")], 'none_of': [('21003', '55')]},
+])
+def test_db_sets_match_pivot(sqlite_db, cohort_criteria):
+    obs = db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria)
+    exp = db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria, wide=True)
+    assert list(obs.columns) == ['eid']
+    assert set(obs['eid']) == set(exp['eid'])
+
+
+def test_db_query_eids_list(sqlite_db):
+    cohort_criteria = {'all_of': [('6070', "1")], 'any_of': [], 'none_of': []}
+    obs = db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria, eids_list=[1041796, 1037918, 1016017])
+    assert set(obs['eid']) == {1041796, 1016017}
+
+
+def test_field_metadata(field_desc):
+    meta = db.FieldMetadata(field_desc)
+    assert meta.tab['6070'] == 'str' and meta.sql_type['21003'] == 'INTEGER'
+    assert db.expand_field('6070', meta) == db.expand_field('6070', field_desc)
+    cohort_criteria = {'all_of': [('6070', '1'), ('21003', 'nan')], 'any_of': [('read_3', '229..')],
+                       'none_of': [('41270', 'H402')]}
+    assert db.compile_cohort_query(cohort_criteria, meta) == db.compile_cohort_query(cohort_criteria, field_desc)
+    query_tuples = db.create_query_tuples(cohort_criteria, meta)
+    assert db.pivot_results(meta, query_tuples) == db.pivot_results(field_desc, query_tuples)
+    with pytest.raises(ValueError):
+        db.is_varchar('f9999', meta)
+
+
+#field_desc is read once per database and again when the file changes
+def test_load_field_metadata(db_file, tmp_path):
+    db_copy = str(tmp_path / 'db.sqlite')
+    shutil.copy(db_file, db_copy)
+    con = sqlite3.connect(db_copy)
+    meta = db.load_field_metadata(con)
+    assert db.load_field_metadata(con) is meta
+    con.execute("UPDATE field_desc SET sql_type='VARCHAR' WHERE field='21003'")
+    con.commit()
+    updated = db.load_field_metadata(con)
+    assert updated is not meta and updated.sql_type['21003'] == 'VARCHAR'
+    con.close()
+
+
+@pytest.mark.parametrize("cohort_criteria,exp_ids", layout_queries)
+def test_count_cohort(db_file, cohort_criteria, exp_ids):
+    assert db.count_cohort(cohort_criteria, db_filename=db_file) == len(exp_ids)
+    index = bitmap.EidBitmapIndex(db_file)
+    assert db.count_cohort(cohort_criteria, db_filename=db_file, bitmap_index=index) == len(exp_ids)
+    assert index.misses > 0
+
+
+def test_count_cohort_empty(sqlite_db):
+    assert db.count_cohort({'all_of': [], 'any_of': [], 'none_of': []}, con=sqlite_db) == 0
+
+
+def test_compile_cohort_query_eids_table(field_desc):
+    obs = db.compile_cohort_query({'all_of': [('6070', '1')], 'any_of': [], 'none_of': [('read_3', '229..')]},
+                                  field_desc, 'query_eids')
+    exp = ("select eid from str where (field='6070' and value ='1') and eid in (select eid from temp.query_eids) "
+           "except select eid from str where (field='read_3' and value ='229..') and eid in "
+           "(select eid from temp.query_eids)")
+    assert obs == exp
+
+
+#The restriction to eids_list happens in SQL, for the wide query as well, and the temp table is dropped after
+@pytest.mark.parametrize("wide", [False, True])
+def test_db_query_eids_list_in_sql(sqlite_db, wide):
+    cohort_criteria = {'all_of': [], 'any_of': [], 'none_of': [('6070', "1")]}
+    eids = [1041796, 1037918, 1016017]
+    obs = db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria, eids_list=eids, wide=wide)
+    exp = db.query_sqlite_db(con=sqlite_db, cohort_criteria=cohort_criteria, wide=wide)
+    assert set(obs['eid']) == set(exp['eid']) & set(eids)
+    assert 'query_eids' not in [x[0] for x in sqlite_db.execute("SELECT name FROM sqlite_temp_master").fetchall()]
+    query = db.pivot_query(cohort_criteria, db.load_field_metadata(sqlite_db), 'query_eids')
+    assert query.count('temp.query_eids') == 2
+
+
+def test_load_eids_table_read_only(db_file):
+    con = db.connection.connect_read_only(db_file)
+    db.load_eids_table(con, [1041796, 1041796, 1037918])
+    assert con.execute('select count(*) from temp.query_eids').fetchone()[0] == 2
+    assert con.execute('PRAGMA query_only').fetchone()[0] == 1
+    db.drop_eids_table(con)
+    con.close()
+
+
+range_queries = [
+    ({'all_of': [('41270', ('prefix', 'E1'))], 'any_of': [], 'none_of': []}, [1037918, 1016017]),
+    ({'all_of': [('21003', ('>=', '68'))], 'any_of': [], 'none_of': []}, [1033149, 1033388, 1030520]),
+    ({'all_of': [('21003', ('<', 52))], 'any_of': [], 'none_of': []}, [1037058, 1016017, 1031595]),
+    ({'all_of': [('50', ('between', '180', '189'))], 'any_of': [], 'none_of': []},
+     [1033149, 1016017, 1033388, 1027017]),
+    ({'all_of': [('53', ('between', '2010-04-20', '2010-04-30'))], 'any_of': [], 'none_of': []}, [1016017, 1031595]),
+    ({'all_of': [], 'any_of': [('read_3', ('prefix', 'XE')), ('read_2', ('prefix', 'XE0'))], 'none_of': []},
+     [1037918, 1016017]),
+    ({'all_of': [('41270', ('prefix', 'H'))], 'any_of': [], 'none_of': [('21003', ('>', '60'))]},
+     [1024938, 1031625, 1003670, 1008947]),
+]
+
+
+@pytest.mark.parametrize("cohort_criteria,exp_ids", range_queries)
+def test_db_range_query(layout_db, cohort_criteria, exp_ids):
+    con = layout_db
+    obs = db.query_sqlite_db(con=con, cohort_criteria=cohort_criteria)
+    assert set(obs['eid']) == set(exp_ids)
+    wide = db.query_sqlite_db(con=con, cohort_criteria=cohort_criteria, wide=True)
+    assert set(wide['eid']) == set(exp_ids)
+    assert db.count_cohort(cohort_criteria, con=con) == len(exp_ids)
+
+
+def test_range_condition(field_desc):
+    assert (db.value_condition('value', {'field': '41270', 'val': ('prefix', 'E1'), 'tab': 'str'}, field_desc) ==
+            "value >= 'E1' and value < 'E2'")
+    assert (db.value_condition('value', {'field': '21003', 'val': ('between', '50', '60'), 'tab': 'int'}, field_desc)
+            == "value between 50 and 60")
+    assert db.value_condition('value', {'field': '21003', 'val': ['>=', 50], 'tab': 'int'}, field_desc) == "value >= 50"
+    with pytest.raises(ValueError):
+        db.value_condition('value', {'field': '21003', 'val': ('>=', '50; drop'), 'tab': 'int'}, field_desc)
+    with pytest.raises(ValueError):
+        db.value_condition('value', {'field': '21003', 'val': ('prefix', '5'), 'tab': 'int'}, field_desc)
+    with pytest.raises(ValueError):
+        db.value_condition('value', {'field': '21003', 'val': ('~', '5'), 'tab': 'int'}, field_desc)
+
+
+#A range is one range scan of the (field, value, ...) index
+def test_range_query_plan(sqlite_db):
+    qt = db.create_query_tuples({'all_of': [('50', ('>=', '180'))]}, db.load_field_metadata(sqlite_db))[0]
+    plan = sqlite_db.execute('EXPLAIN QUERY PLAN ' + db.criterion_select(qt, db.load_field_metadata(sqlite_db))).fetchall()
+    assert 'real_index (field=? AND value>?)' in str(plan)
+
+
+@pytest.mark.parametrize("text,exp", [('between 25 and 30', ('between', '25', '30')), ('>=30', ('>=', '30')),
+                                      ('< 2010-01-01', ('<', '2010-01-01')), ('E11*', ('prefix', 'E11')),
+                                      ('229..', '229..'), ('-1', '-1'), ('Block H40-H42', 'Block H40-H42'),
+                                      ('descendants of Block H40-H42', ('descendants', 'Block H40-H42'))])
+def test_parse_value(text, exp):
+    assert ukbcc_filter.parse_value(text) == exp
+
+
+def test_coding_parents():
+    parents = db.coding_parents(['Chapter VII', 'Block H40-H42', 'H40', 'H400', 'H42', 'Block E10-E14', 'E11'])
+    assert parents == {'H40': 'Block H40-H42', 'H400': 'H40', 'H42': 'Block H40-H42', 'E11': 'Block E10-E14'}
+    assert db.read_code_parent('XE0Gu') == 'XE0G.'
+    assert db.read_code_parent('229..') == '22...'
+    assert db.read_code_parent('2....') is None
+    pairs = db.closure_pairs({'H400': 'H40', 'H40': 'Block H40-H42'})
+    assert ('Block H40-H42', 'H400') in pairs and ('H400', 'H400') in pairs and ('H400', 'H40') not in pairs
+
+
+closure_queries = [
+    ({'all_of': [('41270', ('descendants', 'Block H40-H42'))], 'any_of': [], 'none_of': []},
+     [1041796, 1033149, 1008947, 1030520]),
+    ({'all_of': [], 'any_of': [('41270', ('descendants', 'Block E10-E14')), ('read_3', ('descendants', '2....'))],
+      'none_of': []}, [1037918, 1016017]),
+    ({'all_of': [('read_2', ('descendants', 'XE...'))], 'any_of': [], 'none_of': []}, [1016017]),
+    ({'all_of': [('21003', ('>=', '60'))], 'any_of': [], 'none_of': [('41270', ('descendants', 'H40'))]},
+     [1037918, 1041796, 1033149, 1033388, 1038882]),
+]
+
+
+@pytest.mark.parametrize("cohort_criteria,exp_ids", closure_queries)
+def test_db_closure_query(closure_db, cohort_criteria, exp_ids):
+    obs = db.query_sqlite_db(con=closure_db, cohort_criteria=cohort_criteria)
+    assert set(obs['eid']) == set(exp_ids)
+    wide = db.query_sqlite_db(con=closure_db, cohort_criteria=cohort_criteria, wide=True)
+    assert set(wide['eid']) == set(exp_ids)
+
+
+def test_db_closure_table(closure_db):
+    descendants = closure_db.execute("select descendant from code_closure where field='41270' and "
+                                     "ancestor='Block E10-E14'").fetchall()
+    assert sorted(x[0] for x in descendants) == ['Block E10-E14', 'E11', 'E119', 'E14', 'E148']
+    # Ancestors of the read codes in the data are there as well
+    assert closure_db.execute("select count(*) from code_closure where field='read_3' and ancestor='F....' "
+                              "and descendant='F45..'").fetchone()[0] == 1
+
+
+#Counts from the stats tables match the data, whatever the layout
+def test_criterion_counts(layout_db):
+    con = layout_db
+    criteria = {'all_of': [('6070', '1'), ('21003', '55'), ('21003', '55.0'), ('read_2', 'XE0of'), ('6070', 'X'),
+                           ('50', ('>=', '180')), ('6070', 'nan')], 'any_of': [], 'none_of': []}
+    assert db.criterion_counts(con, criteria) == {('6070', '1'): 8, ('21003', '55'): 4, ('21003', '55.0'): 4,
+                                                  ('read_2', 'XE0of'): 1, ('6070', 'X'): 0, ('50', ('>=', '180')): 14,
+                                                  ('6070', 'nan'): 9}
+    assert con.execute("select n_eids, n_values, min_value, median, max_value from field_stats where field='50' and "
+                       "instance=-1").fetchone() == (14, 13, 142, 168, 189)
+    assert con.execute("select n_eids from field_stats where field='6070' and instance=0").fetchone() == (9,)
+    assert con.execute("select count(*) from field_stats where field='read_2'").fetchone() == (1,)
+
+
+#The most selective all_of criterion is intersected first, and a cohort with an empty criterion isn't queried
+def test_compile_with_counts(sqlite_db):
+    field_desc = db.load_field_metadata(sqlite_db)
+    criteria = {'all_of': [('6070', '1'), ('read_2', 'XE0of')], 'any_of': [], 'none_of': []}
+    query = db.compile_cohort_query(criteria, field_desc, counts=db.criterion_counts(sqlite_db, criteria))
+    assert query.index("'XE0of'") < query.index("'6070'")
+    empty = {'all_of': [('6070', '1')], 'any_of': [('6070', 'X'), ('6119', 'X')], 'none_of': []}
+    assert db.compile_cohort_query(empty, field_desc, counts=db.criterion_counts(sqlite_db, empty)) == db.empty_cohort_query
+    assert db.query_sqlite_db(empty, con=sqlite_db).empty
+    assert db.count_cohort(empty, con=sqlite_db) == 0
+
+
+def test_add_participant_counts(sqlite_db):
+    candidate_df = pd.DataFrame({'FieldID': ['6070', '6070', '50', 'read_2', '99999'],
+                                 'Value': ['1', '9', None, 'XE0of', '1']})
+    counts = ukbcc_filter.add_participant_counts(candidate_df, sqlite_db)['Participants']
+    assert counts.tolist()[:4] == [8, 0, 14, 1] and pd.isna(counts.iloc[4])
+
+
+#A participant's rows come out the same whatever the layout, read through the eid indexes when there are any
+def test_extract_participants(layout_db, sqlite_db):
+    con = layout_db
+    eids = [1016017, 1008947, 1]
+    exp = pd.concat([pd.read_sql(f"select * from {tab} where eid in (1016017, 1008947)", sqlite_db)
+                     for tab in ['str', 'int', 'real', 'datetime']])
+    obs = db.extract_participants(eids, con=con)
+    #Read code event dates are day numbers in some layouts
+    rows = lambda df: sorted(map(str, df[~df['field'].str.startswith('read')].itertuples(index=False)))
+    events = lambda df: sorted(map(str, df[df['field'].str.startswith('read')][['eid', 'field', 'value']].itertuples(index=False)))
+    assert rows(obs) == rows(exp) and events(obs) == events(exp) and len(events(obs)) > 0
+    obs = db.extract_participants(eids, fields=['6148', 'read_2'], con=con)
+    assert set(obs['field']) == {'6148', 'read_2'} and set(obs[obs['field'] == 'read_2']['eid']) == {1016017}
+
+    wide = db.extract_participants(eids, fields=['50', '6148', 'read_2', '6119'], con=con, wide=True)
+    assert wide.columns.tolist() == ['eid', 'f50-0.0', 'f6148-0.1', 'f6148-0.2', 'f6119-0.0']
+    assert wide.set_index('eid').loc[1016017, ['f50-0.0', 'f6148-0.1', 'f6148-0.2']].tolist() == [189, '4', '6']
+    with pytest.raises(ValueError, match=r"DoesNotExist .*"):
+        db.extract_participants(eids, fields=['DoesNotExist'], con=con)
+
+
+def test_extract_participants_eid_index(main_csv, showcase_csv, gp_csv, tmpdir):
+    con = db.create_sqlite_db(db_filename=str(tmpdir.join("db_eid_index.sqlite")), main_filename=main_csv,
+                              gp_clin_filename=gp_csv, showcase_file=showcase_csv, step=2, eid_index=True)
+    assert db.has_eid_index(con)
+    db.load_eids_table(con, [1016017], name='extract_eids')
+    for query in db.extract_queries(['6148', '50'], db.load_field_metadata(con), 'extract_eids'):
+        plan = con.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+        assert 'SCAN e' in str(plan) and '_eid_index (eid=?' in str(plan)
+    assert set(db.extract_participants([1016017], con=con)['field']) >= {'50', '6148', 'read_2'}
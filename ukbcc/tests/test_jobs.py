@@ -0,0 +1,121 @@
+import pytest
+from ukbcc import db, connection, jobs, bitmap
+import pandas as pd
+import threading
+import time
+
+# A query that runs until it is interrupted
+endless_query = 'with recursive r(i) as (select 1 union all select i + 1 from r) select count(*) from r'
+
+
+def wait(job, timeout=10):
+    job.future.result(timeout=timeout)
+    return job.progress()
+
+
+def test_job_runs_query(db_file):
+    runner = jobs.JobRunner(max_workers=1)
+    def fn(job):
+        with job.watch(connection.get_connection(db_file)):
+            job.stage('cohort')
+            res = db.query_sqlite_db({'all_of': [('50', 'nan')]}, db_filename=db_file)
+            job.stage('count')
+            return res['eid'].tolist(), db.count_cohort({'all_of': [('50', 'nan')]}, db_filename=db_file)
+    job_id = runner.submit(fn, stages=['cohort', 'count'])
+    progress = wait(runner.get(job_id))
+    assert progress['status'] == 'done' and progress['fraction'] == 1.0 and progress['stage'] == 'count'
+    ids, n = runner.get(job_id).result
+    assert len(ids) == n > 0
+    runner.shutdown()
+
+
+#Cancelling interrupts the running query, and the pooled connection is left usable without a progress handler
+def test_cancel_running_query(db_file):
+    runner = jobs.JobRunner(max_workers=1)
+    cons = []
+    started = threading.Event()
+    def fn(job):
+        con = connection.get_connection(db_file)
+        cons.append(con)
+        with job.watch(con):
+            job.stage('endless')
+            started.set()
+            return con.execute(endless_query).fetchone()
+    job_id = runner.submit(fn, stages=['endless'])
+    assert started.wait(10)
+    while runner.progress(job_id)['steps'] == 0:
+        time.sleep(0.01)
+    assert runner.cancel(job_id)
+    progress = wait(runner.get(job_id))
+    assert progress['status'] == 'cancelled' and progress['steps'] > 0
+    assert not runner.cancel(job_id)
+    reuse = runner.executor.submit(lambda: cons[0].execute('select count(*) from str').fetchone()[0]).result(10)
+    assert reuse > 0
+    runner.shutdown()
+
+
+#pandas wraps the interrupted query's error in its own DatabaseError, which is still a cancellation
+def test_cancel_read_sql(db_file):
+    runner = jobs.JobRunner(max_workers=1)
+    def fn(job):
+        con = connection.get_connection(db_file)
+        with job.watch(con):
+            job.stage('endless')
+            return pd.read_sql(endless_query, con)
+    job_id = runner.submit(fn, stages=['endless'])
+    while runner.progress(job_id)['steps'] == 0:
+        time.sleep(0.01)
+    assert runner.cancel(job_id)
+    progress = wait(runner.get(job_id))
+    assert progress['status'] == 'cancelled' and progress['error'] is None
+    runner.shutdown()
+
+
+#Bitmaps are loaded on the job's watched connection, so a slow load is cancelled too
+def test_cancel_bitmap_load(db_file, monkeypatch):
+    monkeypatch.setattr(db, 'criterion_select', lambda qt, field_desc: endless_query.replace('count(*)', 'i'))
+    runner = jobs.JobRunner(max_workers=1)
+    def fn(job):
+        with job.watch(connection.get_connection(db_file)):
+            job.stage('bitmaps')
+            return bitmap.EidBitmapIndex(db_file).bitmap('6070', '1')
+    job_id = runner.submit(fn, stages=['bitmaps'])
+    while runner.progress(job_id)['steps'] == 0:
+        time.sleep(0.01)
+    assert runner.cancel(job_id)
+    assert wait(runner.get(job_id))['status'] == 'cancelled'
+    runner.shutdown()
+
+
+def test_cancel_queued_job():
+    runner = jobs.JobRunner(max_workers=1)
+    release = threading.Event()
+    blocking = runner.submit(lambda job: release.wait(10))
+    queued = runner.submit(lambda job: 'ran')
+    assert runner.cancel(queued)
+    release.set()
+    assert wait(runner.get(blocking))['status'] == 'done'
+    assert runner.progress(queued)['status'] == 'cancelled'
+    assert runner.get(queued).result is None
+    runner.shutdown()
+
+
+def test_job_error():
+    runner = jobs.JobRunner(max_workers=1)
+    job_id = runner.submit(lambda job: 1 / 0)
+    progress = wait(runner.get(job_id))
+    assert progress['status'] == 'error' and 'division' in progress['error']
+    assert runner.progress('missing') is None and not runner.cancel('missing')
+    runner.shutdown()
+
+
+def test_runner_forgets_old_jobs():
+    runner = jobs.JobRunner(max_workers=2, keep=2)
+    release = threading.Event()
+    running = runner.submit(lambda job: release.wait(10))
+    finished = runner.submit(lambda job: None)
+    wait(runner.get(finished))
+    runner.submit(lambda job: None)
+    assert runner.get(finished) is None and runner.get(running) is not None
+    release.set()
+    runner.shutdown()
@@ -10,7 +10,7 @@ from dash.exceptions import PreventUpdate
 import os
 import json
 import ukbcc
-from ukbcc import query, utils
+from ukbcc import query, utils, connection
 
 db_path_input = dbc.FormGroup([
         dbc.Label("SQLite Database (path)", html_for={"type": "config_input","name":"db_path"}),
@@ -25,6 +25,15 @@ db_path_input = dbc.FormGroup([
                 )
 ])
 
+db_immutable_input = dbc.FormGroup([
+        dbc.Checklist(options=[{"label": "Serve the database read-only and immutable", "value": "immutable"}],
+                      value=[], id={"type": "config_input", "name": "db_immutable"}, switch=True, persistence=True,
+                      style={"margin": "5px"}),
+        dbc.FormText("For databases on network filesystems such as Lustre or NFS: the database is opened without file "
+                     "locking or checks for changes. It must not be rebuilt or refreshed while the app is running.",
+                     color="secondary")
+])
+
 # gp_path_input = dbc.FormGroup([
 #         dbc.Label("GP Dataset File", html_for={"type": "config_input", "name":"gp_path"}),
 #         dbc.Input(placeholder="Specify the name and path to GP data file e.g /data/gp_clinical.txt", type="text", id={"type": "config_input", "name":"gp_path"}, persistence=True),
@@ -103,6 +112,7 @@ tab = dbc.FormGroup(
             html.H3("Settings", className="card-text"),
             html.H4("File Paths"),
             dbc.Form([db_path_input,
+                      db_immutable_input,
                       showcase_path_input,
                       codings_path_input,
                       readcodes_path_input]),
@@ -119,6 +129,20 @@ def toggle_modals(n1: int, n2: int, is_open: bool):
         return not is_open
     return is_open
 
+def apply_db_config(config: dict):
+    """Serve the configured database immutable or not, as chosen in the config. The mode holds for the whole server
+    process, so it is set when the config is saved (or at startup with --immutable), not by each query; setting it
+    to what it already is does nothing.
+
+    Keyword arguments:
+    ------------------
+    config: dict
+        config_store store
+    """
+    db_path = config.get('db_path')
+    if db_path and os.path.exists(db_path) and config.get('db_immutable') is not None:
+        connection.set_immutable(db_path, 'immutable' in config['db_immutable'])
+
 def check_path_exists(path: str):
     if path:
         is_path = os.path.exists(path)
@@ -206,7 +230,8 @@ def save_config_handler(values: str, n_click: int, config_init: dict):
     """
     ctx = dash.callback_context
 
-    if not ctx.triggered or not ctx.triggered[0]['value']:
+    # An unticked checklist is an empty list, which is still a change to save
+    if not ctx.triggered or ctx.triggered[0]['value'] in [None, '']:
         raise PreventUpdate
 
     config = config_init or {}
@@ -220,5 +245,7 @@ def save_config_handler(values: str, n_click: int, config_init: dict):
             config_id_dict = field
             if 'value' in config_id_dict:
                 config[config_id_dict['id']['name']]=config_id_dict['value']
+        # Only saving the config changes how the database is opened
+        apply_db_config(config)
         return config
     return config
@@ -9,6 +9,7 @@ import os
 import pandas as pd
 import dash_table
 from ukbcc import filter as ukbcc_filter
+from ukbcc import connection
 import json
 import configparser
 from dash.exceptions import PreventUpdate
@@ -170,6 +171,9 @@ def search_kw_button(_: int, config: dict, search_terms: list, kw_search: dict):
                                            coding_filename=coding_filename,
                                            readcode_filename=readcode_filename)
     candidate_df = ukbcc_filter.construct_candidate_df(searchable_df=search_df, search_terms=search_terms)
+    #Show how many participants have each candidate, from the database's precomputed counts
+    if config.get('db_path') and os.path.exists(config['db_path']):
+        candidate_df = ukbcc_filter.add_participant_counts(candidate_df, connection.get_connection(config['db_path']))
     if not search_terms:
         search_terms = []
     return (candidate_df.to_json()), (search_terms)
@@ -194,7 +198,9 @@ def show_candidates(ts, candidate_df_json):
                 dbc.Col([
                     html.Div([
                     dbc.Button("Select All", id={'type':'select_btn', 'name':'select'}, style={"margin": "5px"}),
-                    dbc.Button("Deselect All", id={'type':'select_btn', 'name':'deselect'}, style={"margin": "5px"})
+                    dbc.Button("Deselect All", id={'type':'select_btn', 'name':'deselect'}, style={"margin": "5px"}),
+                    dbc.FormText("Values can be edited to a range: 'between 25 and 30', '>=30', '<30', or a code "
+                                 "prefix such as 'E11*'", color="secondary")
                     # dbc.Button("Return selected fields", id={'modal_ctrl':'none', 'name':'return_rows'})
                     ])
                 ])
@@ -210,7 +216,7 @@ def show_candidates(ts, candidate_df_json):
                         style_cell_conditional = [
                                 {'if': {'column_id':'Value'}, 'width': '50px'}
                         ],
-                            columns=[{"name": i, "id": i} for i in candidate_df.columns],
+                            columns=[{"name": i, "id": i, "editable": i == 'Value'} for i in candidate_df.columns],
                         data=candidate_df.to_dict('records'),
                         row_selectable='multi',
                         filter_action='native',
@@ -8,11 +8,9 @@ from dash.dependencies import Input, Output, State, MATCH, ALL
 import dash_core_components as dcc
 import pandas as pd
 import os
-import tableone
-from io import StringIO
 
-from ukbcc import query, utils, db, stats
-import pprint
+from ukbcc import query, utils, db, stats, bitmap, cache, connection, jobs
+from ukbcc import filter as ukbcc_filter
 
 from datetime import datetime
 print_time = lambda: datetime.now().strftime("%H:%M:%S")
@@ -63,21 +61,26 @@ tab = dbc.FormGroup(
                 dbc.FormGroup([all_dropdown, any_dropdown, none_dropdown,
                                dbc.Button("Submit", color="success", id='cohort_search_submit1', style={"margin": "5px"})])
             ),
+            dbc.Row(dbc.Col(html.P(id='cohort_count', className="card-text")), align='center'),
             dbc.Row(dbc.Col(id='query_results'), align='center'),
             dbc.Row([
                dbc.Button("Previous", color='primary', id={"name":"prev_button_query","type":"nav_btn"}, style={"margin": "5px"}),
                dbc.Button("Next", color='primary',  id={"name":"next_button_query","type":"nav_btn"}, style={"margin": "5px"})
             ]),
 
+            dcc.Store(id="query_job_id", storage_type='memory'),
+            dcc.Interval(id="query_job_interval", interval=500, disabled=True),
             dbc.Modal(
                 [
                     dbc.ModalHeader("Running query..."),
-                    dbc.ModalBody(id="run_query", children="Please wait, this could take some time.."),
+                    dbc.ModalBody([html.P(id="run_query", children="Please wait, this could take some time.."),
+                                   dbc.Progress(id="query_progress", value=0, striped=True, animated=True)]),
                     # dbc.Row(dbc.Col(id="status_message"))),
                     # dbc.Row(dbc.Col(id="query_output"))),
-                    dbc.ModalFooter(
+                    dbc.ModalFooter([
+                        dbc.Button("Cancel query", color="danger", id="cancel_query_btn", style={"margin": "5px"}),
                         dbc.Button("Close", id="close_run_query_btn", className="ml-auto", style={"margin": "5px"})
-                    ),
+                    ]),
                 ],
                 id="run_query_modal")
         ]
@@ -93,10 +96,18 @@ def toggle_modal(n1, n2, is_open):
 @app.callback(
     Output("run_query_modal", "is_open"),
     [Input("cohort_search_submit1", "n_clicks"),
-    Input("close_run_query_btn", "n_clicks")],
-    [State("run_query_modal", "is_open")]
+    Input("close_run_query_btn", "n_clicks"),
+    Input("cancel_query_btn", "n_clicks")],
+    [State("run_query_modal", "is_open"),
+     State("query_job_id", "data")]
 )
-def toggle_run_query_modal(n1, n2, is_open):
+def toggle_run_query_modal(n1, n2, n_cancel, is_open, job_id):
+    #Cancelling interrupts the running query and closes the modal
+    ctx = dash.callback_context
+    if ctx.triggered and ctx.triggered[0]['prop_id'] == 'cancel_query_btn.n_clicks':
+        if job_id:
+            jobs.get_job_runner().cancel(job_id)
+        return False
     check = toggle_modal(n1, n2, is_open)
     return check
 
@@ -156,7 +167,8 @@ def _term_iterator(selterms: dict):
     terms = pd.concat([pd.read_json(x) for x in selterms['any']] + [pd.DataFrame()])
     terms['FieldID'] = terms['FieldID'].astype(str)
     terms['Value'] = terms['Value'].astype(str)
-    rand_terms = rand_terms + [tuple(x) for x in terms[['FieldID', 'Value']].values]
+    # Values can also be ranges, e.g. '>=30' or 'E11*'
+    rand_terms = rand_terms + [(f, ukbcc_filter.parse_value(v)) for f, v in terms[['FieldID', 'Value']].values]
     rand_terms_decoded = rand_terms_decoded + [tuple(x) for x in terms[['Field', 'Meaning']].values]
     return rand_terms, rand_terms_decoded
 
@@ -193,24 +205,72 @@ def _create_conditional_logic_list(logic_terms: list, defined_terms: dict):
     return term_final, term_decoded_final
 
 
-#Submit a query
+#Show the size of the cohort as terms are picked. Counts come from the bitmap index, or COUNT(DISTINCT eid) in SQL,
+#without pivoting any values
 @app.callback(
-    # [Output("query_results", "children"),
-    [Output("cohort_id_results", "data"),
-    Output("cohort_id_results_timestamp", "data"),
-    Output("cohort_id_report", "data")],
+    Output("cohort_count", "children"),
+    [Input({"index":0, "name":"query_term_dropdown"}, 'value'),
+     Input({"index":1, "name":"query_term_dropdown"}, 'value'),
+     Input({"index":2, "name":"query_term_dropdown"}, 'value')],
+    [State("defined_terms", "data"),
+     State("config_store", "data")]
+)
+def count_cohort_terms(all_terms: list, any_terms: list, none_terms: list, defined_terms: dict, config: dict):
+    """Returns the number of participants matching the selected terms.
+
+    Keyword arguments:
+    ------------------
+    all_terms: list
+        phenotypes for all participants
+    any_terms: list
+        phenotypes for any participants
+    none_terms: list
+        phenotypes for none of the participants
+    defined_terms: dict
+        phenotypes
+    config: dict
+        path configuration
+
+    Returns:
+    --------
+    count_text: str
+        number of matching participants
+    """
+    if defined_terms is None or not config or not config.get('db_path'):
+        raise PreventUpdate
+    logic_dictionary = {'all_of': all_terms, 'any_of': any_terms, 'none_of': none_terms}
+    cohort_criteria = {logic: _create_conditional_logic_list(terms, defined_terms)[0] if terms else []
+                       for logic, terms in logic_dictionary.items()}
+    if not any(cohort_criteria.values()):
+        return ""
+    db_filename = config['db_path']
+    index = bitmap.get_bitmap_index(db_filename)
+    if index.answerable(cohort_criteria):
+        phenotypes = {logic: {term: _term_iterator(defined_terms[term])[0] for term in terms}
+                      for logic, terms in logic_dictionary.items() if terms}
+        n = index.count_phenotypes(phenotypes)
+    else:
+        n = db.count_cohort(cohort_criteria, db_filename=db_filename)
+    return f"{n} participants match these terms"
+
+
+#Submit a query. The query runs as a background job, which is polled for its progress until it has finished, so a
+#heavy cohort doesn't hold up a server worker and can be cancelled. A new search cancels the previous one
+@app.callback(
+    Output("query_job_id", "data"),
     [Input("cohort_search_submit1", "n_clicks")],
     [State("defined_terms", "data"),
      State({"index":0, "name":"query_term_dropdown"}, 'value'),
      State({"index":1, "name":"query_term_dropdown"}, 'value'),
      State({"index":2, "name":"query_term_dropdown"}, 'value'),
      State("config_store", "data"),
-     State("kw_search_terms", "data")]
+     State("kw_search_terms", "data"),
+     State("query_job_id", "data")]
 )
 def submit_cohort_query(n: int, defined_terms: dict, all_terms: list,
                         any_terms: list, none_terms: list, config: dict,
-                        kw_search_terms: list):
-    """Run cohort search.
+                        kw_search_terms: list, previous_job_id: str):
+    """Start a cohort search.
 
     Keyword arguments:
     ------------------
@@ -228,23 +288,65 @@ def submit_cohort_query(n: int, defined_terms: dict, all_terms: list,
         path configuration
     kw_search_terms: list
         search terms
+    previous_job_id: str
+        id of the job of the previous search
 
     Returns:
     --------
-    output_text: html object
-        specifies length of IDs returned from search
-    ids: list
-        contains IDs returned from search
+    job_id: str
+        id of the job running the search, which starts poll_cohort_query polling it
 
     """
-    pp = pprint.PrettyPrinter(indent=4)
-
     ctx = dash.callback_context
     if not ctx.triggered:
         raise PreventUpdate
     if n is None:
         raise PreventUpdate
 
+    runner = jobs.get_job_runner()
+    if previous_job_id:
+        runner.cancel(previous_job_id)
+    job_id = runner.submit(lambda job: run_cohort_query(job, defined_terms, all_terms, any_terms, none_terms, config,
+                                                        kw_search_terms),
+                           stages=query_stages)
+    return job_id
+
+
+# Stages of a cohort search, shown as its progress
+query_stages = ['Finding cohort', 'Computing statistics']
+
+
+def run_cohort_query(job: jobs.QueryJob, defined_terms: dict, all_terms: list, any_terms: list, none_terms: list,
+                     config: dict, kw_search_terms: list):
+    """Run cohort search, as a background job.
+
+    Keyword arguments:
+    ------------------
+    job: jobs.QueryJob
+        job running the search
+    defined_terms: dict
+        phenotypes
+    all_terms: list
+        phenotypes for all participants
+    any_terms: list
+        phenotypes for any participants
+    none_terms: list
+        phenotypes for none of the participants
+    config: dict
+        path configuration
+    kw_search_terms: list
+        search terms
+
+    Returns:
+    --------
+    ids: list
+        contains IDs returned from search
+    timestamp: float
+        time of the search
+    stats_report_dict: dict
+        report of the cohort statistics
+
+    """
     timestamp = datetime.now().timestamp()
 
     logic_dictionary = {'all_of': all_terms, 'any_of': any_terms, 'none_of': none_terms}
@@ -281,28 +383,89 @@ def submit_cohort_query(n: int, defined_terms: dict, all_terms: list,
     showcase_filename=config['showcase_path']
     coding_filename=config['codings_path']
 
-    res = db.query_sqlite_db(db_filename=db_filename, cohort_criteria=cohort_dictionaries['encoded'])
-    ret = html.P(f"No matching ids found. Please change your criteria.")
-    if res.shape[0]:
-        t1=tableone.TableOne(res)
-        ret=dbc.Table.from_dataframe(pd.read_csv(StringIO(t1.to_csv())), striped=True, bordered=True,
-                                 hover=True)
-
-    ids=res['eid'].tolist()
-    # print('\nfinished query_databases {}'.format(print_time()))
-    # print('\n generating report {}'.format(print_time()))
-    print(f"length of ids {len(ids)}")
-
-    stats_dict, translation_df = stats.compute_stats_db(db_filename, ids, showcase_filename, coding_filename)
+    # The queries below, bitmap loads included, all run on this thread's pooled connection, which is watched for
+    # progress and cancelling
+    with job.watch(connection.get_connection(db_filename)):
+        # Find the cohort from the bitmap index, which keeps the bitmap of each phenotype for the next cohorts using
+        # it. Results are cached in the cohort directory, so re-running a cohort definition is instant, also after a
+        # restart
+        job.stage(query_stages[0])
+        cohort_cache = cache.get_cohort_cache(os.path.join(outpath, 'cohort_cache.sqlite'))
+        index = bitmap.get_bitmap_index(db_filename)
+        phenotypes = {logic: {term: _term_iterator(defined_terms[term])[0] for term in terms}
+                      for logic, terms in logic_dictionary.items() if terms}
+        compute = None
+        if index.answerable(cohort_dictionaries['encoded']):
+            compute = lambda: pd.DataFrame({'eid': index.query_phenotypes(phenotypes)})
+        ids = cohort_cache.query(db_filename, cohort_dictionaries['encoded'], bitmap_index=index,
+                                 compute=compute)['eid'].tolist()
+        print(f"length of ids {len(ids)}")
+
+        job.stage(query_stages[1])
+        stats_dict, translation_df = stats.compute_stats_db(db_filename, ids, showcase_filename, coding_filename)
 
     # stats_fields = {"all_of": [], "any_of": [["20002", "1263"]], "none_of": []}
     # stats_dict, translation_df = stats.compute_stats(main_filename=config['main_path'],
     #                                            eids=ids,
     stats_report_dict = stats.create_report(translation_df)
 
-    footer = dbc.ModalFooter(dbc.Button("Close", id="close_run_query_btn_new", className="ml-auto", style={"margin": "5px"}))
-    output_text = html.P(ret)
-    output_runquery = dbc.Row(dbc.Col([output_text,
-                                       dbc.Button("Close", color='primary', id="run_query_close", style={"margin": "5px"})]))
-
     return ids, timestamp, stats_report_dict
+
+
+#Poll the job of a search, showing its progress and storing its results once it has finished. A new job id starts
+#the polling, and only this callback sets whether the interval is disabled
+@app.callback(
+    [Output("cohort_id_results", "data"),
+     Output("cohort_id_results_timestamp", "data"),
+     Output("cohort_id_report", "data"),
+     Output("query_progress", "value"),
+     Output("run_query", "children"),
+     Output("query_job_interval", "disabled")],
+    [Input("query_job_interval", "n_intervals"),
+     Input("query_job_id", "data")]
+)
+def poll_cohort_query(n_intervals: int, job_id: str):
+    """Report the progress of a cohort search.
+
+    Keyword arguments:
+    ------------------
+    n_intervals: int
+        number of times the job has been polled
+    job_id: str
+        id of the job running the search
+
+    Returns:
+    --------
+    ids: list
+        contains IDs returned from search, once finished
+    timestamp: float
+        time of the search, once finished
+    stats_report_dict: dict
+        report of the cohort statistics, once finished
+    progress: int
+        percentage of the stages of the search done
+    status_text: str
+        status of the search
+    disabled: bool
+        stop polling, once the search has finished
+
+    """
+    if not job_id:
+        raise PreventUpdate
+    runner = jobs.get_job_runner()
+    job = runner.get(job_id)
+    if job is None:
+        return dash.no_update, dash.no_update, dash.no_update, 0, "The query was lost, please submit it again.", True
+    progress = job.progress()
+    percent = int(100 * progress['fraction'])
+    if progress['status'] == 'done':
+        ids, timestamp, stats_report_dict = job.result
+        text = f"Found {len(ids)} participants." if ids else "No matching ids found. Please change your criteria."
+        return ids, timestamp, stats_report_dict, 100, text, True
+    if progress['status'] == 'cancelled':
+        return dash.no_update, dash.no_update, dash.no_update, percent, "The query was cancelled.", True
+    if progress['status'] == 'error':
+        return dash.no_update, dash.no_update, dash.no_update, percent, f"The query failed: {progress['error']}", True
+    stage = progress['stage'] or "Waiting for other queries"
+    text = f"{stage} ({progress['stages_done'] + 1} of {progress['stages']}, {progress['elapsed']:.0f}s)..."
+    return dash.no_update, dash.no_update, dash.no_update, percent, text, False
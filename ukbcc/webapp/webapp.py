@@ -9,7 +9,10 @@ import json
 from app import app
 from apps import config_app, kw_search_app, include_kw_app, definitions_app, query_app, results_app
 import webbrowser
+import argparse
+import os
 from threading import Timer
+from ukbcc import connection
 
 from dash.exceptions import PreventUpdate
 
@@ -134,6 +137,39 @@ def open_browser():
 	webbrowser.open_new("http://localhost:{}".format(port))
 
 def main():
+    """Run the webapp.
+
+    Keyword arguments:
+    ------------------
+    db_path: str
+        optional path of the sqlite database to serve immutable or from memory, or warm up, at startup
+    immutable: bool
+        serve the database read-only and immutable, without file locking, e.g. on a network filesystem
+    in_memory: bool
+        copy the whole database into memory and run every query against the copy
+    warm: str
+        comma separated tables and indexes of the database to read into the operating system's cache instead
+    """
+    parser = argparse.ArgumentParser(description='Run the ukbcc webapp.')
+    parser.add_argument('--db_path', default=None,
+                        help='Path of the sqlite database to serve immutable, load into memory or warm up at startup')
+    parser.add_argument('--immutable', action='store_true',
+                        help='Serve the database read-only and immutable, without file locking, e.g. on Lustre or '
+                             'NFS. It must not be rebuilt while the app is running')
+    parser.add_argument('--in_memory', action='store_true',
+                        help='Copy the whole database into memory and serve every query from the copy')
+    parser.add_argument('--warm', default=None,
+                        help='Comma separated tables and indexes of the database to read at startup, e.g. '
+                             'str_index,int_index,participants')
+    args, _ = parser.parse_known_args()
+    # With the reloader, only the child process serves requests
+    if args.db_path and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if args.immutable:
+            connection.set_immutable(args.db_path)
+        if args.in_memory:
+            connection.load_into_memory(args.db_path)
+        elif args.warm:
+            connection.warm(args.db_path, args.warm.split(','))
     # Timer(1, open_browser).start();
     app.run_server(debug=True, use_reloader=True, dev_tools_props_check=False, dev_tools_ui=True, port=port)
 